@@ -0,0 +1,12 @@
+Feature: Program checks several paths in one run
+  Scenario: Remove duplicates from two directories
+    Given we have "twintrim" installed
+    And we have a subdirectory "first"
+    And we have a subdirectory "second"
+    And we have two matching files "first/foo.txt" and "first/foo (1).txt"
+    And we have two matching files "second/bar.txt" and "second/bar (2).txt"
+    When we run "twintrim" with paths "first" and "second"
+    Then "first/foo.txt" still exists
+    But "first/foo (1).txt" is removed
+    And "second/bar.txt" still exists
+    But "second/bar (2).txt" is removed
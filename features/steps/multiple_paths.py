@@ -0,0 +1,15 @@
+'''
+Steps for running the program on several paths
+'''
+#pylint: disable=missing-docstring, function-redefined
+from behave import when
+import os
+import shlex
+
+from file_removal import run_program
+
+@when(u'we run "{program}" with paths "{path1}" and "{path2}"')
+def step_impl(context, program, path1, path2):
+    run_program(' '.join([program,
+                          shlex.quote(os.path.join(context.path, path1)),
+                          shlex.quote(os.path.join(context.path, path2))]))
@@ -3,8 +3,17 @@ Tests for the twintrimmer module
 '''
 # pylint: disable=missing-docstring, invalid-name, too-many-public-methods
 from io import StringIO
+import argparse
+import errno
+import hashlib
+import logging
+import logging.handlers
+import math
 import unittest
 import os
+import queue
+import struct
+import tempfile
 import sys
 from unittest.mock import patch
 from pyfakefs import fake_filesystem_unittest
@@ -28,6 +37,115 @@ class TestClumper(unittest.TestCase):
         self.assertEqual(out, {})
 
 
+class TestPartition(unittest.TestCase):
+    def test_refine_builds_keys_from_clumps(self):
+        partition = twintrimmer.twintrimmer.Partition(
+            {('a', ): ['x', 'y', 'z'], ('b', ): ['w', 'v']})
+        groups = {items[0]: group
+                  for group, items in partition.groups.items()}
+        partition.refine({(groups['x'], ('1', )): ['x', 'y'],
+                          (groups['x'], ('2', )): ['z'],
+                          (groups['w'], ('1', )): ['w', 'v']})
+        self.assertEqual(partition.dump(), {('a', '1'): {'x', 'y'},
+                                            ('a', '2'): {'z'},
+                                            ('b', '1'): {'w', 'v'}})
+
+    def test_singletons_are_dropped_as_they_appear(self):
+        partition = twintrimmer.twintrimmer.Partition(
+            {('a', ): ['x', 'y', 'z'], ('b', ): ['w']}, keep_singletons=False)
+        self.assertEqual(list(partition.groups.values()), [['x', 'y', 'z']])
+        group = next(iter(partition.groups))
+        partition.refine({(group, ('1', )): ['x', 'y'],
+                          (group, ('2', )): ['z']})
+        self.assertEqual(partition.dump(), {('a', '1'): {'x', 'y'}})
+
+    def test_items_without_clump_are_dropped(self):
+        clumper = twintrimmer.twintrimmer.RegexClumper(r'(\w+)\.txt')
+        names = [twintrimmer.Filename(name, None, None, '/' + name)
+                 for name in ('a.txt', 'a.txt', 'b.doc')]
+        partition = twintrimmer.twintrimmer.Partition({('/', ): names})
+        clumper.refine(partition)
+        self.assertEqual(partition.dump(), {('/', 'a'): set(names[:2])})
+
+
+
+class TestPipeline(unittest.TestCase):
+    def test_check_pipeline_drops_hash_stage(self):
+        self.assertEqual(['size', 'partial'],
+                         twintrimmer.twintrimmer.check_pipeline(
+                             'size,partial,hash'))
+
+    def test_check_pipeline_rejects_unknown_stage(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            twintrimmer.twintrimmer.check_pipeline('size,inode')
+
+    def test_check_pipeline_rejects_hash_before_other_stages(self):
+        with self.assertRaises(argparse.ArgumentTypeError):
+            twintrimmer.twintrimmer.check_pipeline('hash,size')
+
+    def test_default_stages_are_ordered_by_rank(self):
+        stages = twintrimmer.twintrimmer.pipeline_stages(
+            skip_regex=False, regex_pattern='(.+)')
+        self.assertEqual(['regex', 'size'], [name for name, _ in stages])
+
+    def test_default_stages_skip_regex(self):
+        stages = twintrimmer.twintrimmer.pipeline_stages(
+            skip_regex=True, regex_pattern='')
+        self.assertEqual(['size'], [name for name, _ in stages])
+
+    def test_pipeline_option_sets_order(self):
+        stages = twintrimmer.twintrimmer.pipeline_stages(
+            skip_regex=False, regex_pattern='(.+)',
+            pipeline=['partial', 'regex'])
+        self.assertEqual(['partial', 'regex'], [name for name, _ in stages])
+
+    def test_group_collects_items_of_each_group_and_clump(self):
+        entries = [(0, (4, ), 'a'), (0, (4, ), 'b'), (0, (5, ), 'c'),
+                   (1, (4, ), 'd')]
+        labelled = twintrimmer.twintrimmer.SizeClumper().group(entries)
+        self.assertEqual({(0, (4, )): ['a', 'b'], (0, (5, )): ['c'],
+                          (1, (4, )): ['d']}, dict(labelled))
+
+    @patch('twintrimmer.twintrimmer.group_with_numpy')
+    def test_numpy_backend_is_only_used_by_vectorized_stages(self,
+                                                             mock_group):
+        entries = [(0, ('a', None), 'a')]
+        clumper = twintrimmer.twintrimmer.RegexClumper('(.+)')
+        clumper.backend = 'numpy'
+        clumper.group(entries)
+        self.assertEqual(mock_group.call_count, 0)
+        clumper = twintrimmer.twintrimmer.SizeClumper()
+        clumper.backend = 'numpy'
+        clumper.group(entries)
+        mock_group.assert_called_with(entries)
+
+    @unittest.skipIf(twintrimmer.twintrimmer.numpy is None,
+                     'numpy is not installed')
+    def test_numpy_backend_matches_python_backend(self):
+        entries = [(group, ('{0:x}'.format(num % 5), num % 3), num)
+                   for group in range(3) for num in range(20)]
+        clumper = twintrimmer.twintrimmer.HashClumper('md5')
+        expected = dict(clumper.group(entries))
+        clumper.backend = 'numpy'
+        self.assertEqual(expected, clumper.group(entries))
+
+    def test_size_stage_splits_groups_without_changing_keys(self):
+        with tempfile.TemporaryDirectory() as directory:
+            files = []
+            for name, contents in (('a', b'aa'), ('b', b'bb'), ('c', b'c')):
+                path = os.path.join(directory, name)
+                with open(path, 'wb') as file:
+                    file.write(contents)
+                files.append(twintrimmer.Filename(name, '', directory, path))
+            partition = twintrimmer.twintrimmer.Partition(
+                {('dir', ): set(files)}, keep_singletons=False)
+            stats = []
+            twintrimmer.twintrimmer.run_stage(
+                'size', twintrimmer.twintrimmer.SizeClumper(), partition,
+                stats)
+        self.assertEqual({('dir', ): set(files[:2])}, partition.dump())
+        self.assertEqual(('size', 3, 2), stats[0][:3])
+
 class TestPicker(unittest.TestCase):
     def setUp(self):
         self.picker = twintrimmer.twintrimmer.Picker()
@@ -92,11 +210,47 @@ class TestHashClumper(fake_filesystem_unittest.TestCase):
         checksum = clumper.make_clump(self.full)
         self.assertEqual(checksum, ('af55da6adb51f8dc6b4d3758b5bcf8cc', ))
 
+    def test_generate_several_checksums_in_one_read(self):
+        clumper = twintrimmer.twintrimmer.HashClumper('md5,sha1')
+        with patch('builtins.open', wraps=open) as mock_open:
+            checksum = clumper.make_clump(self.full)
+        self.assertEqual(mock_open.call_count, 1)
+        self.assertEqual(checksum, (
+            'af55da6adb51f8dc6b4d3758b5bcf8cc',
+            '5a0cd97a76759aafa9fd5e4c5aa2ffe0e6f1720d'))
+
+    def test_key_digest_is_checksum_of_first_hash_function(self):
+        key = ('examples', 'af55da6adb51f8dc6b4d3758b5bcf8cc',
+               '5a0cd97a76759aafa9fd5e4c5aa2ffe0e6f1720d')
+        self.assertEqual(twintrimmer.twintrimmer.key_digest(key, 'md5,sha1'),
+                         'af55da6adb51f8dc6b4d3758b5bcf8cc')
+        self.assertEqual(twintrimmer.twintrimmer.key_digest(key, 'sha1'),
+                         '5a0cd97a76759aafa9fd5e4c5aa2ffe0e6f1720d')
+
     def test_generate_checksum_raises_OSError_for_missing_file(self):
         clumper = twintrimmer.twintrimmer.HashClumper('sha1')
         with self.assertRaises(twintrimmer.twintrimmer.ClumperError):
             clumper.make_clump(self.nonexistent)
 
+    def test_empty_files_are_not_opened(self):
+        self.fs.CreateFile('/empty.txt')
+        empty = twintrimmer.Filename(None, None, None, '/empty.txt')
+        clumper = twintrimmer.twintrimmer.HashClumper('md5')
+        with patch.object(clumper, 'checksum') as mock_checksum:
+            checksum = clumper.make_clump(empty)
+        self.assertEqual(mock_checksum.call_count, 0)
+        self.assertEqual(checksum, (hashlib.md5(b'').hexdigest(), ))
+
+    def test_empty_files_are_read_when_asked(self):
+        self.fs.CreateFile('/empty.txt')
+        empty = twintrimmer.Filename(None, None, None, '/empty.txt')
+        clumper = twintrimmer.twintrimmer.HashClumper('md5', read_empty=True)
+        with patch.object(clumper, 'checksum',
+                          wraps=clumper.checksum) as mock_checksum:
+            checksum = clumper.make_clump(empty)
+        self.assertEqual(mock_checksum.call_count, 1)
+        self.assertEqual(checksum, (hashlib.md5(b'').hexdigest(), ))
+
     def test_generate_checksum_dict_from_list_of_one_file(self):
         clumper = twintrimmer.twintrimmer.HashClumper('sha1')
         checksum_dict = clumper.dump_clumps({(None, ): [self.test]})
@@ -123,6 +277,367 @@ class TestHashClumper(fake_filesystem_unittest.TestCase):
                                    '5a0cd97a76759aafa9fd5e4c5aa2ffe0e6f1720d')]
         self.assertEqual(len(filenames), 0)
 
+    def test_files_are_hashed_in_inode_order(self):
+        clumper = twintrimmer.twintrimmer.HashClumper('sha1')
+        with patch.object(clumper, 'checksum',
+                          wraps=clumper.checksum) as mock_checksum:
+            clumper.dump_clumps({(None, ): [self.test2, self.full],
+                                 ('other', ): [self.test]})
+        order = [call[0][0] for call in mock_checksum.call_args_list]
+        self.assertEqual(order, sorted(
+            [self.test2, self.test, self.full],
+            key=lambda item: os.stat(item.path).st_ino))
+
+    def test_empty_files_never_reach_the_readers(self):
+        self.fs.CreateFile('/empty.txt')
+        self.fs.CreateFile('/empty2.txt')
+        empty = twintrimmer.Filename(None, None, None, '/empty.txt')
+        empty2 = twintrimmer.Filename(None, None, None, '/empty2.txt')
+        clumper = twintrimmer.twintrimmer.AsyncHashClumper('md5', 2)
+        with patch.object(clumper, 'checksum',
+                          wraps=clumper.checksum) as mock_checksum:
+            checksum_dict = clumper.dump_clumps(
+                {(None, ): [empty, empty2, self.test]})
+        self.assertEqual(mock_checksum.call_count, 1)
+        self.assertEqual(checksum_dict[(None, hashlib.md5(b'').hexdigest())],
+                         {empty, empty2})
+
+    @patch('twintrimmer.twintrimmer.physical_offset')
+    @patch('twintrimmer.twintrimmer.is_rotational')
+    def test_files_on_spinning_disks_are_hashed_in_extent_order(
+            self, mock_rotational, mock_offset):
+        mock_rotational.return_value = True
+        offsets = {self.full.path: 4096, self.test.path: 8192,
+                   self.test2.path: 0}
+        mock_offset.side_effect = offsets.get
+        clumper = twintrimmer.twintrimmer.HashClumper('sha1')
+        with patch.object(clumper, 'checksum',
+                          wraps=clumper.checksum) as mock_checksum:
+            clumper.dump_clumps({(None, ): [self.test, self.full,
+                                            self.test2, self.nonexistent]})
+        order = [call[0][0] for call in mock_checksum.call_args_list]
+        self.assertEqual(order, [self.test2, self.full, self.test])
+        self.assertEqual(mock_rotational.call_count, 1)
+
+    @patch('twintrimmer.twintrimmer.physical_offset')
+    @patch('twintrimmer.twintrimmer.is_rotational')
+    def test_empty_files_on_spinning_disks_are_not_opened(
+            self, mock_rotational, mock_offset):
+        mock_rotational.return_value = True
+        mock_offset.return_value = None
+        self.fs.CreateFile('/empty.txt')
+        empty = twintrimmer.Filename(None, None, None, '/empty.txt')
+        clumper = twintrimmer.twintrimmer.HashClumper('sha1')
+        clumper.dump_clumps({(None, ): [empty, self.test, self.test2]})
+        paths = [call[0][0] for call in mock_offset.call_args_list]
+        self.assertNotIn('/empty.txt', paths)
+        self.assertEqual(2, len(paths))
+
+    def test_hard_links_are_hashed_once(self):
+        os.link('/test.txt', '/link.txt')
+        link = twintrimmer.Filename(None, None, None, '/link.txt')
+        clumper = twintrimmer.twintrimmer.HashClumper('sha1')
+        with patch.object(clumper, 'checksum',
+                          wraps=clumper.checksum) as mock_checksum:
+            checksum_dict = clumper.dump_clumps(
+                {(None, ): [self.test, link, self.test2]})
+        self.assertEqual(mock_checksum.call_count, 2)
+        filenames = checksum_dict[(None,
+                                   '5a0cd97a76759aafa9fd5e4c5aa2ffe0e6f1720d')]
+        self.assertEqual(filenames, {self.test, link, self.test2})
+
+
+class TestAsyncHashClumper(fake_filesystem_unittest.TestCase):
+    setUp = TestHashClumper.setUp
+
+    def test_generate_checksum_dict_matches_hash_clumper(self):
+        clumps = {(None, ): [self.test, self.test2, self.full],
+                  ('other', ): [self.full, self.nonexistent]}
+        expected = twintrimmer.twintrimmer.HashClumper('md5').dump_clumps(
+            clumps)
+        clumper = twintrimmer.twintrimmer.AsyncHashClumper('md5', 2)
+        self.assertEqual(clumper.dump_clumps(clumps), expected)
+
+    def test_generate_checksum_dict_handles_OSError(self):
+        clumper = twintrimmer.twintrimmer.AsyncHashClumper('sha1', 3)
+        checksum_dict = clumper.dump_clumps({(None, ): [self.nonexistent]})
+        self.assertEqual(checksum_dict, {})
+
+    def test_hard_links_are_hashed_once(self):
+        os.link('/test.txt', '/link.txt')
+        link = twintrimmer.Filename(None, None, None, '/link.txt')
+        clumper = twintrimmer.twintrimmer.AsyncHashClumper('sha1', 4)
+        with patch.object(clumper, 'checksum',
+                          wraps=clumper.checksum) as mock_checksum:
+            checksum_dict = clumper.dump_clumps(
+                {(None, ): [self.test, link], ('other', ): [self.test2]})
+        self.assertEqual(mock_checksum.call_count, 2)
+        self.assertEqual(
+            checksum_dict[(None, '5a0cd97a76759aafa9fd5e4c5aa2ffe0e6f1720d')],
+            {self.test, link})
+
+    @patch('twintrimmer.twintrimmer.physical_offset')
+    @patch('twintrimmer.twintrimmer.is_rotational')
+    def test_rotational_device_is_read_in_inode_order(self, mock_rotational,
+                                                      mock_offset):
+        mock_rotational.return_value = True
+        mock_offset.return_value = None
+        clumper = twintrimmer.twintrimmer.AsyncHashClumper('sha1', 4)
+        with patch.object(clumper, 'checksum',
+                          wraps=clumper.checksum) as mock_checksum:
+            clumper.dump_clumps({(None, ): [self.test2, self.test, self.full]})
+        order = [call[0][0] for call in mock_checksum.call_args_list]
+        self.assertEqual(order, sorted(
+            [self.test2, self.test, self.full],
+            key=lambda item: os.stat(item.path).st_ino))
+
+
+class TestSparseChecksum(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.clumper = twintrimmer.twintrimmer.HashClumper('md5')
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def make_file(self, name, size, data=None, offset=0):
+        path = os.path.join(self.tempdir.name, name)
+        with open(path, 'wb') as file:
+            file.truncate(size)
+            if data is not None:
+                file.seek(offset)
+                file.write(data)
+        return twintrimmer.twintrimmer.Filename(name, name, '', path)
+
+    def expected(self, filename):
+        with open(filename.path, 'rb') as file:
+            return (hashlib.md5(file.read()).hexdigest(), )
+
+    def test_sparse_file_matches_full_read(self):
+        filename = self.make_file('image', 8 * 1024 * 1024, b'x' * 5000,
+                                  3 * 1024 * 1024)
+        self.assertEqual(self.clumper.read_checksum(filename),
+                         self.expected(filename))
+
+    def test_all_zero_files_are_hashed_once_per_size(self):
+        first = self.make_file('first', 4 * 1024 * 1024)
+        second = self.make_file('second', 4 * 1024 * 1024)
+        self.assertEqual(self.clumper.read_checksum(first),
+                         self.expected(first))
+        self.assertEqual(self.clumper.read_checksum(second),
+                         self.expected(second))
+        if os.stat(first.path).st_blocks == 0:
+            self.assertEqual(list(self.clumper.zero_checksums),
+                             [4 * 1024 * 1024])
+
+    @patch('twintrimmer.twintrimmer.data_extents', return_value=[])
+    def test_preallocated_zero_file_is_not_read(self, mock_extents):
+        filename = self.make_file('preallocated', 0, bytes(1024 * 1024))
+        with patch('builtins.open', wraps=open) as mock_open:
+            self.assertEqual(self.clumper.read_checksum(filename),
+                             self.expected(filename))
+        self.assertEqual(1, mock_extents.call_count)
+        self.assertEqual(list(self.clumper.zero_checksums), [1024 * 1024])
+        self.assertEqual(1, mock_open.call_count)
+
+    @patch('os.lseek')
+    def test_unsupported_seek_data_reads_whole_file(self, mock_lseek):
+        mock_lseek.side_effect = OSError(errno.EINVAL, 'Invalid argument')
+        self.assertIsNone(twintrimmer.twintrimmer.data_extents(0, 100))
+
+    def test_extents_of_dense_file(self):
+        filename = self.make_file('dense', 0, b'y' * 10000)
+        with open(filename.path, 'rb') as file:
+            extents = twintrimmer.twintrimmer.data_extents(file.fileno(),
+                                                           10000)
+        self.assertIn(extents, ([(0, 10000)], None))
+
+    def test_zeros_are_fed_in_chunks(self):
+        checksum = hashlib.md5()
+        twintrimmer.twintrimmer.update_with_zeros(checksum, 10000, 4096)
+        self.assertEqual(checksum.hexdigest(),
+                         hashlib.md5(bytes(10000)).hexdigest())
+
+
+class TestTreeChecksum(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.data = bytes(range(256)) * 40
+        path = os.path.join(self.tempdir.name, 'large')
+        with open(path, 'wb') as file:
+            file.write(self.data)
+        self.large = twintrimmer.twintrimmer.Filename('large', 'large', '',
+                                                      path)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_root_checksum_combines_range_checksums(self):
+        clumper = twintrimmer.twintrimmer.HashClumper('md5', tree_chunk=1000)
+        ranges = b''.join(hashlib.md5(self.data[start:start + 1000]).digest()
+                          for start in range(0, len(self.data), 1000))
+        self.assertEqual(clumper.read_checksum(self.large),
+                         (hashlib.md5(ranges).hexdigest(), ))
+
+    def test_root_checksum_of_each_hash_function(self):
+        clumper = twintrimmer.twintrimmer.HashClumper('md5,sha1',
+                                                      tree_chunk=6000)
+        ranges = [self.data[:6000], self.data[6000:]]
+        self.assertEqual(clumper.read_checksum(self.large), (
+            hashlib.md5(b''.join(hashlib.md5(part).digest()
+                                 for part in ranges)).hexdigest(),
+            hashlib.sha1(b''.join(hashlib.sha1(part).digest()
+                                  for part in ranges)).hexdigest()))
+
+    def cached_clumper(self):
+        cache = twintrimmer.twintrimmer.ChunkCache(
+            os.path.join(self.tempdir.name, 'chunks.json'), 'md5', 1000)
+        cache.load()
+        return twintrimmer.twintrimmer.HashClumper(
+            'md5', tree_chunk=1000, chunk_cache=cache), cache
+
+    def fresh_checksum(self):
+        clumper = twintrimmer.twintrimmer.HashClumper('md5', tree_chunk=1000)
+        return clumper.read_checksum(self.large)
+
+    def read_ranges(self):
+        clumper, cache = self.cached_clumper()
+        with patch('os.pread', wraps=os.pread) as mock_pread:
+            checksum = clumper.read_checksum(self.large)
+        cache.save()
+        return checksum, {call[0][2] // 1000
+                          for call in mock_pread.call_args_list}
+
+    def append(self, data):
+        with open(self.large.path, 'ab') as file:
+            file.write(data)
+
+    def test_unchanged_file_is_not_read_again(self):
+        checksum, _ = self.read_ranges()
+        self.assertEqual(self.read_ranges(), (checksum, set()))
+
+    def test_only_ranges_past_old_end_are_read(self):
+        self.read_ranges()
+        self.append(b'x' * 2000)
+        checksum, ranges = self.read_ranges()
+        self.assertEqual(checksum, self.fresh_checksum())
+        self.assertEqual(ranges, {0, 5, 9, 10, 11, 12})
+
+    def test_modified_file_is_read_again(self):
+        self.read_ranges()
+        with open(self.large.path, 'r+b') as file:
+            file.write(b'changed')
+        self.append(b'x' * 2000)
+        checksum, ranges = self.read_ranges()
+        self.assertEqual(checksum, self.fresh_checksum())
+        self.assertEqual(ranges, set(range(13)))
+        self.assertEqual(checksum, self.read_ranges()[0])
+
+    def test_file_changed_without_growing_is_read_again(self):
+        checksum, _ = self.read_ranges()
+        with open(self.large.path, 'r+b') as file:
+            file.seek(3000)
+            file.write(b'changed')
+        stat = os.stat(self.large.path)
+        os.utime(self.large.path, ns=(stat.st_atime_ns,
+                                      stat.st_mtime_ns + 10 ** 9))
+        changed, ranges = self.read_ranges()
+        self.assertNotEqual(checksum, changed)
+        self.assertEqual(changed, self.fresh_checksum())
+        self.assertEqual(ranges, set(range(11)))
+
+    def test_cache_of_other_range_size_is_ignored(self):
+        self.read_ranges()
+        cache = twintrimmer.twintrimmer.ChunkCache(
+            os.path.join(self.tempdir.name, 'chunks.json'), 'md5', 2000)
+        cache.load()
+        self.assertEqual(cache.files, {})
+
+    def test_files_below_chunk_size_are_hashed_whole(self):
+        clumper = twintrimmer.twintrimmer.HashClumper('md5',
+                                                      tree_chunk=len(self.data))
+        self.assertEqual(clumper.read_checksum(self.large),
+                         (hashlib.md5(self.data).hexdigest(), ))
+
+
+class TestPhysicalOffset(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.fs.CreateFile('/test.txt', contents='First line\n')
+
+    @staticmethod
+    def fake_fiemap(extents, physical=0):
+        header = twintrimmer.twintrimmer.FIEMAP
+        extent = twintrimmer.twintrimmer.FIEMAP_EXTENT
+
+        def ioctl(_, request, buf):
+            assert request == twintrimmer.twintrimmer.FS_IOC_FIEMAP
+            start, length, flags, _, count, _ = header.unpack_from(buf, 0)
+            assert count == 1
+            header.pack_into(buf, 0, start, length, flags, extents, count, 0)
+            extent.pack_into(buf, header.size, 0, physical, 4096,
+                             0, 0, 1, 0, 0, 0)
+            return 0
+        return ioctl
+
+    @patch('fcntl.ioctl')
+    def test_returns_offset_of_first_extent(self, mock_ioctl):
+        mock_ioctl.side_effect = self.fake_fiemap(1, physical=123456)
+        self.assertEqual(
+            twintrimmer.twintrimmer.physical_offset('/test.txt'), 123456)
+
+    @patch('fcntl.ioctl')
+    def test_returns_none_without_extents(self, mock_ioctl):
+        mock_ioctl.side_effect = self.fake_fiemap(0)
+        self.assertIsNone(twintrimmer.twintrimmer.physical_offset('/test.txt'))
+
+    @patch('fcntl.ioctl')
+    def test_returns_none_when_unsupported(self, mock_ioctl):
+        mock_ioctl.side_effect = OSError(errno.EOPNOTSUPP, 'unsupported')
+        self.assertIsNone(twintrimmer.twintrimmer.physical_offset('/test.txt'))
+
+    def test_returns_none_for_missing_file(self):
+        self.assertIsNone(twintrimmer.twintrimmer.physical_offset('/none'))
+
+
+class TestDeviceScheduler(fake_filesystem_unittest.TestCase):
+    def setUp(self):
+        self.setUpPyfakefs()
+        self.scheduler = twintrimmer.twintrimmer.DeviceScheduler(6)
+        self.device = os.makedev(8, 1)
+
+    def tearDown(self):
+        self.scheduler.shutdown()
+
+    def test_spinning_disk_gets_one_reader(self):
+        self.fs.CreateFile('/sys/dev/block/8:1/queue/rotational',
+                           contents='1\n')
+        self.assertEqual(self.scheduler.readers(self.device), 1)
+        self.assertEqual(self.scheduler.executor(self.device)._max_workers,
+                         1)
+
+    def test_solid_state_disk_gets_concurrency_readers(self):
+        self.fs.CreateFile('/sys/dev/block/8:1/queue/rotational',
+                           contents='0\n')
+        self.assertEqual(self.scheduler.readers(self.device), 6)
+
+    def test_partition_uses_parent_disk(self):
+        self.fs.CreateFile('/sys/block/sda/queue/rotational',
+                           contents='1\n')
+        self.fs.CreateDirectory('/sys/block/sda/sda1')
+        self.fs.CreateLink('/sys/dev/block/8:1', '/sys/block/sda/sda1')
+        self.assertTrue(twintrimmer.twintrimmer.is_rotational(self.device))
+
+    def test_device_without_sysfs_entry_is_not_rotational(self):
+        self.assertFalse(twintrimmer.twintrimmer.is_rotational(
+            os.makedev(0, 42)))
+
+    def test_executor_is_shared_per_device(self):
+        self.assertIs(self.scheduler.executor(self.device),
+                      self.scheduler.executor(self.device))
+        self.assertIsNot(self.scheduler.executor(self.device),
+                         self.scheduler.executor(os.makedev(8, 16)))
+
 
 class TestShortestPicker(unittest.TestCase):
     def setUp(self):
@@ -267,6 +782,713 @@ class TestCaseWithFileSystem(fake_filesystem_unittest.TestCase):
         self.picker = twintrimmer.twintrimmer.ShortestPicker()
 
 
+class TestPathClumperRoots(TestCaseWithFileSystem):
+    def test_dump_clumps_walks_every_root(self):
+        clumper = twintrimmer.twintrimmer.PathClumper(
+            ['examples/recur', 'examples/underscore'])
+        self.assertEqual(set(clumper.dump_clumps()),
+                         {('examples/recur', ), ('examples/underscore', )})
+
+    def test_dump_clumps_lists_overlapping_roots_once(self):
+        clumper = twintrimmer.twintrimmer.PathClumper(
+            ['examples', 'examples/recur'], recursive=True)
+        clumps = clumper.dump_clumps()
+        self.assertEqual(len(clumps), 3)
+        self.assertEqual(len(list(clumps[('examples/recur', )])), 2)
+
+
+class TestWalkFilter(TestCaseWithFileSystem):
+    @staticmethod
+    def walk(walk_filter, clumper=twintrimmer.twintrimmer.PathClumper):
+        clumps = clumper('examples', True,
+                         walk_filter=walk_filter).dump_clumps()
+        return {key[0]: sorted(item.name for item in value)
+                for key, value in clumps.items()}
+
+    def test_exclude_prunes_files_and_directories(self):
+        walk_filter = twintrimmer.twintrimmer.WalkFilter(['recur', 'baz*'])
+        clumps = self.walk(walk_filter)
+        self.assertEqual(set(clumps), {'examples', 'examples/underscore'})
+        self.assertNotIn('baz.txt', clumps['examples'])
+        self.assertIn('foo.txt', clumps['examples'])
+
+    def test_ignore_file_applies_below_its_directory(self):
+        self.fs.CreateFile('examples/recur/.twintrimignore',
+                           contents='# comment\n\nfile (*\n')
+        self.fs.CreateFile('examples/recur/deep/file (3).txt')
+        self.fs.CreateFile('examples/underscore/file (3).txt')
+        clumps = self.walk(twintrimmer.twintrimmer.WalkFilter(),
+                           twintrimmer.twintrimmer.AsyncPathClumper)
+        self.assertEqual(clumps['examples/recur'],
+                         ['.twintrimignore', 'file.txt'])
+        self.assertEqual(clumps['examples/recur/deep'], [])
+        self.assertIn('file (3).txt', clumps['examples/underscore'])
+
+    def test_size_limits_skip_files(self):
+        self.fs.CreateFile('examples/big.txt', contents='x' * 100)
+        walk_filter = twintrimmer.twintrimmer.WalkFilter(min_size=5,
+                                                         max_size=50)
+        clumps = self.walk(walk_filter)
+        self.assertNotIn('big.txt', clumps['examples'])
+        self.assertNotIn('foo.txt', clumps['examples'])
+        self.assertIn('baz.txt', clumps['examples'])
+        self.assertEqual(clumps['examples/underscore'], [])
+
+    def test_allows_checks_globs_of_every_directory_above(self):
+        self.fs.CreateFile('examples/recur/.twintrimignore',
+                           contents='deep\n')
+        self.fs.CreateFile('examples/recur/deep/new.txt')
+        walk_filter = twintrimmer.twintrimmer.WalkFilter(['*.bak'])
+        self.assertFalse(walk_filter.allows('examples/foo.bak', 'examples'))
+        self.assertFalse(walk_filter.allows('examples/recur/deep/new.txt',
+                                            'examples'))
+        self.assertTrue(walk_filter.allows('examples/recur/file.txt',
+                                           'examples'))
+
+    def test_allows_checks_skipped_directories_and_size(self):
+        walk_filter = twintrimmer.twintrimmer.WalkFilter(
+            min_size=5, skip_dirs=['examples/recur'])
+        self.assertFalse(walk_filter.allows('examples/recur/file.txt',
+                                            ['examples']))
+        self.assertFalse(walk_filter.allows('examples/foo.txt', 'examples'))
+        self.assertTrue(walk_filter.allows('examples/baz.txt', 'examples'))
+
+    def test_same_globs_share_one_matcher(self):
+        walk_filter = twintrimmer.twintrimmer.WalkFilter(['*.o'])
+        self.walk(walk_filter)
+        self.assertEqual(list(walk_filter.matchers), [('*.o', )])
+
+    def test_parse_size_understands_suffixes(self):
+        parse_size = twintrimmer.twintrimmer.parse_size
+        self.assertEqual(parse_size('100'), 100)
+        self.assertEqual(parse_size('4K'), 4096)
+        self.assertEqual(parse_size('2GiB'), 2 * 1024 ** 3)
+        with self.assertRaises(argparse.ArgumentTypeError):
+            parse_size('lots')
+
+
+class TestAsyncPathClumper(TestCaseWithFileSystem):
+    @staticmethod
+    def as_sets(clumps):
+        return {key: set(value) for key, value in clumps.items()}
+
+    def test_dump_clumps_matches_path_clumper(self):
+        expected = twintrimmer.twintrimmer.PathClumper('examples')
+        clumper = twintrimmer.twintrimmer.AsyncPathClumper('examples')
+        self.assertEqual(self.as_sets(clumper.dump_clumps()),
+                         self.as_sets(expected.dump_clumps()))
+
+    def test_dump_clumps_recursive_matches_path_clumper(self):
+        expected = twintrimmer.twintrimmer.PathClumper('examples', True)
+        clumper = twintrimmer.twintrimmer.AsyncPathClumper('examples', True, 2)
+        self.assertEqual(self.as_sets(clumper.dump_clumps()),
+                         self.as_sets(expected.dump_clumps()))
+
+    def test_dump_clumps_several_roots_matches_path_clumper(self):
+        roots = ['examples/recur', 'examples', 'examples/underscore']
+        expected = twintrimmer.twintrimmer.PathClumper(roots, True)
+        clumper = twintrimmer.twintrimmer.AsyncPathClumper(roots, True, 2)
+        self.assertEqual(self.as_sets(clumper.dump_clumps()),
+                         self.as_sets(expected.dump_clumps()))
+
+    def test_dump_clumps_raises_not_implemented(self):
+        clumper = twintrimmer.twintrimmer.AsyncPathClumper('examples')
+        with self.assertRaises(NotImplementedError):
+            clumper.dump_clumps({('this'): {'one', 'two'}})
+
+    def test_listing_error_does_not_stop_the_walk(self):
+        roots = ['examples/recur', 'examples', 'examples/underscore']
+        clumper = twintrimmer.twintrimmer.AsyncPathClumper(roots, False, 1)
+        list_directory = clumper.list_directory
+
+        def fail_first(path):
+            if path == 'examples/recur':
+                raise OSError(errno.ENOSPC, 'No space left on device')
+            return list_directory(path)
+
+        with patch.object(clumper, 'list_directory', side_effect=fail_first):
+            with self.assertLogs('twintrimmer', 'ERROR') as logs:
+                clumps = clumper.dump_clumps()
+        self.assertIn('examples/recur', '\n'.join(logs.output))
+        self.assertEqual({('examples', ), ('examples/underscore', )},
+                         set(clumps))
+
+    def test_scan_directory_handles_OSError(self):
+        scan = twintrimmer.twintrimmer.AsyncPathClumper.scan_directory
+        self.assertEqual(scan('examples/missing'), ([], []))
+
+    def test_scan_directory_without_context_manager(self):
+        scandir = os.scandir
+        scan = twintrimmer.twintrimmer.AsyncPathClumper.scan_directory
+        expected = scan('examples')
+        with patch('os.scandir', side_effect=lambda path: iter(
+                list(scandir(path)))):
+            self.assertEqual(scan('examples'), expected)
+
+
+class TestCheckpoint(TestCaseWithFileSystem):
+    def setUp(self):
+        super(TestCheckpoint, self).setUp()
+        self.checkpoint = twintrimmer.twintrimmer.Checkpoint('progress.json',
+                                                             'md5')
+        self.foo = twintrimmer.Filename('foo.txt', 'foo', '.txt',
+                                        'examples/foo.txt')
+
+    def test_save_and_load_progress(self):
+        stat = os.stat(self.foo.path)
+        self.checkpoint.add_listing('examples', 7, ['foo.txt'], [])
+        self.checkpoint.add_checksum(self.foo.path, stat, ('abc', ))
+        self.checkpoint.save()
+        loaded = twintrimmer.twintrimmer.Checkpoint('progress.json', 'md5')
+        loaded.load()
+        self.assertEqual(loaded.listing('examples', 7), (['foo.txt'], []))
+        self.assertEqual(loaded.checksum(self.foo.path, stat), ('abc', ))
+        self.assertFalse(os.path.exists('progress.json.tmp'))
+
+    def test_load_ignores_other_hash_function(self):
+        self.checkpoint.add_listing('examples', 7, ['foo.txt'], [])
+        self.checkpoint.save()
+        loaded = twintrimmer.twintrimmer.Checkpoint('progress.json', 'sha1')
+        loaded.load()
+        self.assertIsNone(loaded.listing('examples', 7))
+
+    def test_load_handles_missing_and_corrupt_files(self):
+        self.checkpoint.load()
+        self.assertEqual(self.checkpoint.directories, {})
+        self.fs.CreateFile('progress.json', contents='{"trunc')
+        self.checkpoint.load()
+        self.assertEqual(self.checkpoint.directories, {})
+
+    def test_modified_directory_listing_is_not_reused(self):
+        self.checkpoint.add_listing('examples', 7, ['foo.txt'], [])
+        self.assertIsNone(self.checkpoint.listing('examples', 8))
+
+    def test_modified_file_checksum_is_not_reused(self):
+        self.checkpoint.add_checksum(self.foo.path, os.stat(self.foo.path),
+                                     ('abc', ))
+        with open(self.foo.path, 'a') as file:
+            file.write('more')
+        self.assertIsNone(self.checkpoint.checksum(self.foo.path,
+                                                   os.stat(self.foo.path)))
+
+    def test_saves_when_interval_has_passed(self):
+        self.checkpoint.interval = 0
+        self.checkpoint.add_listing('examples', 7, ['foo.txt'], [])
+        self.assertTrue(os.path.exists('progress.json'))
+
+    def test_does_not_save_before_interval(self):
+        self.checkpoint.add_listing('examples', 7, ['foo.txt'], [])
+        self.assertFalse(os.path.exists('progress.json'))
+
+    def test_remove_handles_missing_file(self):
+        self.checkpoint.remove()
+        self.checkpoint.save()
+        self.checkpoint.remove()
+        self.assertFalse(os.path.exists('progress.json'))
+
+    def test_hash_clumper_reuses_saved_checksum(self):
+        self.checkpoint.add_checksum(self.foo.path, os.stat(self.foo.path),
+                                     ('abc', ))
+        clumper = twintrimmer.twintrimmer.HashClumper('md5', self.checkpoint)
+        with patch.object(clumper, 'read_checksum') as mock_read:
+            self.assertEqual(clumper.make_clump(self.foo), ('abc', ))
+        self.assertEqual(mock_read.call_count, 0)
+
+    def test_hash_clumper_saves_new_checksum(self):
+        clumper = twintrimmer.twintrimmer.HashClumper('md5', self.checkpoint)
+        clump = clumper.make_clump(self.foo)
+        self.assertEqual(
+            self.checkpoint.checksum(self.foo.path, os.stat(self.foo.path)),
+            clump)
+
+    def test_path_clumper_reuses_saved_listing(self):
+        mtime = os.stat('examples/recur').st_mtime_ns
+        self.checkpoint.add_listing('examples/recur', mtime, ['saved.txt'],
+                                    [])
+        clumper = twintrimmer.twintrimmer.PathClumper(
+            'examples', True, self.checkpoint)
+        clumps = clumper.dump_clumps()
+        self.assertEqual([item.name for item in clumps[('examples/recur', )]],
+                         ['saved.txt'])
+        self.assertIn('examples/underscore', self.checkpoint.directories)
+
+
+class TestReferenceIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'library.idx')
+        self.digests = [hashlib.md5(str(num).encode()).digest()
+                        for num in range(50)]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_finds_every_written_checksum(self):
+        count = twintrimmer.twintrimmer.ReferenceIndex.write(
+            self.path, 'md5', self.digests + self.digests[:5])
+        self.assertEqual(count, 50)
+        index = twintrimmer.twintrimmer.ReferenceIndex(self.path)
+        self.assertEqual(len(index), 50)
+        self.assertEqual(index.hash_name, 'md5')
+        for digest in self.digests:
+            self.assertIn(digest, index)
+        self.assertNotIn(hashlib.md5(b'missing').digest(), index)
+        index.close()
+
+    def test_empty_index_finds_nothing(self):
+        twintrimmer.twintrimmer.ReferenceIndex.write(self.path, 'sha1', [])
+        index = twintrimmer.twintrimmer.ReferenceIndex(self.path)
+        self.assertNotIn(hashlib.sha1(b'').digest(), index)
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.ReferenceIndex(self.path)
+
+    def test_rejects_truncated_index(self):
+        twintrimmer.twintrimmer.ReferenceIndex.write(self.path, 'md5',
+                                                     self.digests)
+        with open(self.path, 'r+b') as file:
+            file.truncate(100)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.ReferenceIndex(self.path)
+        with open(self.path, 'r+b') as file:
+            file.truncate(10)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.ReferenceIndex(self.path)
+
+
+class TestScanIndex(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'scan.idx')
+        self.stat = os.stat(self.tempdir.name)
+        self.entries = [('/files/{0}.txt'.format(num), self.stat,
+                         hashlib.md5(str(num % 20).encode()).digest())
+                        for num in range(60)]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_finds_every_record_of_a_checksum(self):
+        count = twintrimmer.twintrimmer.ScanIndex.write(self.path, 'md5',
+                                                        self.entries)
+        self.assertEqual(count, 60)
+        index = twintrimmer.twintrimmer.ScanIndex(self.path)
+        self.assertEqual(len(index), 60)
+        self.assertEqual(index.hash_name, 'md5')
+        records = index.find(hashlib.md5(b'3').digest())
+        self.assertEqual([record.path for record in records],
+                         ['/files/23.txt', '/files/3.txt', '/files/43.txt'])
+        self.assertEqual(records[0].size, self.stat.st_size)
+        self.assertEqual(records[0].mtime_ns, self.stat.st_mtime_ns)
+        self.assertEqual(records[0].ino, self.stat.st_ino)
+        self.assertIn(hashlib.md5(b'19').digest(), index)
+        self.assertNotIn(hashlib.md5(b'missing').digest(), index)
+        self.assertEqual(index.find(hashlib.md5(b'missing').digest()), [])
+        with self.assertRaises(IndexError):
+            index[60]
+        index.close()
+
+    def test_keeps_undecodable_paths(self):
+        name = os.fsdecode(b'/files/caf\xe9.txt')
+        twintrimmer.twintrimmer.ScanIndex.write(
+            self.path, 'sha1', [(name, self.stat, b'\0' * 20)])
+        index = twintrimmer.twintrimmer.ScanIndex(self.path)
+        self.assertEqual(index[0].path, name)
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.ScanIndex(self.path)
+
+    def test_rejects_truncated_index(self):
+        twintrimmer.twintrimmer.ScanIndex.write(self.path, 'md5',
+                                                self.entries)
+        with open(self.path, 'r+b') as file:
+            file.truncate(100)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.ScanIndex(self.path)
+        with open(self.path, 'r+b') as file:
+            file.truncate(10)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.ScanIndex(self.path)
+
+    def test_open_index_reads_both_kinds(self):
+        twintrimmer.twintrimmer.ScanIndex.write(self.path, 'md5',
+                                                self.entries)
+        index = twintrimmer.twintrimmer.open_index(self.path)
+        self.assertIsInstance(index, twintrimmer.twintrimmer.ScanIndex)
+        twintrimmer.twintrimmer.ReferenceIndex.write(self.path, 'md5', [])
+        index = twintrimmer.twintrimmer.open_index(self.path)
+        self.assertIsInstance(index, twintrimmer.twintrimmer.ReferenceIndex)
+        with open(self.path, 'wb') as file:
+            file.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.open_index(self.path)
+
+
+class TestQuarantine(TestCaseWithFileSystem):
+    def setUp(self):
+        super(TestQuarantine, self).setUp()
+        self.quarantine = twintrimmer.twintrimmer.Quarantine('trash', 0)
+        self.options = dict(hash_function='md5',
+                            skip_regex=True,
+                            recursive=True,
+                            remove_links=True,
+                            quarantine='examples/.trash')
+
+    def test_files_keep_their_path_in_the_trash_tree(self):
+        target = self.quarantine.target('examples/foo (1).txt')
+        self.assertTrue(target.startswith(self.quarantine.batch))
+        self.assertTrue(target.endswith(os.path.abspath(
+            'examples/foo (1).txt')))
+
+    def test_files_are_renamed_into_the_trash_tree(self):
+        target = self.quarantine.move('examples/foo (1).txt')
+        self.assertFalse(os.path.exists('examples/foo (1).txt'))
+        with open(target) as file:
+            self.assertEqual('foo\n', file.read())
+
+    def test_same_path_moved_twice_is_kept(self):
+        first = self.quarantine.move('examples/foo (1).txt')
+        self.fs.CreateFile('examples/foo (1).txt', contents='foo\n')
+        second = self.quarantine.move('examples/foo (1).txt')
+        self.assertNotEqual(first, second)
+        self.assertTrue(os.path.exists(first))
+        self.assertTrue(os.path.exists(second))
+
+    @patch('os.replace')
+    def test_other_filesystem_is_reported(self, mock_replace):
+        mock_replace.side_effect = OSError(errno.EXDEV, 'Cross-device link')
+        with self.assertRaises(OSError) as context:
+            self.quarantine.move('examples/foo (1).txt')
+        self.assertIn('Quarantine is on another filesystem',
+                      str(context.exception))
+
+    def test_walk_path_quarantines_duplicates(self):
+        twintrimmer.walk_path('examples', **self.options)
+        self.assertFalse(os.path.exists('examples/foo (1).txt'))
+        self.assertEqual(1, len(os.listdir('examples/.trash')))
+
+    def test_walk_path_skips_the_trash_tree(self):
+        def quarantined():
+            return sorted(os.path.join(path, name) for path, _, names in
+                          os.walk('examples/.trash') for name in names)
+
+        twintrimmer.walk_path('examples', **self.options)
+        first_run = quarantined()
+        twintrimmer.walk_path('examples', **self.options)
+        self.assertEqual(first_run, quarantined())
+
+    def test_purge_deletes_oldest_run_first(self):
+        self.fs.CreateFile('trash/20240102T000000/a/new.txt', contents='new')
+        self.fs.CreateFile('trash/20240101T000000/b/old.txt', contents='old')
+        with self.assertLogs('twintrimmer', 'INFO') as logs:
+            purged = twintrimmer.twintrimmer.purge_quarantine('trash')
+        deleted = [line for line in logs.output if 'was deleted' in line]
+        self.assertIn('old.txt', deleted[0])
+        self.assertIn('new.txt', deleted[1])
+        self.assertEqual(6, purged)
+        self.assertEqual([], os.listdir('trash'))
+
+    def test_purge_skips_what_is_not_a_run(self):
+        self.fs.CreateFile('home/projects/src/main.py', contents='main')
+        self.fs.CreateFile('home/notes.txt', contents='notes')
+        with self.assertLogs('twintrimmer', 'WARNING') as logs:
+            purged = twintrimmer.twintrimmer.purge_quarantine('home')
+        self.assertEqual(0, purged)
+        self.assertTrue(os.path.exists('home/projects/src/main.py'))
+        self.assertTrue(os.path.exists('home/notes.txt'))
+        self.assertEqual(2, len(logs.output))
+
+    @patch('time.sleep')
+    def test_purge_is_rate_limited(self, mock_sleep):
+        self.fs.CreateFile('trash/20240101T000000/a.txt', contents='a' * 100)
+        self.fs.CreateFile('trash/20240101T000000/b.txt', contents='b' * 100)
+        twintrimmer.twintrimmer.purge_quarantine('trash', purge_rate=10)
+        self.assertEqual(2, mock_sleep.call_count)
+        self.assertGreater(mock_sleep.call_args[0][0], 10)
+
+    def test_purge_no_action_keeps_files(self):
+        self.fs.CreateFile('trash/20240101T000000/a.txt', contents='a')
+        with patch('builtins.print') as mock_print:
+            twintrimmer.twintrimmer.purge_quarantine('trash', no_action=True)
+        self.assertTrue(os.path.exists('trash/20240101T000000/a.txt'))
+        self.assertEqual(1, mock_print.call_count)
+
+
+class TestRemoveByTree(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.root = self.tempdir.name
+        for tree in ('project', 'project (copy)'):
+            self.write(tree + '/a.txt', 'a\n')
+            self.write(tree + '/src/b.txt', 'b\n')
+            self.write(tree + '/src/c.txt', 'b\n')
+        self.write('renamed/z.txt', 'a\n')
+        self.write('renamed/src/b.txt', 'b\n')
+        self.write('renamed/src/c.txt', 'c\n')
+        os.makedirs(os.path.join(self.root, 'empty'))
+        os.makedirs(os.path.join(self.root, 'empty (copy)'))
+        self.options = dict(hash_function='md5',
+                            skip_regex=True,
+                            recursive=True,
+                            trees=True)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, name, contents):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(contents)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.root, name))
+
+    def test_removes_copied_tree_as_a_whole(self):
+        twintrimmer.walk_path(self.root, **self.options)
+        self.assertFalse(self.exists('project (copy)'))
+        self.assertTrue(self.exists('project/a.txt'))
+        self.assertNotEqual(self.exists('project/src/b.txt'),
+                            self.exists('project/src/c.txt'))
+        self.assertTrue(self.exists('renamed/z.txt'))
+        self.assertTrue(self.exists('renamed/src/c.txt'))
+        self.assertTrue(self.exists('empty (copy)'))
+
+    def test_no_action_reports_copied_tree(self):
+        with patch('sys.stdout', new=StringIO()) as output:
+            twintrimmer.walk_path(self.root, no_action=True, **self.options)
+        self.assertTrue(self.exists('project (copy)'))
+        self.assertIn('project (copy) would have been deleted',
+                      output.getvalue())
+        self.assertNotIn('project (copy)/a.txt', output.getvalue())
+
+    def test_tree_holding_unhashed_file_is_not_hashed(self):
+        digest = hashlib.md5(b'a\n').digest()
+        file_digests = {os.path.join(self.root, 'project', 'a.txt'): digest}
+        trees = twintrimmer.twintrimmer.hash_trees(self.root, file_digests,
+                                                   'md5')
+        self.assertIsNone(trees[os.path.join(self.root, 'project')][0])
+        self.assertIsNone(trees[self.root][0])
+        self.assertEqual(trees[os.path.join(self.root, 'empty')][1], 0)
+        self.assertEqual(trees[os.path.join(self.root, 'empty')][0],
+                         trees[os.path.join(self.root, 'empty (copy)')][0])
+
+    def test_symlinked_directory_is_not_hashed(self):
+        os.symlink(os.path.join(self.root, 'empty'),
+                   os.path.join(self.root, 'project', 'link'))
+        twintrimmer.walk_path(self.root, **self.options)
+        self.assertTrue(self.exists('project (copy)/a.txt'))
+
+    def test_symlinked_file_is_not_hashed(self):
+        self.write('linked/d.txt', 'd\n')
+        os.makedirs(os.path.join(self.root, 'links'))
+        os.symlink(os.path.join('..', 'linked', 'd.txt'),
+                   os.path.join(self.root, 'links', 'd.txt'))
+        twintrimmer.walk_path(self.root, **self.options)
+        self.assertTrue(self.exists('linked/d.txt'))
+        self.assertTrue(self.exists('links/d.txt'))
+
+    def test_tree_holding_removed_tree_keeps_a_copy(self):
+        trees = ('nested/aa/x', 'nested/bb/x', 'nested/x')
+        for tree in trees:
+            self.write(tree + '/f.txt', 'f\n')
+        twintrimmer.walk_path(os.path.join(self.root, 'nested'),
+                              **self.options)
+        self.assertEqual(1, sum(self.exists(tree + '/f.txt')
+                                for tree in trees))
+
+    def test_tree_holding_removed_tree_is_not_compared(self):
+        trees = ('nested/aa/x', 'nested/bb/x', 'nested/x')
+        for tree in trees:
+            self.write(tree + '/f.txt', 'f\n')
+        with patch('sys.stdout', new=StringIO()) as output:
+            twintrimmer.walk_path(os.path.join(self.root, 'nested'),
+                                  no_action=True, **self.options)
+        deleted = [line.split(' would have')[0]
+                   for line in output.getvalue().splitlines()]
+        kept = [tree for tree in trees if not any(
+            os.path.join(self.root, tree).startswith(path + os.sep) or
+            os.path.join(self.root, tree) == path for path in deleted)]
+        self.assertEqual(1, len(kept))
+
+    @patch('shutil.rmtree')
+    def test_deletion_errors_are_logged(self, mock_rmtree):
+        mock_rmtree.side_effect = PermissionError
+        with self.assertLogs('twintrimmer', 'ERROR'):
+            twintrimmer.walk_path(self.root, **self.options)
+        self.assertTrue(self.exists('project (copy)/a.txt'))
+
+
+class TestBloomFilter(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tempdir.name, 'library.bloom')
+        self.keys = [hashlib.md5(str(num).encode()).digest()
+                     for num in range(2000)]
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def test_finds_every_written_key(self):
+        twintrimmer.twintrimmer.BloomFilter.write(self.path, self.keys)
+        bloom = twintrimmer.twintrimmer.BloomFilter(self.path)
+        self.assertEqual(bloom.count, 2000)
+        for key in self.keys:
+            self.assertIn(key, bloom)
+        bloom.close()
+
+    def test_false_positive_rate_follows_size(self):
+        missing = [hashlib.sha1(str(num).encode()).digest()
+                   for num in range(10000)]
+        for error_rate in (0.1, 0.01):
+            bits = twintrimmer.twintrimmer.BloomFilter.write(
+                self.path, self.keys, error_rate)
+            self.assertLess(bits, 2000 * 10 * -math.log10(error_rate))
+            bloom = twintrimmer.twintrimmer.BloomFilter(self.path)
+            false_positives = sum(key in bloom for key in missing)
+            bloom.close()
+            self.assertLess(false_positives / len(missing), error_rate * 2)
+
+    def test_empty_filter_finds_nothing(self):
+        twintrimmer.twintrimmer.BloomFilter.write(self.path, [])
+        bloom = twintrimmer.twintrimmer.BloomFilter(self.path)
+        self.assertNotIn(self.keys[0], bloom)
+
+    def test_rejects_other_files(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'x' * 64)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.BloomFilter(self.path)
+
+    def test_rejects_truncated_filter(self):
+        twintrimmer.twintrimmer.BloomFilter.write(self.path, self.keys)
+        with open(self.path, 'r+b') as file:
+            file.truncate(100)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.BloomFilter(self.path)
+        with open(self.path, 'r+b') as file:
+            file.truncate(10)
+        with self.assertRaises(ValueError):
+            twintrimmer.twintrimmer.BloomFilter(self.path)
+
+    def test_key_holds_size_and_start_of_file(self):
+        with open(self.path, 'wb') as file:
+            file.write(b'a' * 5000)
+        key = twintrimmer.twintrimmer.BloomFilter.make_key(self.path)
+        self.assertEqual(key[:8], struct.pack('<Q', 5000))
+        self.assertEqual(key[8:], hashlib.md5(b'a' * 4096).digest())
+
+
+class TestReferenceWalkPath(unittest.TestCase):
+    def setUp(self):
+        self.tempdir = tempfile.TemporaryDirectory()
+        self.library = os.path.join(self.tempdir.name, 'library')
+        self.incoming = os.path.join(self.tempdir.name, 'incoming')
+        self.index = os.path.join(self.tempdir.name, 'library.idx')
+        self.write('library/old.txt', 'old\n')
+        self.write('library/deep/older.txt', 'older\n')
+        self.write('incoming/copy of old.txt', 'old\n')
+        self.write('incoming/older.txt', 'older\n')
+        self.write('incoming/new.txt', 'new\n')
+        self.write('incoming/new (1).txt', 'new\n')
+        self.options = dict(hash_function='md5',
+                            skip_regex=True,
+                            recursive=True,
+                            remove_links=True)
+
+    def tearDown(self):
+        self.tempdir.cleanup()
+
+    def write(self, name, contents):
+        path = os.path.join(self.tempdir.name, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(contents)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.incoming, name))
+
+    def test_removes_files_found_in_reference(self):
+        twintrimmer.twintrimmer.build_reference(
+            self.library, build_reference=self.index, **self.options)
+        self.assertTrue(os.path.exists(os.path.join(self.library, 'old.txt')))
+        twintrimmer.walk_path(self.incoming, reference=self.index,
+                              **self.options)
+        self.assertFalse(self.exists('copy of old.txt'))
+        self.assertFalse(self.exists('older.txt'))
+        self.assertTrue(self.exists('new.txt'))
+        self.assertFalse(self.exists('new (1).txt'))
+
+    def test_no_action_keeps_files_found_in_reference(self):
+        twintrimmer.twintrimmer.build_reference(
+            self.library, build_reference=self.index, async_io=True,
+            **self.options)
+        with patch('sys.stdout', new=StringIO()) as output:
+            twintrimmer.walk_path(self.incoming, reference=self.index,
+                                  no_action=True, **self.options)
+        self.assertTrue(self.exists('copy of old.txt'))
+        self.assertIn('copy of old.txt would have been deleted',
+                      output.getvalue())
+
+    def test_reference_uses_first_of_several_hash_functions(self):
+        options = dict(self.options, hash_function='md5,sha256')
+        twintrimmer.twintrimmer.build_reference(
+            self.library, build_reference=self.index, **options)
+        index = twintrimmer.twintrimmer.ReferenceIndex(self.index)
+        self.assertEqual(index.hash_name, 'md5')
+        index.close()
+        kept = twintrimmer.walk_path(self.incoming, reference=self.index,
+                                     **options)
+        self.assertFalse(self.exists('copy of old.txt'))
+        self.assertIn((self.incoming,
+                       hashlib.md5(b'new\n').hexdigest(),
+                       hashlib.sha256(b'new\n').hexdigest()), kept)
+
+    def test_saved_scan_index_works_as_reference(self):
+        scan = os.path.join(self.tempdir.name, 'library.scan')
+        twintrimmer.walk_path(self.library, save_index=scan,
+                              no_action=True, **self.options)
+        index = twintrimmer.twintrimmer.ScanIndex(scan)
+        self.assertEqual(sorted(os.path.relpath(record.path, self.library)
+                                for record in index),
+                         ['deep/older.txt', 'old.txt'])
+        index.close()
+        twintrimmer.walk_path(self.incoming, reference=scan, **self.options)
+        self.assertFalse(self.exists('copy of old.txt'))
+        self.assertTrue(self.exists('new.txt'))
+
+    def test_bloom_filter_skips_hashing_new_files(self):
+        self.write('incoming/alone/newest.txt', 'newest\n')
+        bloom = os.path.join(self.tempdir.name, 'library.bloom')
+        twintrimmer.twintrimmer.build_reference(
+            self.library, build_reference=self.index, **self.options)
+        twintrimmer.twintrimmer.build_bloom(self.library, build_bloom=bloom,
+                                            **self.options)
+        with self.assertLogs('twintrimmer', 'DEBUG') as logs:
+            twintrimmer.walk_path(self.incoming, reference=self.index,
+                                  bloom=bloom, **self.options)
+        self.assertIn('alone/newest.txt is not in bloom filter',
+                      '\n'.join(logs.output))
+        self.assertTrue(self.exists('alone/newest.txt'))
+        self.assertFalse(self.exists('copy of old.txt'))
+        self.assertTrue(self.exists('new.txt'))
+
+    @patch('os.remove')
+    def test_deletion_errors_are_logged(self, mock_remove):
+        mock_remove.side_effect = PermissionError
+        twintrimmer.twintrimmer.build_reference(
+            self.library, build_reference=self.index, **self.options)
+        twintrimmer.walk_path(self.incoming, reference=self.index,
+                              **self.options)
+        self.assertTrue(self.exists('copy of old.txt'))
+
+
 class TestInteractivePicker(unittest.TestCase):
     def setUp(self):
         filenames = ['file.txt', 'file1.txt', 'file2.txt']
@@ -356,9 +1578,11 @@ class TestRemoveFilesForDeletion(unittest.TestCase):
         self.assertEqual(mock_remove.call_count, 1)
         mock_remove.assert_called_with('examples/foo (1).txt')
 
+    @patch('os.replace')
     @patch('os.link')
     @patch('os.remove')
-    def test_makes_hardlink_after_deletion(self, mock_remove, mock_link):
+    def test_replaces_duplicate_with_hardlink(self, mock_remove, mock_link,
+                                              mock_replace):
         bad = twintrimmer.Filename(None, None, None, 'examples/foo (2).txt')
         best = twintrimmer.Filename(None, None, None, 'examples/foo.txt')
         twintrimmer.remove_file(
@@ -367,9 +1591,203 @@ class TestRemoveFilesForDeletion(unittest.TestCase):
             remove_links=True,
             make_links=True,
             no_action=False)
-        self.assertEqual(mock_remove.call_count, 1)
-        mock_link.assert_called_with('examples/foo.txt',
-                                     'examples/foo (2).txt')
+        self.assertEqual(mock_remove.call_count, 0)
+        source, temp_path = mock_link.call_args[0]
+        self.assertEqual(source, 'examples/foo.txt')
+        self.assertEqual(os.path.dirname(temp_path), 'examples')
+        mock_replace.assert_called_with(temp_path, 'examples/foo (2).txt')
+
+
+class TestReplaceWithLink(TestCaseWithFileSystem):
+    def setUp(self):
+        super(TestReplaceWithLink, self).setUp()
+        self.bad = twintrimmer.Filename(None, None, None,
+                                        'examples/foo (1).txt')
+        self.best = twintrimmer.Filename(None, None, None, 'examples/foo.txt')
+
+    def test_replaces_file_with_link(self):
+        twintrimmer.twintrimmer.replace_with_link(self.bad, self.best)
+        self.assertTrue(os.path.samefile(self.bad.path, self.best.path))
+        self.assertEqual(len(os.listdir('examples')), 11)
+
+    def test_existing_link_leaves_no_temporary_name(self):
+        os.remove(self.bad.path)
+        os.link(self.best.path, self.bad.path)
+        twintrimmer.twintrimmer.replace_with_link(self.bad, self.best)
+        self.assertTrue(os.path.samefile(self.bad.path, self.best.path))
+        self.assertEqual(len(os.listdir('examples')), 11)
+
+    @patch('os.link')
+    def test_keeps_file_when_link_fails(self, mock_link):
+        mock_link.side_effect = PermissionError
+        with self.assertRaises(PermissionError):
+            twintrimmer.twintrimmer.replace_with_link(self.bad, self.best)
+        self.assertTrue(os.path.exists(self.bad.path))
+        self.assertFalse(os.path.samefile(self.bad.path, self.best.path))
+
+    @patch('os.replace')
+    def test_removes_temporary_link_when_rename_fails(self, mock_replace):
+        mock_replace.side_effect = PermissionError
+        with self.assertRaises(PermissionError):
+            twintrimmer.twintrimmer.replace_with_link(self.bad, self.best)
+        self.assertTrue(os.path.exists(self.bad.path))
+        self.assertEqual(len(os.listdir('examples')), 11)
+
+
+class TestDirectoryHandles(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.paths = {}
+        for name in ('one/a.txt', 'one/b.txt', 'two/c.txt'):
+            path = os.path.join(self.directory.name, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as file:
+                file.write(name)
+            self.paths[name] = path
+        self.handles = twintrimmer.twintrimmer.DirectoryHandles()
+
+    def tearDown(self):
+        self.handles.close()
+        self.directory.cleanup()
+
+    def test_files_are_removed_by_name(self):
+        with patch('os.unlink', wraps=os.unlink) as mock_unlink:
+            self.handles.remove(self.paths['one/a.txt'])
+        self.assertFalse(os.path.exists(self.paths['one/a.txt']))
+        self.assertEqual('a.txt', mock_unlink.call_args[0][0])
+
+    def test_directory_is_opened_once(self):
+        with patch('os.open', wraps=os.open) as mock_open:
+            self.handles.stat(self.paths['one/a.txt'])
+            self.handles.stat(self.paths['one/b.txt'])
+        self.assertEqual(1, mock_open.call_count)
+
+    def test_link_and_replace_make_hard_link(self):
+        temp_path = os.path.join(self.directory.name, 'two', '.c.tmp')
+        self.handles.link(self.paths['one/a.txt'], temp_path)
+        self.handles.replace(temp_path, self.paths['two/c.txt'])
+        self.assertTrue(self.handles.samefile(self.paths['one/a.txt'],
+                                              self.paths['two/c.txt']))
+        self.assertFalse(self.handles.samefile(self.paths['one/a.txt'],
+                                               self.paths['one/b.txt']))
+        self.assertFalse(os.path.exists(temp_path))
+
+    def test_least_recently_used_directory_is_closed(self):
+        self.handles.limit = 1
+        self.handles.stat(self.paths['one/a.txt'])
+        self.handles.stat(self.paths['two/c.txt'])
+        self.assertEqual([os.path.dirname(self.paths['two/c.txt'])],
+                         list(self.handles.fds))
+
+    def test_changed_directories_are_synced_once_when_closed(self):
+        self.handles.fsync = True
+        with patch('os.fsync') as mock_fsync:
+            self.handles.remove(self.paths['one/a.txt'])
+            self.handles.remove(self.paths['one/b.txt'])
+            self.handles.stat(self.paths['two/c.txt'])
+            self.handles.close()
+        self.assertEqual(1, mock_fsync.call_count)
+        self.assertEqual({}, dict(self.handles.fds))
+
+    def test_remove_file_uses_directory_handles(self):
+        bad = twintrimmer.Filename('b.txt', 'b', '.txt',
+                                   self.paths['one/b.txt'])
+        best = twintrimmer.Filename('a.txt', 'a', '.txt',
+                                    self.paths['one/a.txt'])
+        twintrimmer.remove_file(bad, best, self.handles, make_links=True)
+        self.assertTrue(os.path.samefile(bad.path, best.path))
+        self.assertEqual(['a.txt', 'b.txt'], sorted(os.listdir(
+            os.path.dirname(bad.path))))
+
+
+def fake_dedupe_range(status, max_length=None):
+    '''
+    Build a side effect for fcntl.ioctl that fills in a dedupe reply
+    '''
+    header = twintrimmer.twintrimmer.DEDUPE_RANGE
+    info = twintrimmer.twintrimmer.DEDUPE_RANGE_INFO
+
+    def ioctl(_, request, buf):
+        assert request == twintrimmer.twintrimmer.FIDEDUPERANGE
+        _, length, count, _, _ = header.unpack_from(buf, 0)
+        assert count == 1
+        if max_length is not None:
+            length = min(length, max_length)
+        fd, offset, _, _, _ = info.unpack_from(buf, header.size)
+        info.pack_into(buf, header.size, fd, offset,
+                       length if status == 0 else 0, status, 0)
+        return 0
+    return ioctl
+
+
+class TestReflinkFile(TestCaseWithFileSystem):
+    def setUp(self):
+        super(TestReflinkFile, self).setUp()
+        self.bad = twintrimmer.Filename(None, None, None,
+                                        'examples/foo (1).txt')
+        self.best = twintrimmer.Filename(None, None, None, 'examples/foo.txt')
+
+    @patch('fcntl.ioctl')
+    def test_shares_extents_of_whole_file(self, mock_ioctl):
+        mock_ioctl.side_effect = fake_dedupe_range(0, max_length=3)
+        twintrimmer.twintrimmer.reflink_file(self.bad, self.best)
+        self.assertEqual(mock_ioctl.call_count, 2)
+        self.assertTrue(os.path.exists(self.bad.path))
+
+    @patch('fcntl.ioctl')
+    def test_opens_both_files_read_only(self, mock_ioctl):
+        mock_ioctl.side_effect = fake_dedupe_range(0)
+        with patch('builtins.open', wraps=open) as mock_open:
+            twintrimmer.twintrimmer.reflink_file(self.bad, self.best)
+        self.assertEqual(['rb', 'rb'],
+                         [call[0][1] for call in mock_open.call_args_list])
+
+    @patch('fcntl.ioctl')
+    def test_raises_when_contents_differ(self, mock_ioctl):
+        mock_ioctl.side_effect = fake_dedupe_range(1)
+        with self.assertRaises(OSError):
+            twintrimmer.twintrimmer.reflink_file(self.bad, self.best)
+
+    @patch('fcntl.ioctl')
+    def test_raises_error_reported_for_destination(self, mock_ioctl):
+        mock_ioctl.side_effect = fake_dedupe_range(-errno.EPERM)
+        with self.assertRaises(PermissionError):
+            twintrimmer.twintrimmer.reflink_file(self.bad, self.best)
+
+    @patch('fcntl.ioctl')
+    def test_raises_when_nothing_was_shared(self, mock_ioctl):
+        mock_ioctl.side_effect = fake_dedupe_range(0, max_length=0)
+        with self.assertRaises(OSError):
+            twintrimmer.twintrimmer.reflink_file(self.bad, self.best)
+
+    @patch('fcntl.ioctl')
+    def test_raises_when_sizes_differ(self, mock_ioctl):
+        bad = twintrimmer.Filename(None, None, None, 'examples/foo (3).txt')
+        with self.assertRaises(OSError):
+            twintrimmer.twintrimmer.reflink_file(bad, self.best)
+        self.assertEqual(mock_ioctl.call_count, 0)
+
+    @patch('twintrimmer.twintrimmer.reflink_file')
+    def test_remove_file_reflinks_rather_than_removing(self, mock_reflink):
+        twintrimmer.remove_file(self.bad, self.best, remove_links=True,
+                                no_action=False, reflink=True)
+        mock_reflink.assert_called_with(self.bad, self.best)
+        self.assertTrue(os.path.exists(self.bad.path))
+
+    @patch('twintrimmer.twintrimmer.reflink_file')
+    def test_remove_file_keeps_file_when_reflink_unsupported(self,
+                                                             mock_reflink):
+        mock_reflink.side_effect = OSError(errno.EOPNOTSUPP, 'unsupported')
+        twintrimmer.remove_file(self.bad, self.best, remove_links=True,
+                                no_action=False, reflink=True)
+        self.assertTrue(os.path.exists(self.bad.path))
+
+    @patch('twintrimmer.twintrimmer.reflink_file')
+    def test_remove_file_raises_other_reflink_errors(self, mock_reflink):
+        mock_reflink.side_effect = PermissionError(errno.EPERM, 'denied')
+        with self.assertRaises(PermissionError):
+            twintrimmer.remove_file(self.bad, self.best, remove_links=True,
+                                    no_action=False, reflink=True)
 
 
 class TestWalkPath(TestCaseWithFileSystem):
@@ -619,6 +2037,112 @@ class TestWalkPathIntegration(TestCaseWithFileSystem):
         self.assertFalse(os.path.exists('examples/foo (1).txt'))
         self.assertFalse(os.path.exists('examples/recur/file (2).txt'))
 
+    def test_traverses_directories_recursively_with_async_io(self):
+        twintrimmer.walk_path('examples',
+                              hash_function='md5',
+                              no_action=False,
+                              skip_regex=False,
+                              recursive=True,
+                              async_io=True,
+                              concurrency=4,
+                              regex_pattern=r'(^.+?)(?: \(\d\))*(\..+)',
+                              remove_links=True)
+        self.assertTrue(os.path.exists('examples/foo.txt'))
+        self.assertFalse(os.path.exists('examples/foo (1).txt'))
+        self.assertFalse(os.path.exists('examples/recur/file (2).txt'))
+
+    def test_traverses_several_paths(self):
+        twintrimmer.walk_path(['examples/recur', 'examples/underscore'],
+                              hash_function='md5',
+                              no_action=False,
+                              skip_regex=True,
+                              recursive=False,
+                              remove_links=True)
+        self.assertTrue(os.path.exists('examples/foo (1).txt'))
+        self.assertTrue(os.path.exists('examples/recur/file.txt'))
+        self.assertFalse(os.path.exists('examples/recur/file (2).txt'))
+        self.assertTrue(os.path.exists('examples/underscore/file.txt'))
+        self.assertFalse(os.path.exists('examples/underscore/file__1.txt'))
+
+    def test_files_without_duplicate_candidate_are_not_hashed(self):
+        with patch.object(twintrimmer.twintrimmer.HashClumper,
+                          'read_checksum', autospec=True,
+                          side_effect=lambda self, filename: (
+                              filename.name, )) as mock_read:
+            twintrimmer.walk_path('examples',
+                                  hash_function='md5',
+                                  no_action=True,
+                                  skip_regex=False,
+                                  recursive=True,
+                                  regex_pattern=r'(^.+?)(?: \(\d\))*(\..+)',
+                                  remove_links=True)
+        hashed = {call[0][1].name for call in mock_read.call_args_list}
+        self.assertNotIn('baz.text', hashed)
+        self.assertNotIn('foo (3).txt', hashed)
+        self.assertIn('foo.txt', hashed)
+
+    def test_pipeline_without_size_stage_hashes_every_candidate(self):
+        with patch.object(twintrimmer.twintrimmer.HashClumper,
+                          'read_checksum', autospec=True,
+                          side_effect=lambda self, filename: (
+                              filename.name, )) as mock_read:
+            twintrimmer.walk_path('examples',
+                                  hash_function='md5',
+                                  no_action=True,
+                                  skip_regex=False,
+                                  pipeline=['regex'],
+                                  recursive=True,
+                                  regex_pattern=r'(^.+?)(?: \(\d\))*(\..+)',
+                                  remove_links=True)
+        hashed = {call[0][1].name for call in mock_read.call_args_list}
+        self.assertIn('foo (3).txt', hashed)
+
+    def test_stats_prints_every_stage(self):
+        with patch('builtins.print') as mock_print:
+            twintrimmer.walk_path('examples',
+                                  hash_function='md5',
+                                  no_action=True,
+                                  skip_regex=True,
+                                  pipeline=['size', 'partial'],
+                                  stats=True,
+                                  recursive=True,
+                                  regex_pattern='',
+                                  remove_links=True)
+        lines = [call[0][0] for call in mock_print.call_args_list]
+        self.assertEqual(['stage', 'size', 'partial', 'hash'],
+                         [line.split()[0] for line in lines[:4]])
+
+    def test_checkpoint_is_removed_after_run(self):
+        self.fs.CreateFile('progress.json', contents='{}')
+        twintrimmer.walk_path('examples',
+                              hash_function='md5',
+                              no_action=False,
+                              skip_regex=False,
+                              recursive=True,
+                              checkpoint='progress.json',
+                              resume=True,
+                              regex_pattern=r'(^.+?)(?: \(\d\))*(\..+)',
+                              remove_links=True)
+        self.assertFalse(os.path.exists('examples/foo (1).txt'))
+        self.assertFalse(os.path.exists('progress.json'))
+
+    @patch('twintrimmer.twintrimmer.remove_by_clump')
+    @patch('twintrimmer.twintrimmer.HashClumper.read_checksum')
+    def test_checkpoint_is_saved_when_interrupted(self, mock_read,
+                                                  mock_remove):
+        mock_read.side_effect = KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            twintrimmer.walk_path('examples',
+                                  hash_function='md5',
+                                  skip_regex=True,
+                                  recursive=True,
+                                  checkpoint='progress.json')
+        self.assertEqual(mock_remove.call_count, 0)
+        checkpoint = twintrimmer.twintrimmer.Checkpoint('progress.json',
+                                                        'md5')
+        checkpoint.load()
+        self.assertEqual(len(checkpoint.directories), 3)
+
     def test_can_not_sum_hash_due_to_OSError(self):
         os.chmod('examples/recur/file.txt', 0o000)
         twintrimmer.walk_path('examples/recur',
@@ -646,6 +2170,224 @@ class TestWalkPathIntegration(TestCaseWithFileSystem):
         self.assertTrue(os.path.exists('examples/recur/file (2).txt'))
 
 
+class TestInotifyWatcher(unittest.TestCase):
+    def test_parse_events_splits_buffer(self):
+        watcher = twintrimmer.twintrimmer.InotifyWatcher
+        data = (watcher.EVENT.pack(1, watcher.IN_CLOSE_WRITE, 0, 16) +
+                b'foo (1).txt\0\0\0\0\0' +
+                watcher.EVENT.pack(2, watcher.IN_MOVED_TO, 7, 0))
+        self.assertEqual(watcher.parse_events(data),
+                         [(1, watcher.IN_CLOSE_WRITE, 'foo (1).txt'),
+                          (2, watcher.IN_MOVED_TO, '')])
+
+    def test_parse_events_handles_empty_buffer(self):
+        watcher = twintrimmer.twintrimmer.InotifyWatcher
+        self.assertEqual(watcher.parse_events(b''), [])
+
+    def test_pruned_directories_are_not_watched(self):
+        with tempfile.TemporaryDirectory() as root:
+            for name in ('keep/deep', 'skip/deep'):
+                os.makedirs(os.path.join(root, name))
+            watcher = twintrimmer.twintrimmer.InotifyWatcher(
+                root, True, twintrimmer.twintrimmer.WalkFilter(['skip']))
+            try:
+                watched = sorted(os.path.relpath(path, root)
+                                 for path in watcher.watches.values())
+                found = watcher.watch_new_directory(root)
+            finally:
+                watcher.close()
+        self.assertEqual(['.', 'keep', 'keep/deep'], watched)
+        self.assertEqual([], found)
+
+
+    def test_events_of_new_files_and_directories(self):
+        with tempfile.TemporaryDirectory() as root:
+            os.makedirs(os.path.join(root, 'gone'))
+            watcher = twintrimmer.twintrimmer.InotifyWatcher(root, True)
+            try:
+                events = watcher.events()
+                with open(os.path.join(root, 'a.txt'), 'w') as file:
+                    file.write('a')
+                self.assertEqual(os.path.join(root, 'a.txt'), next(events))
+
+                os.makedirs(os.path.join(root, 'new'))
+                with open(os.path.join(root, 'new', 'b.txt'), 'w') as file:
+                    file.write('b')
+                self.assertEqual(os.path.join(root, 'new', 'b.txt'),
+                                 next(events))
+
+                os.rmdir(os.path.join(root, 'gone'))
+                with open(os.path.join(root, 'new', 'c.txt'), 'w') as file:
+                    file.write('c')
+                self.assertEqual(os.path.join(root, 'new', 'c.txt'),
+                                 next(events))
+                self.assertNotIn(os.path.join(root, 'gone'),
+                                 watcher.watches.values())
+            finally:
+                watcher.close()
+
+    def test_overflow_yields_a_scan_of_the_roots(self):
+        with tempfile.TemporaryDirectory() as root:
+            watcher = twintrimmer.twintrimmer.InotifyWatcher(root, True)
+            try:
+                os.makedirs(os.path.join(root, 'missed'))
+                wd = next(iter(watcher.watches))
+                data = [watcher.EVENT.pack(-1, watcher.IN_Q_OVERFLOW, 0, 0),
+                        watcher.EVENT.pack(wd + 100, watcher.IN_CLOSE_WRITE,
+                                           0, 0) +
+                        watcher.EVENT.pack(wd, watcher.IN_CLOSE_WRITE, 0, 0)]
+                with patch('os.read', side_effect=data):
+                    events = watcher.events()
+                    with self.assertLogs('twintrimmer', 'WARNING'):
+                        self.assertIsNone(next(events))
+                    self.assertEqual(os.path.join(root, ''), next(events))
+                self.assertIn(os.path.join(root, 'missed'),
+                              watcher.watches.values())
+            finally:
+                watcher.close()
+
+
+class FakeWatcher():
+    def __init__(self, test, files):
+        self.test = test
+        self.files = files
+        self.closed = False
+
+    def events(self):
+        for path, contents in self.files:
+            with open(path, 'w') as file:
+                file.write(contents)
+            yield path
+
+    def close(self):
+        self.closed = True
+
+
+class OverflowedWatcher(FakeWatcher):
+    def events(self):
+        for path, contents in self.files:
+            with open(path, 'w') as file:
+                file.write(contents)
+        yield None
+
+
+class InterruptedWatcher(FakeWatcher):
+    def events(self):
+        raise KeyboardInterrupt
+        yield  # pylint: disable=unreachable
+
+
+class TestWatchPath(TestCaseWithFileSystem):
+    def watch(self, files, watcher_class=FakeWatcher, **options):
+        watcher = watcher_class(self, files)
+        twintrimmer.twintrimmer.watch_path(
+            'examples',
+            watcher=watcher,
+            hash_function='md5',
+            no_action=False,
+            skip_regex=False,
+            recursive=False,
+            regex_pattern=r'(^.+?)(?: \(\d\))*(\..+)',
+            remove_links=True,
+            **options)
+        self.assertTrue(watcher.closed)
+
+    def test_trims_existing_files_before_watching(self):
+        self.watch([])
+        self.assertTrue(os.path.exists('examples/foo.txt'))
+        self.assertFalse(os.path.exists('examples/foo (1).txt'))
+
+    def test_removes_new_duplicate_file(self):
+        self.watch([('examples/foo (4).txt', 'foo\n')])
+        self.assertTrue(os.path.exists('examples/foo.txt'))
+        self.assertFalse(os.path.exists('examples/foo (4).txt'))
+
+    def test_lost_events_scan_the_path_again(self):
+        self.watch([('examples/foo (4).txt', 'foo\n')], OverflowedWatcher)
+        self.assertTrue(os.path.exists('examples/foo.txt'))
+        self.assertFalse(os.path.exists('examples/foo (4).txt'))
+
+    def test_keeps_new_file_with_different_content(self):
+        self.watch([('examples/foo (4).txt', 'different\n')])
+        self.assertTrue(os.path.exists('examples/foo (4).txt'))
+
+    def test_removes_duplicates_of_new_file(self):
+        self.watch([('examples/new.txt', 'new\n'),
+                    ('examples/new (1).txt', 'new\n')])
+        self.assertTrue(os.path.exists('examples/new.txt'))
+        self.assertFalse(os.path.exists('examples/new (1).txt'))
+
+    def test_new_file_replaces_longer_named_copy(self):
+        self.fs.RemoveObject('examples/baz.txt')
+        self.watch([('examples/baz.txt', 'foobar\n')])
+        self.assertTrue(os.path.exists('examples/baz.txt'))
+        self.assertFalse(os.path.exists('examples/baz (1).txt'))
+
+    def test_modified_file_is_not_matched_by_old_content(self):
+        self.watch([('examples/diff.txt', 'changed'),
+                    ('examples/diff (2).txt', 'foo')])
+        self.assertTrue(os.path.exists('examples/diff.txt'))
+        self.assertTrue(os.path.exists('examples/diff (2).txt'))
+
+    def test_excluded_new_file_is_skipped(self):
+        self.watch([('examples/foo (5).txt', 'foo\n')], exclude=['* (5).*'])
+        self.assertTrue(os.path.exists('examples/foo.txt'))
+        self.assertTrue(os.path.exists('examples/foo (5).txt'))
+
+    def test_stops_on_keyboard_interrupt(self):
+        watcher = InterruptedWatcher(self, [])
+        twintrimmer.twintrimmer.watch_path(
+            'examples',
+            watcher=watcher,
+            hash_function='md5',
+            no_action=True,
+            remove_links=False,
+            skip_regex=True,
+            recursive=False)
+        self.assertTrue(watcher.closed)
+
+
+class TestBatchLogging(unittest.TestCase):
+    def setUp(self):
+        self.stream = StringIO()
+        self.handler = twintrimmer.twintrimmer.BatchStreamHandler(
+            self.stream, capacity=3)
+        self.logger = logging.getLogger('twintrimmer.test')
+        self.logger.propagate = False
+        self.logger.setLevel(logging.INFO)
+
+    def tearDown(self):
+        self.logger.handlers = []
+
+    def test_records_are_written_when_flushed(self):
+        self.logger.addHandler(self.handler)
+        self.logger.info('first')
+        self.logger.info('second')
+        self.assertEqual('', self.stream.getvalue())
+        self.handler.flush()
+        self.assertEqual('first\nsecond\n', self.stream.getvalue())
+
+    def test_records_are_written_when_batch_is_full(self):
+        self.logger.addHandler(self.handler)
+        with patch.object(self.stream, 'write',
+                          wraps=self.stream.write) as mock_write:
+            for num in range(3):
+                self.logger.info('record %d', num)
+        self.assertEqual(1, mock_write.call_count)
+        self.assertEqual('record 0\nrecord 1\nrecord 2\n',
+                         self.stream.getvalue())
+
+    def test_listener_writes_queued_records_when_stopped(self):
+        queue_handler = logging.handlers.QueueHandler(queue.Queue())
+        listener = twintrimmer.twintrimmer.BatchQueueListener(
+            queue_handler.queue, self.handler)
+        self.logger.addHandler(queue_handler)
+        listener.start()
+        self.logger.info('queued')
+        listener.stop()
+        self.assertEqual('queued\n', self.stream.getvalue())
+
+
 class TestMain(TestCaseWithFileSystem):
     def setUp(self):
         super(TestMain, self).setUp()
@@ -657,63 +2399,67 @@ class TestMain(TestCaseWithFileSystem):
         super(TestMain, self).tearDown()
         sys.stdout, sys.stderr = self.old_out, self.old_err
 
+    @staticmethod
+    def expected_args(**changes):
+        args = dict(log_file=None,
+                    log_level=3,
+                    interactive=False,
+                    pipeline=None,
+                    stats=False,
+                    group_backend='python',
+                    hash_function='md5',
+                    tree_hash=None,
+                    chunk_cache=None,
+                    remove_links=False,
+                    verbosity=1,
+                    recursive=False,
+                    path=['.'],
+                    make_links=False,
+                    regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
+                    skip_regex=False,
+                    keep_oldest=False,
+                    no_action=False,
+                    reflink=False,
+                    fsync_dirs=False,
+                    quarantine=None,
+                    purge_quarantine=False,
+                    purge_rate=None,
+                    async_io=False,
+                    trees=False,
+                    concurrency=8,
+                    exclude=None,
+                    min_size=None,
+                    max_size=None,
+                    read_empty=False,
+                    reference=None,
+                    build_reference=None,
+                    save_index=None,
+                    bloom=None,
+                    build_bloom=None,
+                    checkpoint=None,
+                    resume=False,
+                    watch=False)
+        args.update(changes)
+        return args
+
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_default_args_pass_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args())
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_no_action_argument_passes_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['--no-action', '.'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=True)
+        mock_walk_path.assert_called_with(**self.expected_args(no_action=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_no_action_single_argument_passes_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['--n', '.'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=True)
+        mock_walk_path.assert_called_with(**self.expected_args(no_action=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
@@ -721,243 +2467,460 @@ class TestMain(TestCaseWithFileSystem):
     def test_log_file_argument_passes_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--log-file', 'file.log',
                                       '--log-level', '5'])
-        mock_walk_path.assert_called_with(
-            log_file='file.log',
-            log_level=5,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            log_file='file.log', log_level=5))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_log_file_is_written_when_main_returns(self, mock_walk_path):
+        mock_walk_path.side_effect = lambda **options: (
+            twintrimmer.twintrimmer.LOGGER.info('removing files'))
+        handlers = list(logging.getLogger('').handlers)
+        twintrimmer.twintrimmer.main(['.', '--log-file', 'file.log'])
+        with open('file.log') as log_file:
+            self.assertIn('INFO - removing files', log_file.read())
+        self.assertEqual(handlers, logging.getLogger('').handlers)
+
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_hash_fuction_argument_passes_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--hash-function', 'sha1'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='sha1',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            hash_function='sha1'))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_several_hash_functions_pass_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--hash-function', 'md5,sha256'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            hash_function='md5,sha256'))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_tree_hash_argument_passes_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--tree-hash', '1G'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            tree_hash=1024 ** 3))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_chunk_cache_without_tree_hash_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--chunk-cache', 'cache.json'])
+        self.assertIn('Chunk cache set without tree hash',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_empty_tree_hash_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--tree-hash', '0'])
+        self.assertIn('Tree hash size must be positive',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_tree_hash_with_reference_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--tree-hash', '1G',
+                                          '--build-reference', 'lib.idx'])
+        self.assertIn('Tree hash set while using reference index',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_pipeline_is_passed_without_hash_stage(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--pipeline', 'size,partial,hash',
+                                      '--stats', '-c'])
+        mock_walk_path.assert_called_with(
+            **self.expected_args(pipeline=['size', 'partial'], stats=True,
+                                 skip_regex=True))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_pipeline_without_regex_stage_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--pipeline', 'size,partial'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Regex stage left out without only checksum',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.numpy', None)
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_numpy_backend_without_numpy_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--group-backend', 'numpy'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Numpy backend set without numpy installed',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_fsync_dirs_argument_passes_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--fsync-dirs'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            fsync_dirs=True))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_fsync_dirs_while_taking_no_action_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '-n', '--fsync-dirs'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Fsync dirs set while taking no action',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_regex_stage_while_skipping_regex_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '-c', '--pipeline', 'regex'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Regex stage set while skipping regex',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_unknown_hash_function_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--hash-function', 'md5,md7'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('invalid hash function: md7', self.new_err.getvalue())
+
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_short_recursive_argument_passes_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '-r'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=True,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(recursive=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_long_recursive_argument_passes_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--recursive'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=True,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(recursive=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_make_links_argument_passes_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--make-links'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=True,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            make_links=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_remove_link_arg_pass_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--remove-links'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=True,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            remove_links=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_interactive_mode_passed_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--interactive'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=True,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            interactive=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_short_arg_interactive_passed_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '-i'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=True,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            interactive=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_keep_oldest_mode_passed_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--keep-oldest'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=False,
-            keep_oldest=True,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            keep_oldest=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_short_checksum_only_mode_passed_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '-c'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=True,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            skip_regex=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_long_checksum_only_mode_passed_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--only-checksum'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern='(^.+?)(?: \\(\\d\\))*(\\..+)$',
-            skip_regex=True,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            skip_regex=True))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_custom_regex_passed_correctly(self, mock_walk_path):
         twintrimmer.twintrimmer.main(['.', '--pattern', r'(^.+?)(?:\..+)$'])
-        mock_walk_path.assert_called_with(
-            log_file=None,
-            log_level=3,
-            interactive=False,
-            hash_function='md5',
-            remove_links=False,
-            verbosity=1,
-            recursive=False,
-            path='.',
-            make_links=False,
-            regex_pattern=r'(^.+?)(?:\..+)$',
-            skip_regex=False,
-            keep_oldest=False,
-            no_action=False)
+        mock_walk_path.assert_called_with(**self.expected_args(
+            regex_pattern=r'(^.+?)(?:\..+)$'))
         self.assertEqual(self.new_out.getvalue(), '')
         self.assertEqual(self.new_err.getvalue(), '')
 
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_async_io_arguments_pass_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--async-io', '--concurrency', '32'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            async_io=True, concurrency=32))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_reflink_argument_passes_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--reflink'])
+        mock_walk_path.assert_called_with(**self.expected_args(reflink=True))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_reflink_with_make_links_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--reflink', '--make-links'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Reflink set while making links',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_concurrency_without_async_io_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--concurrency', '4'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Concurrency set without async io',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_zero_concurrency_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--async-io',
+                                          '--concurrency', '0'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Concurrency must be at least 1',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_checkpoint_arguments_pass_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--checkpoint', 'progress.json',
+                                      '--resume'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            checkpoint='progress.json', resume=True))
+
+    @patch('twintrimmer.twintrimmer.ReferenceIndex')
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_reference_argument_passes_correctly(self, mock_walk_path,
+                                                 mock_index):
+        mock_index.return_value.hash_name = 'md5'
+        twintrimmer.twintrimmer.main(['.', '--reference', 'library.idx'])
+        mock_index.assert_called_with('library.idx')
+        mock_walk_path.assert_called_with(**self.expected_args(
+            reference='library.idx'))
+
+    @patch('twintrimmer.twintrimmer.ReferenceIndex')
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_reference_with_other_hash_function_fails(self, mock_walk_path,
+                                                      mock_index):
+        mock_index.return_value.hash_name = 'sha1'
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--reference', 'library.idx'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Reference index uses hash function "sha1"',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_invalid_reference_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--reference',
+                                          'examples/foo.txt'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Invalid reference index', self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_reference_while_making_links_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--reference', 'library.idx',
+                                          '--make-links'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Reference set while making links',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.build_reference')
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_build_reference_argument_builds_index(self, mock_walk_path,
+                                                   mock_build):
+        twintrimmer.twintrimmer.main(['.', '--build-reference', 'lib.idx'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        mock_build.assert_called_with(**self.expected_args(
+            build_reference='lib.idx'))
+
+    @patch('twintrimmer.twintrimmer.BloomFilter')
+    @patch('twintrimmer.twintrimmer.ReferenceIndex')
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_bloom_argument_passes_correctly(self, mock_walk_path,
+                                             mock_index, mock_bloom):
+        mock_index.return_value.hash_name = 'md5'
+        twintrimmer.twintrimmer.main(['.', '--reference', 'library.idx',
+                                      '--bloom', 'library.bloom'])
+        mock_bloom.assert_called_with('library.bloom')
+        mock_walk_path.assert_called_with(**self.expected_args(
+            reference='library.idx', bloom='library.bloom'))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_bloom_without_reference_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--bloom', 'library.bloom'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Bloom filter set without reference',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.ReferenceIndex')
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_invalid_bloom_filter_fails(self, mock_walk_path, mock_index):
+        mock_index.return_value.hash_name = 'md5'
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--reference', 'library.idx',
+                                          '--bloom', 'examples/foo.txt'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Invalid bloom filter', self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.build_bloom')
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_build_bloom_argument_builds_filter(self, mock_walk_path,
+                                                mock_build):
+        twintrimmer.twintrimmer.main(['.', '--build-bloom', 'lib.bloom'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        mock_build.assert_called_with(**self.expected_args(
+            build_bloom='lib.bloom'))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_build_bloom_while_watching_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--build-bloom', 'lib.bloom',
+                                          '--watch'])
+        self.assertIn('Building bloom filter while building reference or '
+                      'watching', self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_save_index_argument_passes_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--save-index', 'scan.idx'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            save_index='scan.idx'))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_walk_filter_arguments_pass_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--exclude', '.git', '--exclude',
+                                      '*.o', '--min-size', '4K',
+                                      '--max-size', '1M'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            exclude=['.git', '*.o'], min_size=4096, max_size=1024 ** 2))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_min_size_above_max_size_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--min-size', '2M',
+                                          '--max-size', '1M'])
+        self.assertIn('Minimum size larger than maximum size',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_read_empty_argument_passes_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--read-empty'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            read_empty=True))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_quarantine_argument_passes_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--quarantine', 'trash'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            quarantine='trash'))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    @patch('twintrimmer.twintrimmer.purge_quarantine')
+    def test_purge_quarantine_purges_paths(self, mock_purge, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '--purge-quarantine',
+                                      '--purge-rate', '10M'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        mock_purge.assert_called_with(**self.expected_args(
+            purge_quarantine=True, purge_rate=10 * 1024 ** 2))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_quarantine_while_making_links_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--quarantine', 'trash',
+                                          '--make-links'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Quarantine set while making links',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_purge_rate_without_purging_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--purge-rate', '10M'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Purge rate set without purging quarantine',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_trees_argument_passes_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['.', '-r', '--trees'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            recursive=True, trees=True))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_trees_without_recursive_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--trees'])
+        self.assertIn('Trees set without recursive', self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_trees_while_making_links_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '-r', '--trees',
+                                          '--make-links'])
+        self.assertIn('Trees set while making links',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_resume_without_checkpoint_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--resume'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('Resume set without checkpoint file',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.watch_path')
+    def test_checkpoint_while_watching_fails(self, mock_watch_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['.', '--watch', '--checkpoint',
+                                          'progress.json'])
+        self.assertEqual(mock_watch_path.call_count, 0)
+        self.assertIn('Checkpoint set while watching',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.watch_path')
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_watch_argument_starts_watching(self, mock_walk_path,
+                                            mock_watch_path):
+        with patch('sys.platform', 'linux'):
+            twintrimmer.twintrimmer.main(['.', '--watch'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        mock_watch_path.assert_called_with(**self.expected_args(watch=True))
+
+    @patch('twintrimmer.twintrimmer.watch_path')
+    def test_watch_argument_fails_without_linux(self, mock_watch_path):
+        with patch('sys.platform', 'darwin'):
+            with self.assertRaises(SystemExit):
+                twintrimmer.twintrimmer.main(['.', '--watch'])
+        self.assertEqual(mock_watch_path.call_count, 0)
+        self.assertIn('Watching for new files requires linux',
+                      self.new_err.getvalue())
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_several_paths_pass_correctly(self, mock_walk_path):
+        twintrimmer.twintrimmer.main(['examples', 'examples/recur'])
+        mock_walk_path.assert_called_with(**self.expected_args(
+            path=['examples', 'examples/recur']))
+
+    @patch('twintrimmer.twintrimmer.walk_path')
+    def test_one_bad_path_of_several_fails(self, mock_walk_path):
+        with self.assertRaises(SystemExit):
+            twintrimmer.twintrimmer.main(['examples', '/does/not/exist/'])
+        self.assertEqual(mock_walk_path.call_count, 0)
+        self.assertIn('path was not a directory', self.new_err.getvalue())
+
     @patch('twintrimmer.twintrimmer.walk_path')
     def test_no_args_fails(self, mock_walk_path):
         with self.assertRaises(SystemExit):
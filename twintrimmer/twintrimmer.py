@@ -3,14 +3,37 @@
 tool for removing duplicate files
 '''
 import argparse
+import asyncio
+import concurrent.futures
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import fnmatch
 import functools
 import hashlib
+import itertools
+import json
 import logging
+import logging.handlers
+import math
+import mmap
 import os
+import queue
 import re
+import shutil
+import struct
 import sys
 import textwrap
-from collections import defaultdict, namedtuple
+import threading
+import time
+import uuid
+from collections import OrderedDict, defaultdict, namedtuple
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 __author__ = 'Paul Schwendenman'
 __email__ = 'schwendenman.paul+twintrim@gmail.com'
@@ -30,14 +53,194 @@ class ClumperError(Exception):
     pass
 
 
+def list_root_paths(root_path):
+    '''
+    Return a list of root paths from either a single path or several
+
+    :param root_path: one path or an iterable of paths
+    :type root_path: str or iterable[str]
+    :rtype: list[str]
+    '''
+    if isinstance(root_path, str):
+        return [root_path]
+    return list(root_path)
+
+
+def list_hash_names(hash_function):
+    '''
+    Return a list of hash function names from either a comma separated
+    string or several names
+
+    :param hash_function: one or more names, separated by commas
+    :type hash_function: str or iterable[str]
+    :rtype: list[str]
+    '''
+    if isinstance(hash_function, str):
+        return hash_function.split(',')
+    return list(hash_function)
+
+
+def key_digest(key, hash_function):
+    '''
+    Return the checksum files are grouped on from a clump key, which ends
+    with the checksum of each hash function in turn
+
+    :param tuple key: a clump key made by the checksum stage
+    :param str hash_function: the comma separated hash functions
+    :returns: the hex form of the checksum of the first hash function
+    :rtype: str
+    '''
+    return key[-len(list_hash_names(hash_function))]
+
+
+class MultiHash():
+    '''
+    Several hash functions fed the same data in a single pass
+
+    The checksums are returned in the order the hash functions were named,
+    files are grouped on the checksum of the first, see key_digest.
+    '''
+
+    def __init__(self, hash_name, hash_funcs=None):
+        self.hash_names = list_hash_names(hash_name)
+        self.hash_funcs = hash_funcs or [hashlib.new(name)
+                                         for name in self.hash_names]
+        self.block_size = max(func.block_size for func in self.hash_funcs)
+
+    def update(self, data):
+        '''
+        feed the data to every hash function
+        '''
+        for hash_func in self.hash_funcs:
+            hash_func.update(data)
+
+    def copy(self):
+        '''
+        return a copy of every hash function
+        '''
+        return MultiHash(self.hash_names,
+                         [hash_func.copy() for hash_func in self.hash_funcs])
+
+    def hexdigests(self):
+        '''
+        return a tuple of the hex form of every checksum
+        '''
+        return tuple(hash_func.hexdigest() for hash_func in self.hash_funcs)
+
+    def digests(self):
+        '''
+        return a tuple of the binary form of every checksum
+        '''
+        return tuple(hash_func.digest() for hash_func in self.hash_funcs)
+
+    def combine(self, parts):
+        '''
+        return a copy fed the binary checksums of the parts, in order, for
+        each hash function
+
+        :param parts: the digests of each part
+        :type parts: iterable[tuple[bytes]]
+        '''
+        combined = self.copy()
+        for part in parts:
+            for hash_func, digest in zip(combined.hash_funcs, part):
+                hash_func.update(digest)
+        return combined
+
+
+class Partition():
+    '''
+    Files split into groups that each clumper refines in place
+
+    Groups are numbered and only remember the group they were split from
+    and the clump that split them off, so the tuple key of a group is built
+    once, when the partition is dumped. Groups of a single file are
+    discarded as soon as they appear unless they are kept on purpose.
+    '''
+
+    def __init__(self, clumps=None, keep_singletons=True):
+        self.keep_singletons = keep_singletons
+        self.groups = {}
+        self.parents = {}
+        self.ids = itertools.count()
+        for key, items in (clumps or {}).items():
+            self.add(None, key, items)
+
+    def add(self, parent, clump, items):
+        '''
+        add a group split off the parent group by the clump
+        '''
+        items = list(items)
+        if not items or (len(items) == 1 and not self.keep_singletons):
+            return
+        group = next(self.ids)
+        self.groups[group] = items
+        self.parents[group] = (parent, clump)
+
+    def refine(self, labelled, in_key=True):
+        '''
+        replace every group with the groups of its files sharing a clump,
+        dropping the files that were not given a clump
+
+        :param dict labelled: the files of each group number and clump
+        :param bool in_key: add the clumps to the keys of the new groups
+        '''
+        self.groups = {}
+        for (parent, clump), items in labelled.items():
+            self.add(parent, clump if in_key else (), items)
+
+    def count(self):
+        '''
+        return the number of files left in the groups
+        '''
+        return sum(len(items) for items in self.groups.values())
+
+    def key(self, group):
+        '''
+        return the tuple key of a group, joining the clumps that split it off
+        '''
+        clumps = []
+        while group is not None:
+            group, clump = self.parents[group]
+            clumps.append(clump)
+        return tuple(itertools.chain.from_iterable(reversed(clumps)))
+
+    def dump(self):
+        '''
+        return a dictionary of the key of each group mapped to its files
+        '''
+        clumps = defaultdict(set)
+        for group, items in self.groups.items():
+            clumps[self.key(group)].update(items)
+        return clumps
+
+
 class Clumper():
     '''
     general purpose class for grouping
+
+    Each clumper estimates the cost of clumping one file and the share of
+    files it keeps, which orders the stages of the pipeline. Clumpers that
+    are not in the key only split groups, their clumps are implied by the
+    clumps of a later stage.
     '''
+    COST = 1.0
+    SELECTIVITY = 0.0
+    VECTORIZED = False
+    in_key = True
+    backend = 'python'
 
     def __init__(self, *args, **kwargs):
         pass
 
+    @classmethod
+    def rank(cls):
+        '''
+        return the cost of the stage for each file it removes, the cheapest
+        and most selective stages rank first
+        '''
+        return cls.COST / (1 - cls.SELECTIVITY)
+
     def make_clump(self, item):
         '''
         make a clump of the item
@@ -48,47 +251,546 @@ class Clumper():
         '''
         group list into clumps
         '''
-        clumps = defaultdict(set)
+        partition = Partition(clumper)
+        self.refine(partition)
+        return partition.dump()
+
+    def refine(self, partition):
+        '''
+        split every group of the partition by the clump of each of its items
+        '''
+        entries = []
+        for group, item in self.order(partition.groups):
+            try:
+                entries.append((group, self.make_clump(item), item))
+            except ClumperError as err:
+                LOGGER.error(str(err))
+        partition.refine(self.group(entries), self.in_key)
+
+    def group(self, entries):
+        '''
+        return the items of each group number and clump
+
+        Clumpers whose clumps are tuples of numbers or strings of one type
+        are grouped by sorting arrays with the numpy backend.
+
+        :param entries: the group number, clump and item of every file
+        :type entries: list[tuple]
+        :rtype: dict
+        '''
+        if self.backend == 'numpy' and self.VECTORIZED and entries and \
+                len({len(clump) for _, clump, _ in entries}) == 1:
+            return group_with_numpy(entries)
+        labelled = defaultdict(list)
+        for group, clump, item in entries:
+            labelled[group, clump].append(item)
+        return labelled
 
+    @staticmethod
+    def order(clumper):
+        '''
+        yield each key and item of the clumps in the order to clump them
+        '''
         for key, value in clumper.items():
             for item in value:
-                try:
-                    clumps[key + self.make_clump(item)].add(item)
-                except ClumperError as err:
-                    LOGGER.error(str(err))
-
-        return clumps
+                yield key, item
 
 
 class HashClumper(Clumper):
     '''
     Subclass of Clumper using hash algorithms
     '''
+    COST = 100.0
+    SELECTIVITY = 0.5
+    VECTORIZED = True
 
-    def __init__(self, hash_name):
+    def __init__(self, hash_name, checkpoint=None, read_empty=False,
+                 tree_chunk=None, chunk_cache=None):
         super(HashClumper, self).__init__()
-        self.hash_func = hashlib.new(hash_name)
+        self.hash_func = MultiHash(hash_name)
+        self.inodes = {}
+        self.rotational = {}
+        self.zero_checksums = {}
+        self.checkpoint = checkpoint
+        self.read_empty = read_empty
+        self.tree_chunk = tree_chunk
+        self.chunk_cache = chunk_cache
+
+    def order(self, clumper):
+        '''
+        return each key and item sorted by where the file is stored, so the
+        files are read in one sweep across each disk
+        '''
+        def position(pair):
+            '''
+            sort files that can not be stat'ed and empty files first, they
+            are not read and their data is not looked up on disk
+            '''
+            try:
+                stat = self.stat(pair[1])
+            except ClumperError:
+                return (-1, 0, 0)
+            if self.is_empty(stat):
+                return (-1, 0, stat.st_ino)
+            return self.disk_position(pair[1], stat)
+
+        return sorted(super(HashClumper, self).order(clumper), key=position)
+
+    def disk_position(self, filename, stat=None):
+        '''
+        return a sort key of device, physical offset and inode for the file
+
+        The physical offset of the data is only looked up with FIEMAP for
+        files on spinning disks, files on other devices and filesystems
+        without FIEMAP support are ordered by inode.
+        '''
+        if stat is None:
+            stat = self.stat(filename)
+        if stat.st_dev not in self.rotational:
+            self.rotational[stat.st_dev] = is_rotational(stat.st_dev)
+
+        offset = None
+        if self.rotational[stat.st_dev]:
+            offset = physical_offset(filename.path)
+        return (stat.st_dev, offset or 0, stat.st_ino)
 
     def make_clump(self, filename):
         '''
         return a tuple containing the hex form of the checksum for the file
+
+        Files that are hard links of a file already hashed reuse its checksum
+        rather than being read again, and empty files are never opened.
+        '''
+        stat = self.stat(filename)
+        if self.is_empty(stat):
+            return self.zero_checksum(0)
+        inode = (stat.st_dev, stat.st_ino)
+        if inode in self.inodes:
+            LOGGER.debug('Reusing checksum of hard link %s', filename.path)
+        else:
+            self.inodes[inode] = self.checksum(filename)
+        return self.inodes[inode]
+
+    def is_empty(self, stat):
+        '''
+        return whether the size of the file is enough to know its checksum
+        '''
+        return stat.st_size == 0 and not self.read_empty
+
+    @staticmethod
+    def stat(filename):
+        '''
+        return the stat result of the file
+        '''
+        try:
+            return os.stat(filename.path)
+        except OSError as err:
+            raise ClumperError('Checksum generation error: %s', err)
+
+    def checksum(self, filename):
+        '''
+        return a tuple containing the hex form of the checksum for the file,
+        reusing the checksum saved in the checkpoint if the size and
+        modification time of the file have not changed since
+        '''
+        if self.checkpoint is None:
+            return self.read_checksum(filename)
+
+        stat = self.stat(filename)
+        clump = self.checkpoint.checksum(filename.path, stat)
+        if clump is None:
+            clump = self.read_checksum(filename)
+            self.checkpoint.add_checksum(filename.path, stat, clump)
+        else:
+            LOGGER.debug('Reusing checksum of %s from checkpoint',
+                         filename.path)
+        return clump
+
+    def read_checksum(self, filename):
+        '''
+        return a tuple containing the hex form of the checksum for the file,
+        or of every checksum when several hash functions are used
+
+        Only the data extents of files are read, their holes are hashed as
+        runs of zeros. Files without any data extent, either sparse or
+        preallocated, are all zeros, their checksum is only computed once for
+        each size. Files larger
+        than the tree chunk are hashed with tree_checksum.
         '''
         hash_func = self.hash_func.copy()
+        chunk_size = 128 * hash_func.block_size
 
         try:
             with open(filename.path, 'rb') as file:
-                for chunk in iter(
-                        lambda: file.read(128 * hash_func.block_size), b''):
-                    hash_func.update(chunk)
-            return (hash_func.hexdigest(), )
+                stat = os.fstat(file.fileno())
+                if self.tree_chunk and stat.st_size > self.tree_chunk:
+                    return self.tree_checksum(file.fileno(), stat,
+                                              filename.path)
+
+                extents = data_extents(file.fileno(), stat.st_size)
+
+                if extents is None:
+                    file.seek(0)
+                    for chunk in iter(lambda: file.read(chunk_size), b''):
+                        hash_func.update(chunk)
+                    return hash_func.hexdigests()
+
+                if not extents:
+                    LOGGER.debug('%s is all zeros', filename.path)
+                    return self.zero_checksum(stat.st_size)
+
+                position = 0
+                for start, end in extents:
+                    update_with_zeros(hash_func, start - position, chunk_size)
+                    file.seek(start)
+                    while start < end:
+                        chunk = file.read(min(chunk_size, end - start))
+                        if not chunk:
+                            break
+                        hash_func.update(chunk)
+                        start += len(chunk)
+                    position = start
+                update_with_zeros(hash_func, stat.st_size - position,
+                                  chunk_size)
+            return hash_func.hexdigests()
         except OSError as err:
             raise ClumperError('Checksum generation error: %s', err)
 
+    def tree_checksum(self, fd, stat, path=None):
+        '''
+        return a tuple containing the hex form of the root checksum of a
+        large file
+
+        The file is split in ranges of the tree chunk size, which are read
+        with os.pread and hashed on every core at once. The root checksum is
+        the checksum of the binary checksums of the ranges, so it only stays
+        the same for the same tree chunk size.
+
+        The checksums of the ranges are kept in the chunk cache, so a file
+        that only grew since is not read again up to its old end.
+        '''
+        size = stat.st_size
+
+        def hash_range(start):
+            '''
+            return the checksums of one range of the file
+            '''
+            hash_func = self.hash_func.copy()
+            read_size = 128 * hash_func.block_size
+            end = min(start + self.tree_chunk, size)
+            while start < end:
+                data = os.pread(fd, min(read_size, end - start), start)
+                if not data:
+                    break
+                hash_func.update(data)
+                start += len(data)
+            return hash_func.digests()
+
+        reused = []
+        if self.chunk_cache is not None and path is not None:
+            reused, trusted = self.chunk_cache.ranges(path, stat)
+            if reused and not trusted:
+                samples = sorted({0, len(reused) // 2, len(reused) - 1})
+                if any(hash_range(num * self.tree_chunk) != reused[num]
+                       for num in samples):
+                    LOGGER.info('%s was modified before its end, rehashing',
+                                path)
+                    reused = []
+            if reused:
+                LOGGER.debug('Reusing %d range checksums of %s', len(reused),
+                             path)
+
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=os.cpu_count() or 1) as executor:
+            ranges = reused + list(executor.map(
+                hash_range,
+                range(len(reused) * self.tree_chunk, size, self.tree_chunk)))
+
+        if self.chunk_cache is not None and path is not None:
+            self.chunk_cache.add_ranges(path, stat, ranges)
+        return self.hash_func.combine(ranges).hexdigests()
+
+    def zero_checksum(self, size):
+        '''
+        return the checksum of a file of zeros of the size, computing it once
+        '''
+        if size not in self.zero_checksums:
+            hash_func = self.hash_func.copy()
+            update_with_zeros(hash_func, size, 128 * hash_func.block_size)
+            self.zero_checksums[size] = hash_func.hexdigests()
+        return self.zero_checksums[size]
+
+
+class AsyncHashClumper(HashClumper):
+    '''
+    HashClumper that keeps several files being read at once
+
+    Reads are handed to a pool of threads from an asyncio loop so the time
+    spent waiting on a high latency filesystem overlaps between files.
+
+    Files are stat'ed first so the reads can be split by device: each
+    spinning disk gets a single reader working through its files in the
+    order of their data on disk, while other devices get concurrency
+    readers.
+    '''
+
+    def __init__(self, hash_name, concurrency=8, checkpoint=None,
+                 read_empty=False, tree_chunk=None, chunk_cache=None):
+        super(AsyncHashClumper, self).__init__(hash_name, checkpoint,
+                                               read_empty, tree_chunk,
+                                               chunk_cache)
+        self.concurrency = concurrency
+
+    def refine(self, partition):
+        '''
+        split every group of the partition by checksum, reading up to
+        concurrency files at once
+        '''
+        scheduler = DeviceScheduler(self.concurrency)
+        try:
+            partition.refine(run_with_executor(
+                self.gather_clumps(partition.groups, scheduler),
+                self.concurrency))
+        finally:
+            scheduler.shutdown()
+
+    async def gather_clumps(self, clumper, scheduler):
+        '''
+        coroutine returning the items of each key and checksum for refine
+        '''
+        loop = asyncio.get_event_loop()
+        entries = []
+        devices = defaultdict(lambda: defaultdict(list))
+        items = ((key, item) for key, value in clumper.items()
+                 for item in value)
+
+        def locate(item):
+            '''
+            return the position of the file, or None when it is empty
+            '''
+            stat = self.stat(item)
+            if self.is_empty(stat):
+                return None
+            return self.disk_position(item, stat)
+
+        async def stat_worker():
+            '''
+            stat items until none are left, grouping them by device and
+            clumping empty files without handing them to a reader
+            '''
+            for key, item in items:
+                try:
+                    position = await loop.run_in_executor(None, locate, item)
+                except ClumperError as err:
+                    LOGGER.error(str(err))
+                else:
+                    if position is None:
+                        entries.append((key, self.zero_checksum(0), item))
+                        continue
+                    device, offset, inode = position
+                    devices[device][offset, inode].append((key, item))
+
+        async def hash_worker(device, inodes):
+            '''
+            hash the files of a device until none are left
+            '''
+            executor = scheduler.executor(device)
+            for (_, inode), members in inodes:
+                clump = self.inodes.get((device, inode))
+                if clump is None:
+                    try:
+                        clump = await loop.run_in_executor(
+                            executor, self.checksum, members[0][1])
+                    except ClumperError as err:
+                        LOGGER.error(str(err))
+                        continue
+                    self.inodes[device, inode] = clump
+                for key, item in members:
+                    entries.append((key, clump, item))
+
+        await asyncio.gather(*[stat_worker()
+                               for _ in range(self.concurrency)])
+
+        workers = []
+        for device, inodes in devices.items():
+            ordered = iter(sorted(inodes.items()))
+            workers.extend(hash_worker(device, ordered)
+                           for _ in range(scheduler.readers(device)))
+        await asyncio.gather(*workers)
+        return self.group(entries)
+
+
+class DeviceScheduler():
+    '''
+    Hand out a pool of reader threads for each device
+
+    Concurrent reads on a spinning disk make its head seek back and forth,
+    so those devices get a single reader while others get concurrency.
+    '''
+
+    def __init__(self, concurrency=8):
+        self.concurrency = concurrency
+        self.executors = {}
+
+    def readers(self, device):
+        '''
+        return the number of files of the device to read at once
+        '''
+        return 1 if is_rotational(device) else self.concurrency
+
+    def executor(self, device):
+        '''
+        return the thread pool reading files from the device
+        '''
+        if device not in self.executors:
+            readers = self.readers(device)
+            LOGGER.info('Reading device %d:%d with %d readers',
+                        os.major(device), os.minor(device), readers)
+            self.executors[device] = concurrent.futures.ThreadPoolExecutor(
+                max_workers=readers)
+        return self.executors[device]
+
+    def shutdown(self):
+        '''
+        stop the thread pools of all devices
+        '''
+        for executor in self.executors.values():
+            executor.shutdown(wait=True)
+        self.executors.clear()
+
+
+FS_IOC_FIEMAP = 0xc020660b
+FIEMAP = struct.Struct('QQIIII')
+FIEMAP_EXTENT = struct.Struct('QQQQQIIII')
+FIEMAP_MAX_OFFSET = 0xffffffffffffffff
+
+
+def physical_offset(path):
+    '''
+    Return the physical byte offset of the first extent of a file
+
+    :param str path: the file to look up
+    :returns: the offset, or None for empty files and filesystems that do
+              not support the FIEMAP ioctl
+    :rtype: int
+    '''
+    request = bytearray(FIEMAP.size + FIEMAP_EXTENT.size)
+    FIEMAP.pack_into(request, 0, 0, FIEMAP_MAX_OFFSET, 0, 0, 1, 0)
+    try:
+        with open(path, 'rb') as file:
+            fcntl.ioctl(file.fileno(), FS_IOC_FIEMAP, request)
+    except OSError as err:
+        LOGGER.debug('No extent map for %s: %s', path, err)
+        return None
+
+    if not FIEMAP.unpack_from(request, 0)[3]:
+        return None
+    return FIEMAP_EXTENT.unpack_from(request, FIEMAP.size)[1]
+
+
+def data_extents(fd, size):
+    '''
+    Return the start and end of every data extent of a sparse file
+
+    :param int fd: the open file
+    :param int size: the size of the file
+    :returns: the extents, or None when the filesystem can not tell them
+              apart from holes
+    :rtype: list[tuple[int, int]]
+    '''
+    if not hasattr(os, 'SEEK_DATA'):
+        return None
+    extents = []
+    position = 0
+    while position < size:
+        try:
+            start = os.lseek(fd, position, os.SEEK_DATA)
+            end = min(os.lseek(fd, start, os.SEEK_HOLE), size)
+        except OSError as err:
+            if err.errno == errno.ENXIO:
+                break
+            return None
+        extents.append((start, end))
+        position = end
+    return extents
+
+
+def update_with_zeros(hash_func, length, chunk_size):
+    '''
+    Feed a run of zeros to the hash function without reading it
+    '''
+    zeros = bytes(min(length, chunk_size))
+    while length > 0:
+        hash_func.update(zeros[:length])
+        length -= len(zeros)
+
+
+def is_rotational(device):
+    '''
+    Check sysfs for whether a block device is a spinning disk
+
+    Devices without a sysfs entry, such as network mounts, are reported as
+    not rotational.
+
+    :param int device: the st_dev of a file on the device
+    :rtype: bool
+    '''
+    sysfs_path = '/sys/dev/block/{0}:{1}'.format(os.major(device),
+                                                 os.minor(device))
+    # partitions keep their queue settings in the parent disk
+    parent_path = os.path.dirname(os.path.realpath(sysfs_path))
+    for queue_path in (os.path.join(sysfs_path, 'queue'),
+                       os.path.join(parent_path, 'queue')):
+        try:
+            with open(os.path.join(queue_path, 'rotational')) as rotational:
+                return rotational.read().strip() == '1'
+        except OSError:
+            continue
+    return False
+
+
+class SizeClumper(Clumper):
+    '''
+    Subclass of Clumper splitting groups by file size
+    '''
+    COST = 1.0
+    SELECTIVITY = 0.3
+    VECTORIZED = True
+    in_key = False
+
+    def make_clump(self, filename):
+        '''
+        Return a tuple containing the size of the file
+        '''
+        return (HashClumper.stat(filename).st_size, )
+
+
+class PartialClumper(Clumper):
+    '''
+    Subclass of Clumper splitting groups by the checksum of the first bytes
+    of each file
+    '''
+    COST = 10.0
+    SELECTIVITY = 0.8
+    VECTORIZED = True
+    in_key = False
+
+    def make_clump(self, filename):
+        '''
+        Return a tuple containing the size and checksum of the first bytes
+        '''
+        try:
+            return (BloomFilter.make_key(filename.path), )
+        except OSError as err:
+            raise ClumperError('Partial checksum error: %s', err)
+
 
 class RegexClumper(Clumper):
     '''
     Subclass of Clumper using regular expressions
     '''
+    COST = 0.1
+    SELECTIVITY = 0.5
 
     def __init__(self, expr):
         super(RegexClumper, self).__init__()
@@ -113,12 +815,16 @@ class PathClumper(Clumper):
     Clumper for grouping by path
     '''
 
-    def __init__(self, root_path, recursive=False):
+    def __init__(self, root_path, recursive=False, checkpoint=None,
+                 walk_filter=None):
         super(PathClumper, self).__init__()
-        self.root_path = root_path
+        self.root_paths = list_root_paths(root_path)
         self.recursive = recursive
+        self.checkpoint = checkpoint
+        self.walk_filter = walk_filter
 
-    def make_clump(self, path):
+    @staticmethod
+    def make_clump(path):
         '''
         return a tuple containing the path
         '''
@@ -127,20 +833,81 @@ class PathClumper(Clumper):
     def dump_clumps(self, clumper=None):
         '''
         Return dictionary of paths mapped to a list of file objects
+
+        Every root path is walked in turn, directories reached from more
+        than one root are only listed once.
         '''
         if clumper is not None:
             raise NotImplementedError
         clumps = {}
 
-        for path, _, filenames in os.walk(self.root_path):
-            if not self.recursive and path != self.root_path:
-                LOGGER.debug("Skipping child directory %s of %s", path,
-                             self.root_path)
-                continue
-            clumps[self.make_clump(path)] = self.create_filenames_from_list(
-                filenames, path)
+        for root_path in self.root_paths:
+            pending = [root_path]
+            while pending:
+                path = pending.pop()
+                if self.make_clump(path) in clumps:
+                    LOGGER.debug("Skipping directory %s already listed",
+                                 path)
+                    continue
+                filenames, dirnames = self.list_directory(path)
+                clumps[self.make_clump(
+                    path)] = self.create_filenames_from_list(filenames, path)
+                if self.recursive:
+                    pending.extend(reversed(dirnames))
         return clumps
 
+    def list_directory(self, path):
+        '''
+        Return the names of the files and the paths of the child directories
+        of a directory that are not pruned by the walk filter
+        '''
+        filenames, dirnames = self.read_directory(path)
+        if self.walk_filter is not None:
+            filenames, dirnames = self.walk_filter.prune(path, filenames,
+                                                         dirnames)
+        return filenames, dirnames
+
+    def read_directory(self, path):
+        '''
+        Return the names of the files and the paths of the child directories
+        of a directory, reusing the listing saved in the checkpoint if the
+        directory has not been modified since
+        '''
+        if self.checkpoint is None:
+            return self.scan_directory(path)
+
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return self.scan_directory(path)
+
+        listing = self.checkpoint.listing(path, mtime)
+        if listing is None:
+            listing = self.scan_directory(path)
+            self.checkpoint.add_listing(path, mtime, *listing)
+        else:
+            LOGGER.debug('Reusing listing of %s from checkpoint', path)
+        return listing
+
+    @staticmethod
+    def scan_directory(path):
+        '''
+        List a directory, splitting the names of files from the paths of
+        child directories the same way as os.walk
+        '''
+        filenames, dirnames = [], []
+        try:
+            # the iterator is only a context manager from python 3.6, it is
+            # closed once exhausted
+            for entry in list(os.scandir(path)):
+                if not entry.is_dir():
+                    filenames.append(entry.name)
+                elif not entry.is_symlink():
+                    dirnames.append(entry.path)
+        except OSError as err:
+            LOGGER.error('Directory listing error: %s', err)
+        return filenames, dirnames
+
     @staticmethod
     def create_filename_from_string(filename, root):
         '''
@@ -169,6 +936,750 @@ class PathClumper(Clumper):
             yield cls.create_filename_from_string(filename, root)
 
 
+class AsyncPathClumper(PathClumper):
+    '''
+    PathClumper that lists several directories at once
+
+    Directory listings are handed to a pool of threads from an asyncio loop
+    so the round trips to a high latency filesystem overlap.
+    '''
+
+    def __init__(self, root_path, recursive=False, concurrency=8,
+                 checkpoint=None, walk_filter=None):
+        super(AsyncPathClumper, self).__init__(root_path, recursive,
+                                               checkpoint, walk_filter)
+        self.concurrency = concurrency
+
+    def dump_clumps(self, clumper=None):
+        '''
+        Return dictionary of paths mapped to a list of file objects
+        '''
+        if clumper is not None:
+            raise NotImplementedError
+        return run_with_executor(self.gather_clumps(), self.concurrency)
+
+    async def gather_clumps(self):
+        '''
+        coroutine building the clumps for dump_clumps
+        '''
+        loop = asyncio.get_event_loop()
+        clumps = {}
+        queue = asyncio.Queue()
+        queued = set()
+
+        def enqueue(path):
+            '''
+            queue a directory unless it was reached before
+            '''
+            if path not in queued:
+                queued.add(path)
+                queue.put_nowait(path)
+
+        for root_path in self.root_paths:
+            enqueue(root_path)
+
+        async def worker():
+            '''
+            list directories from the queue, queueing their children
+
+            An error listing one directory is logged rather than ending the
+            worker, the directories still queued would never be listed.
+            '''
+            while True:
+                path = await queue.get()
+                try:
+                    filenames, dirnames = await loop.run_in_executor(
+                        None, self.list_directory, path)
+                    clumps[self.make_clump(path)] = list(
+                        self.create_filenames_from_list(filenames, path))
+                    if self.recursive:
+                        for dirname in dirnames:
+                            enqueue(dirname)
+                except asyncio.CancelledError:
+                    raise
+                except Exception as err:  # pylint: disable=broad-except
+                    LOGGER.error('Directory listing error: %s: %s', path,
+                                 err)
+                finally:
+                    queue.task_done()
+
+        workers = [loop.create_task(worker())
+                   for _ in range(self.concurrency)]
+        await queue.join()
+        for task in workers:
+            task.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        return clumps
+
+
+class ChunkCache():
+    '''
+    Checksums of the ranges of tree hashed files kept between runs
+
+    A file that is the same file and has not shrunk since it was cached is
+    taken to have been appended to: when a few sampled ranges still match,
+    only the ranges past the old end are read again.
+    '''
+    VERSION = 1
+
+    def __init__(self, path, hash_name, chunk_size):
+        self.path = path
+        self.hash_name = hash_name
+        self.chunk_size = chunk_size
+        self.files = {}
+        self.lock = threading.Lock()
+
+    def load(self):
+        '''
+        Read the checksums kept by an earlier run with the same hash function
+        and range size
+        '''
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            LOGGER.info('No chunk cache found at %s', self.path)
+            return
+        except (OSError, ValueError) as err:
+            LOGGER.warning('Could not load chunk cache: %s', err)
+            return
+
+        if (data.get('version') != self.VERSION or
+                data.get('hash_function') != self.hash_name or
+                data.get('chunk_size') != self.chunk_size):
+            LOGGER.warning('Chunk cache %s does not match this run, '
+                           'starting over', self.path)
+            return
+        self.files = data['files']
+        LOGGER.info('Loaded range checksums of %d files from %s',
+                    len(self.files), self.path)
+
+    def save(self):
+        '''
+        Write the checksums to a temporary file and rename it over the cache
+        '''
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump({'version': self.VERSION,
+                           'hash_function': self.hash_name,
+                           'chunk_size': self.chunk_size,
+                           'files': self.files}, file)
+            os.replace(temp_path, self.path)
+        LOGGER.debug('Saved chunk cache %s', self.path)
+
+    def ranges(self, path, stat):
+        '''
+        Return the cached checksums of the ranges of the file that can be
+        reused, and whether they can be trusted without sampling
+
+        Every range is trusted while the size and modification time are
+        unchanged. When the file grew, only the ranges that were full at the
+        old size are returned. A file changed without growing is read again.
+
+        :rtype: tuple[list, bool]
+        '''
+        with self.lock:
+            entry = self.files.get(path)
+        if entry is None:
+            return [], False
+        device, inode, size, mtime, ranges = entry
+        if (device, inode) != (stat.st_dev, stat.st_ino) or \
+                size > stat.st_size or mtime > stat.st_mtime_ns:
+            return [], False
+        ranges = [tuple(bytes.fromhex(digest) for digest in part)
+                  for part in ranges]
+        if (size, mtime) == (stat.st_size, stat.st_mtime_ns):
+            return ranges, True
+        if size == stat.st_size:
+            return [], False
+        return ranges[:size // self.chunk_size], False
+
+    def add_ranges(self, path, stat, ranges):
+        '''
+        Keep the checksums of the ranges of the file
+        '''
+        with self.lock:
+            self.files[path] = [stat.st_dev, stat.st_ino, stat.st_size,
+                                stat.st_mtime_ns,
+                                [[digest.hex() for digest in part]
+                                 for part in ranges]]
+
+
+class WalkFilter():
+    '''
+    Prune files and directories from the walk before they are clumped
+
+    Names are matched against the exclude globs and the globs listed in the
+    .twintrimignore files of the directory and the directories above it.
+    The globs of each directory are compiled into one regular expression,
+    shared by every directory with the same globs. Excluded directories are
+    not descended into, and neither are the skipped directories.
+    '''
+    IGNORE_FILE = '.twintrimignore'
+
+    def __init__(self, exclude=None, min_size=None, max_size=None,
+                 skip_dirs=None):
+        self.patterns = tuple(exclude or ())
+        self.min_size = min_size
+        self.max_size = max_size
+        self.skip_dirs = {os.path.abspath(path) for path in skip_dirs or ()}
+        self.matchers = {}
+        self.inherited = {}
+
+    def matcher(self, patterns):
+        '''
+        return one compiled expression matching any of the globs
+        '''
+        if patterns not in self.matchers:
+            self.matchers[patterns] = re.compile('|'.join(
+                fnmatch.translate(pattern) for pattern in patterns)) \
+                if patterns else None
+        return self.matchers[patterns]
+
+    @staticmethod
+    def read_ignore_file(path):
+        '''
+        return the globs of an ignore file, one per line, skipping blank lines
+        and comments
+        '''
+        try:
+            with open(path) as file:
+                lines = [line.strip() for line in file]
+        except (OSError, UnicodeDecodeError) as err:
+            LOGGER.error('Ignore file error: %s', err)
+            return ()
+        return tuple(line.rstrip('/') for line in lines
+                     if line and not line.startswith('#'))
+
+    def prune(self, path, filenames, dirnames):
+        '''
+        return the file names and the child directory paths that are kept
+        '''
+        patterns = self.inherited.pop(path, self.patterns)
+        if self.IGNORE_FILE in filenames:
+            patterns += self.read_ignore_file(
+                os.path.join(path, self.IGNORE_FILE))
+        matcher = self.matcher(patterns)
+
+        if matcher is not None:
+            filenames = [name for name in filenames if not matcher.match(name)]
+            dirnames = [dirname for dirname in dirnames
+                        if not matcher.match(os.path.basename(dirname))]
+        if self.skip_dirs:
+            dirnames = [dirname for dirname in dirnames
+                        if os.path.abspath(dirname) not in self.skip_dirs]
+        if self.min_size is not None or self.max_size is not None:
+            filenames = [name for name in filenames
+                         if self.fits_size(os.path.join(path, name))]
+
+        for dirname in dirnames:
+            self.inherited[dirname] = patterns
+        return filenames, dirnames
+
+    def allows(self, path, root_path):
+        '''
+        return whether the walk of the root paths would keep the file or
+        directory, checking the globs of every directory on the way down to
+        it, the skipped directories and the size limits of files
+
+        :param str path: a file or directory found under the root paths
+        :param root_path: the path or paths that are walked
+        :type root_path: str or list[str]
+        '''
+        path = os.path.abspath(path)
+        roots = [os.path.abspath(root) for root in list_root_paths(root_path)
+                 if path.startswith(os.path.join(os.path.abspath(root), ''))]
+        directory = max(roots, key=len) if roots else os.path.dirname(path)
+        patterns = self.patterns
+        for name in os.path.relpath(path, directory).split(os.sep):
+            ignore_file = os.path.join(directory, self.IGNORE_FILE)
+            if os.path.isfile(ignore_file):
+                patterns += self.read_ignore_file(ignore_file)
+            matcher = self.matcher(patterns)
+            directory = os.path.join(directory, name)
+            if (matcher is not None and matcher.match(name)) or \
+                    directory in self.skip_dirs:
+                return False
+        if os.path.isdir(path) or \
+                (self.min_size is None and self.max_size is None):
+            return True
+        return self.fits_size(path)
+
+    def fits_size(self, path):
+        '''
+        return whether the size of the file is within the limits
+        '''
+        try:
+            size = os.stat(path).st_size
+        except OSError as err:
+            LOGGER.error('File size error: %s', err)
+            return False
+        if self.min_size is not None and size < self.min_size:
+            return False
+        return self.max_size is None or size <= self.max_size
+
+
+def check_hash_names(text):
+    '''
+    Check every name of a comma separated list of hash functions
+
+    :raises argparse.ArgumentTypeError: when a hash function is not available
+    '''
+    for name in list_hash_names(text):
+        if name not in hashlib.algorithms_available:
+            raise argparse.ArgumentTypeError(
+                'invalid hash function: {0}'.format(name))
+    return text
+
+
+def parse_size(text):
+    '''
+    Parse a size in bytes with an optional K, M, G or T suffix
+
+    :raises argparse.ArgumentTypeError: when the size is not understood
+    '''
+    match = re.match(r'^(\d+)([KMGT]?)i?B?$', text.strip(), re.IGNORECASE)
+    if match is None:
+        raise argparse.ArgumentTypeError('invalid size: {0}'.format(text))
+    number, suffix = match.groups()
+    return int(number) * 1024 ** ' KMGT'.index(suffix.upper() or ' ')
+
+
+class Checkpoint():
+    '''
+    Progress of a run saved to a file at regular intervals
+
+    Directory listings and checksums are kept so a run that was stopped can
+    skip listing directories and reading files that have not been modified
+    since they were saved.
+    '''
+    VERSION = 1
+
+    def __init__(self, path, hash_name, interval=60):
+        self.path = path
+        self.hash_name = hash_name
+        self.interval = interval
+        self.directories = {}
+        self.checksums = {}
+        self.lock = threading.Lock()
+        self.saved_at = time.monotonic()
+
+    def load(self):
+        '''
+        Read the progress saved by an earlier run with the same hash function
+        '''
+        try:
+            with open(self.path) as file:
+                data = json.load(file)
+        except FileNotFoundError:
+            LOGGER.info('No checkpoint found at %s, starting over', self.path)
+            return
+        except (OSError, ValueError) as err:
+            LOGGER.warning('Could not load checkpoint: %s', err)
+            return
+
+        if (data.get('version') != self.VERSION or
+                data.get('hash_function') != self.hash_name):
+            LOGGER.warning('Checkpoint %s does not match this run, '
+                           'starting over', self.path)
+            return
+
+        self.directories = data['directories']
+        self.checksums = data['checksums']
+        LOGGER.info('Resuming with %d directories and %d checksums from %s',
+                    len(self.directories), len(self.checksums), self.path)
+
+    def save(self):
+        '''
+        Write the progress to a temporary file and rename it over the
+        checkpoint, so an interruption never leaves a partial checkpoint
+        '''
+        with self.lock:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'w') as file:
+                json.dump({'version': self.VERSION,
+                           'hash_function': self.hash_name,
+                           'directories': self.directories,
+                           'checksums': self.checksums}, file)
+            os.replace(temp_path, self.path)
+            self.saved_at = time.monotonic()
+        LOGGER.debug('Saved checkpoint %s', self.path)
+
+    def save_if_due(self):
+        '''
+        Save the progress if the interval has passed since the last save
+        '''
+        if time.monotonic() - self.saved_at >= self.interval:
+            self.save()
+
+    def remove(self):
+        '''
+        Remove the checkpoint once the run has finished
+        '''
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+    def listing(self, path, mtime_ns):
+        '''
+        Return the saved listing of a directory, or None if there is no
+        listing for the modification time of the directory
+        '''
+        saved = self.directories.get(path)
+        if saved is None or saved[0] != mtime_ns:
+            return None
+        return saved[1], saved[2]
+
+    def add_listing(self, path, mtime_ns, filenames, dirnames):
+        '''
+        Save the listing of a directory
+        '''
+        with self.lock:
+            self.directories[path] = [mtime_ns, filenames, dirnames]
+        self.save_if_due()
+
+    def checksum(self, path, stat):
+        '''
+        Return the saved checksum of a file, or None if there is no
+        checksum for the size and modification time of the file
+        '''
+        saved = self.checksums.get(path)
+        if saved is None or saved[:2] != [stat.st_size, stat.st_mtime_ns]:
+            return None
+        return tuple(saved[2])
+
+    def add_checksum(self, path, stat, clump):
+        '''
+        Save the checksum of a file
+        '''
+        with self.lock:
+            self.checksums[path] = [stat.st_size, stat.st_mtime_ns,
+                                    list(clump)]
+        self.save_if_due()
+
+
+class ReferenceIndex():
+    '''
+    Sorted checksums of the files in a reference library
+
+    The binary checksums are stored back to back after a short header, so
+    the index is searched in place through mmap rather than loaded.
+    '''
+    MAGIC = b'TWNTRIMR'
+    HEADER = struct.Struct('<8s16sIQ')
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            header = file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                raise ValueError('Truncated reference index: ' + path)
+            magic, hash_name, self.digest_size, self.count = \
+                self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                raise ValueError('Not a reference index: ' + path)
+            self.hash_name = hash_name.rstrip(b'\0').decode('ascii')
+
+            size = self.HEADER.size + self.digest_size * self.count
+            if os.fstat(file.fileno()).st_size != size:
+                raise ValueError('Truncated reference index: ' + path)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        '''
+        Binary search the index for a binary checksum
+        '''
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            offset = self.HEADER.size + middle * self.digest_size
+            found = self.map[offset:offset + self.digest_size]
+            if found == digest:
+                return True
+            elif found < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return False
+
+    def close(self):
+        '''
+        Release the mapping of the index
+        '''
+        self.map.close()
+
+    @classmethod
+    def write(cls, path, hash_name, digests):
+        '''
+        Write the sorted, unique binary checksums to a new index
+
+        :param str path: the file to write the index to
+        :param str hash_name: the hash function that made the checksums
+        :param digests: the binary checksums
+        :type digests: iterable[bytes]
+        :returns: the number of checksums written
+        :rtype: int
+        '''
+        digest_size = hashlib.new(hash_name).digest_size
+        digests = sorted(set(digests))
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(cls.HEADER.pack(cls.MAGIC, hash_name.encode('ascii'),
+                                       digest_size, len(digests)))
+            for digest in digests:
+                file.write(digest)
+        os.replace(temp_path, path)
+        return len(digests)
+
+
+ScanRecord = namedtuple('ScanRecord', ['path', 'size', 'mtime_ns', 'dev',
+                                       'ino', 'digest'])
+
+
+class ScanIndex():
+    '''
+    Results of a scan stored as fixed width records sorted by checksum
+
+    Each record holds the offset and length of its path in the path table
+    that follows the records, then the size, modification time, device,
+    inode and binary checksum of the file. The index is searched in place
+    through mmap, and a record is only unpacked when it is asked for.
+    '''
+    MAGIC = b'TWNTRIMS'
+    HEADER = struct.Struct('<8s16sIQ')
+    RECORD = '<QIQqQQ{0}s'
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            header = file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                raise ValueError('Truncated scan index: ' + path)
+            magic, hash_name, self.digest_size, self.count = \
+                self.HEADER.unpack(header)
+            if magic != self.MAGIC:
+                raise ValueError('Not a scan index: ' + path)
+            self.hash_name = hash_name.rstrip(b'\0').decode('ascii')
+            self.record = struct.Struct(self.RECORD.format(self.digest_size))
+            self.paths_offset = (self.HEADER.size +
+                                 self.record.size * self.count)
+
+            if os.fstat(file.fileno()).st_size < self.paths_offset:
+                raise ValueError('Truncated scan index: ' + path)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return self.count
+
+    def __contains__(self, digest):
+        num = self.bisect(digest)
+        return num < self.count and self.digest(num) == digest
+
+    def __getitem__(self, num):
+        '''
+        Unpack one record of the index
+
+        :rtype: ScanRecord
+        '''
+        if not 0 <= num < self.count:
+            raise IndexError('Scan record out of range')
+        (path_offset, path_length, size, mtime_ns, dev, ino,
+         digest) = self.record.unpack_from(
+             self.map, self.HEADER.size + num * self.record.size)
+        start = self.paths_offset + path_offset
+        path = os.fsdecode(self.map[start:start + path_length])
+        return ScanRecord(path, size, mtime_ns, dev, ino, digest)
+
+    def digest(self, num):
+        '''
+        Return the binary checksum of a record without unpacking the rest
+        '''
+        offset = (self.HEADER.size + (num + 1) * self.record.size -
+                  self.digest_size)
+        return self.map[offset:offset + self.digest_size]
+
+    def bisect(self, digest):
+        '''
+        Return the number of the first record whose checksum is not less than
+        the binary checksum
+        '''
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self.digest(middle) < digest:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def find(self, digest):
+        '''
+        Return the records of every file with the binary checksum
+
+        :rtype: list[ScanRecord]
+        '''
+        records = []
+        num = self.bisect(digest)
+        while num < self.count and self.digest(num) == digest:
+            records.append(self[num])
+            num += 1
+        return records
+
+    def close(self):
+        '''
+        Release the mapping of the index
+        '''
+        self.map.close()
+
+    @classmethod
+    def write(cls, path, hash_name, entries):
+        '''
+        Write the scanned files to a new index
+
+        :param str path: the file to write the index to
+        :param str hash_name: the hash function that made the checksums
+        :param entries: the path, stat result and binary checksum of each file
+        :type entries: iterable[tuple]
+        :returns: the number of records written
+        :rtype: int
+        '''
+        digest_size = hashlib.new(hash_name).digest_size
+        record = struct.Struct(cls.RECORD.format(digest_size))
+        entries = sorted(entries, key=lambda entry: (entry[2], entry[0]))
+        paths = bytearray()
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(cls.HEADER.pack(cls.MAGIC, hash_name.encode('ascii'),
+                                       digest_size, len(entries)))
+            for name, stat, digest in entries:
+                encoded = os.fsencode(name)
+                file.write(record.pack(len(paths), len(encoded), stat.st_size,
+                                       stat.st_mtime_ns, stat.st_dev,
+                                       stat.st_ino, digest))
+                paths += encoded
+            file.write(paths)
+        os.replace(temp_path, path)
+        return len(entries)
+
+
+def open_index(path):
+    '''
+    Open a reference index, or a scan index written by an earlier run
+
+    :raises ValueError: when the file is neither kind of index
+    '''
+    try:
+        return ReferenceIndex(path)
+    except ValueError:
+        with open(path, 'rb') as file:
+            if file.read(len(ScanIndex.MAGIC)) != ScanIndex.MAGIC:
+                raise
+        return ScanIndex(path)
+
+
+class BloomFilter():
+    '''
+    Bloom filter of the size and first bytes of the files in a library
+
+    A key missing from the filter is certainly not in the library, so the
+    file can be skipped without being hashed. The bits are stored after a
+    short header and tested in place through mmap.
+    '''
+    MAGIC = b'TWNTRIMB'
+    HEADER = struct.Struct('<8sQIIQ')
+    PARTIAL_SIZE = 4096
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as file:
+            header = file.read(self.HEADER.size)
+            if len(header) < self.HEADER.size:
+                raise ValueError('Truncated bloom filter: ' + path)
+            (magic, self.num_bits, self.num_hashes, self.partial_size,
+             self.count) = self.HEADER.unpack(header)
+            if magic != self.MAGIC or not self.num_bits:
+                raise ValueError('Not a bloom filter: ' + path)
+
+            size = self.HEADER.size + (self.num_bits + 7) // 8
+            if os.fstat(file.fileno()).st_size != size:
+                raise ValueError('Truncated bloom filter: ' + path)
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __contains__(self, key):
+        '''
+        Test whether every bit of the key is set
+        '''
+        for bit in self.bits(key, self.num_bits, self.num_hashes):
+            if not self.map[self.HEADER.size + bit // 8] & (1 << bit % 8):
+                return False
+        return True
+
+    def close(self):
+        '''
+        Release the mapping of the filter
+        '''
+        self.map.close()
+
+    @staticmethod
+    def bits(key, num_bits, num_hashes):
+        '''
+        Return the bit positions of a key by enhanced double hashing of one
+        digest, so the positions do not cycle when the second hash shares a
+        factor with the number of bits
+        '''
+        first, second = struct.unpack('<QQ', hashlib.md5(key).digest())
+        return [(first + num * second + (num ** 3 - num) // 6) % num_bits
+                for num in range(num_hashes)]
+
+    @classmethod
+    def make_key(cls, path, partial_size=PARTIAL_SIZE):
+        '''
+        Return the size of a file followed by the checksum of its first bytes
+
+        :raises OSError: when the file can not be read
+        '''
+        with open(path, 'rb') as file:
+            size = os.fstat(file.fileno()).st_size
+            start = file.read(partial_size)
+        return struct.pack('<Q', size) + hashlib.md5(start).digest()
+
+    @classmethod
+    def write(cls, path, keys, error_rate=0.01):
+        '''
+        Write a filter sized for the keys and the false positive rate
+
+        :param str path: the file to write the filter to
+        :param keys: the keys made by make_key
+        :type keys: list[bytes]
+        :param float error_rate: the expected rate of false positives
+        :returns: the number of bits in the filter
+        :rtype: int
+        '''
+        count = max(len(keys), 1)
+        num_bits = int(math.ceil(
+            -count * math.log(error_rate) / math.log(2) ** 2))
+        num_hashes = max(int(round(num_bits / count * math.log(2))), 1)
+        num_bits = max(num_bits, 8192)
+
+        bitmap = bytearray((num_bits + 7) // 8)
+        for key in keys:
+            for bit in cls.bits(key, num_bits, num_hashes):
+                bitmap[bit // 8] |= 1 << bit % 8
+
+        temp_path = path + '.tmp'
+        with open(temp_path, 'wb') as file:
+            file.write(cls.HEADER.pack(cls.MAGIC, num_bits, num_hashes,
+                                       cls.PARTIAL_SIZE, len(keys)))
+            file.write(bitmap)
+        os.replace(temp_path, path)
+        return num_bits
+
+
 class Picker():
     '''
     general purpose class for picking from group
@@ -251,90 +1762,516 @@ class ModificationPicker(Picker):
     '''
     def compare(self, clump):
         '''
-        Compare all names to find the best one
+        Compare all names to find the best one
+        '''
+        return functools.reduce(self.pick_older_file, clump)
+
+    @staticmethod
+    def pick_older_file(item_a, item_b):
+        '''
+        Finds the oldest modification time
+        '''
+        if os.stat(item_a.path).st_mtime < os.stat(item_b.path).st_mtime:
+            return item_a
+        else:
+            return item_b
+
+
+class InteractivePicker(ShortestPicker):
+    '''
+    This class allows the user to interactively select which file is
+    selected to be preserved.
+    '''
+
+    def __init__(self, *args, **kwargs):
+        super(InteractivePicker, self).__init__(*args, **kwargs)
+
+    def sift(self, clump):
+        '''
+        Asks user for best after giving recommendation
+        '''
+        default, rest = super(InteractivePicker, self).sift(clump)
+        files = [default] + list(rest)
+        for num, file in enumerate(files):
+            if file == default:
+                print("{0}. {1} (default)".format(num, file.name))
+            else:
+                print("{0}. {1}".format(num, file.name))
+
+        try:
+            while True:
+                result = input('Pick which file to keep (^C to skip): ')
+                if result == '':
+                    best = default
+                    break
+                elif result.isdigit() and int(result) in range(len(files)):
+                    best = files[int(result)]
+                    break
+                elif result in [file.name for file in files]:
+                    best = [file for file in files if file.name == result][0]
+                    break
+            rest = set(files) - {best}
+            LOGGER.warning('User picked %s over %s', best, default)
+
+        except KeyboardInterrupt:
+            print('\nSkipped')
+            LOGGER.warning('User skipped in interactive mode')
+            best = default
+            rest = {}
+
+        return best, rest
+
+
+class InotifyWatcher():
+    '''
+    Report files written under a directory using the Linux inotify API
+    '''
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_Q_OVERFLOW = 0x00004000
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+    EVENT = struct.Struct('iIII')
+
+    def __init__(self, root_path, recursive=False, walk_filter=None):
+        self.libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.root_path = root_path
+        self.recursive = recursive
+        self.walk_filter = walk_filter
+        self.watches = {}
+        self.fd = self.libc.inotify_init1(os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'inotify_init1: ' + os.strerror(err))
+
+        for path in list_root_paths(root_path):
+            if recursive:
+                for child_path, dirnames, _ in os.walk(path):
+                    self.add_watch(child_path)
+                    dirnames[:] = self.prune(child_path, dirnames)
+            else:
+                self.add_watch(path)
+
+    def prune(self, path, dirnames):
+        '''
+        return the names of the child directories the walk filter keeps, so
+        pruned directories are not watched
+        '''
+        if self.walk_filter is None:
+            return dirnames
+        return [name for name in dirnames if self.walk_filter.allows(
+            os.path.join(path, name), self.root_path)]
+
+    def add_watch(self, path):
+        '''
+        Start watching a directory for files being written or moved into it
+        '''
+        wd = self.libc.inotify_add_watch(self.fd, os.fsencode(path),
+                                         self.WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, 'inotify_add_watch: ' + os.strerror(err), path)
+        LOGGER.debug('Watching directory %s', path)
+        self.watches[wd] = path
+
+    @classmethod
+    def parse_events(cls, data):
+        '''
+        Split a buffer read from the inotify file descriptor into events
+
+        :param bytes data: raw bytes read from the inotify descriptor
+        :returns: tuples of watch descriptor, event mask and name
+        :rtype: list[tuple]
+        '''
+        events = []
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = cls.EVENT.unpack_from(data, offset)
+            offset += cls.EVENT.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            events.append((wd, mask, name))
+        return events
+
+    def events(self):
+        '''
+        Yield the path of each file once it has been written or moved in
+
+        When the event queue overflowed, the directories created since are
+        watched and None is yielded, as the roots have to be scanned again.
+        '''
+        while True:
+            for wd, mask, name in self.parse_events(os.read(self.fd, 65536)):
+                if mask & self.IN_Q_OVERFLOW:
+                    LOGGER.warning('Event queue overflowed, events were lost')
+                    if self.recursive:
+                        for path in list_root_paths(self.root_path):
+                            self.watch_new_directory(path)
+                    yield None
+                    continue
+                if mask & self.IN_IGNORED:
+                    self.watches.pop(wd, None)
+                    continue
+                if wd not in self.watches:
+                    continue
+
+                path = os.path.join(self.watches[wd], name)
+                if mask & self.IN_ISDIR:
+                    if self.recursive and self.prune(self.watches[wd],
+                                                     [name]):
+                        for new_path in self.watch_new_directory(path):
+                            yield new_path
+                elif mask & (self.IN_CLOSE_WRITE | self.IN_MOVED_TO):
+                    yield path
+
+    def watch_new_directory(self, path):
+        '''
+        Watch a directory created under the root and return the files that
+        were written to it before the watch was in place
+        '''
+        found = []
+        for root, dirnames, filenames in os.walk(path):
+            try:
+                self.add_watch(root)
+            except OSError as err:
+                LOGGER.error('Could not watch directory: %s', err)
+            dirnames[:] = self.prune(root, dirnames)
+            found.extend(os.path.join(root, name) for name in filenames)
+        return found
+
+    def close(self):
+        '''
+        Release the inotify file descriptor
+        '''
+        os.close(self.fd)
+
+
+def run_with_executor(coroutine, concurrency):
+    '''
+    Run a coroutine to completion on a new event loop whose default
+    executor has concurrency threads for the blocking filesystem calls
+    '''
+    loop = asyncio.new_event_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    loop.set_default_executor(executor)
+    try:
+        return loop.run_until_complete(coroutine)
+    finally:
+        executor.shutdown(wait=True)
+        loop.close()
+
+
+FIDEDUPERANGE = 0xc0189436
+FILE_DEDUPE_RANGE_DIFFERS = 1
+DEDUPE_RANGE = struct.Struct('QQHHI')
+DEDUPE_RANGE_INFO = struct.Struct('qQQiI')
+DEDUPE_CHUNK_SIZE = 16 * 1024 * 1024
+REFLINK_UNSUPPORTED = (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+                       errno.EXDEV, errno.ENOSYS)
+
+
+def reflink_file(bad, best):
+    '''
+    Make the file bad share its data extents with the file best
+
+    This uses the FIDEDUPERANGE ioctl supported by btrfs and xfs. The kernel
+    compares both ranges before sharing them, so bad is left untouched if
+    its content differs from best. Unlike a hard link, bad keeps its own
+    inode and metadata and stays independent of best when either is edited.
+
+    bad is opened read only, which the ioctl allows when the file is owned
+    or writable, so closing it does not report a write to watch mode.
+
+    :param Filename bad: the duplicate that will share the extents of best
+    :param Filename best: the file that was kept
+    :raises OSError: when the filesystem refuses to share the extents
+    '''
+    with open(best.path, 'rb') as source, open(bad.path, 'rb') as dest:
+        length = os.fstat(source.fileno()).st_size
+        if os.fstat(dest.fileno()).st_size != length:
+            raise OSError(errno.EINVAL, 'File sizes differ', bad.path)
+
+        offset = 0
+        while offset < length:
+            request = bytearray(DEDUPE_RANGE.size + DEDUPE_RANGE_INFO.size)
+            DEDUPE_RANGE.pack_into(request, 0, offset,
+                                   min(length - offset, DEDUPE_CHUNK_SIZE),
+                                   1, 0, 0)
+            DEDUPE_RANGE_INFO.pack_into(request, DEDUPE_RANGE.size,
+                                        dest.fileno(), offset, 0, 0, 0)
+            fcntl.ioctl(source.fileno(), FIDEDUPERANGE, request)
+            _, _, deduped, status, _ = DEDUPE_RANGE_INFO.unpack_from(
+                request, DEDUPE_RANGE.size)
+
+            if status == FILE_DEDUPE_RANGE_DIFFERS:
+                raise OSError(errno.EIO, 'File contents differ', bad.path)
+            elif status < 0:
+                raise OSError(-status, os.strerror(-status), bad.path)
+            elif deduped == 0:
+                raise OSError(errno.EIO, 'No extents were shared', bad.path)
+            offset += deduped
+
+
+class DirectoryHandles():
+    '''
+    Keep the directories of files being removed open and address the files
+    by name within them
+
+    Passing a full path makes the kernel resolve every directory above the
+    file again, while a name is looked up in the open directory alone. The
+    least recently used directory is closed once more than limit are open.
+    The methods take full paths like their counterparts in os.
+
+    :param bool fsync: fsync each changed directory once when it is closed
+    :param int limit: the number of directories to keep open
+    '''
+    supported = {os.stat, os.unlink, os.link, os.rename} <= os.supports_dir_fd
+
+    def __init__(self, fsync=False, limit=256):
+        self.fsync = fsync
+        self.limit = limit
+        self.fds = OrderedDict()
+        self.changed = set()
+
+    def locate(self, path):
+        '''
+        return the descriptor of the directory holding the path and the name
+        of the file within it, or None and the path when the directory can
+        not be opened
+        '''
+        if not self.supported:
+            return None, path
+        directory, name = os.path.split(path)
+        directory = directory or os.curdir
+        if directory in self.fds:
+            self.fds.move_to_end(directory)
+            return self.fds[directory], name
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError as err:
+            LOGGER.debug('Could not open directory %s: %s', directory, err)
+            return None, path
+        self.fds[directory] = fd
+        if len(self.fds) > self.limit:
+            self.release(self.fds.popitem(last=False)[1])
+        return fd, name
+
+    def stat(self, path):
+        '''
+        return the stat of the file, following symbolic links
+        '''
+        fd, name = self.locate(path)
+        return os.stat(name, dir_fd=fd)
+
+    def samefile(self, path1, path2):
+        '''
+        return whether both paths are the same file or hard links of it
+        '''
+        return os.path.samestat(self.stat(path1), self.stat(path2))
+
+    def remove(self, path):
+        '''
+        remove the file
+        '''
+        fd, name = self.locate(path)
+        os.unlink(name, dir_fd=fd)
+        self.changed.add(fd)
+
+    def link(self, source, dest):
+        '''
+        make dest a hard link of source
+        '''
+        source_fd, source_name = self.locate(source)
+        dest_fd, dest_name = self.locate(dest)
+        os.link(source_name, dest_name, src_dir_fd=source_fd,
+                dst_dir_fd=dest_fd)
+        self.changed.add(dest_fd)
+
+    def replace(self, source, dest):
+        '''
+        rename source over dest
+        '''
+        source_fd, source_name = self.locate(source)
+        dest_fd, dest_name = self.locate(dest)
+        os.replace(source_name, dest_name, src_dir_fd=source_fd,
+                   dst_dir_fd=dest_fd)
+        self.changed.update((source_fd, dest_fd))
+
+    def release(self, fd):
+        '''
+        close the directory, syncing it first if files in it were changed
         '''
-        return functools.reduce(self.pick_older_file, clump)
+        try:
+            if self.fsync and fd in self.changed:
+                os.fsync(fd)
+        except OSError as err:
+            LOGGER.error('Directory sync error: %s', err)
+        finally:
+            self.changed.discard(fd)
+            os.close(fd)
 
-    @staticmethod
-    def pick_older_file(item_a, item_b):
+    def close(self):
         '''
-        Finds the oldest modification time
+        close every directory left open
         '''
-        if os.stat(item_a.path).st_mtime < os.stat(item_b.path).st_mtime:
-            return item_a
-        else:
-            return item_b
+        while self.fds:
+            self.release(self.fds.popitem()[1])
 
 
-class InteractivePicker(ShortestPicker):
+class Quarantine():
     '''
-    This class allows the user to interactively select which file is
-    selected to be preserved.
+    Trash tree that duplicates are renamed into rather than being removed
+
+    The files of each run are kept under a directory named for the time it
+    started, at their absolute path below it, so they can be moved back by
+    hand and are purged one run at a time, oldest first. A rename does not
+    touch the data, but the trash tree must be on the filesystem of the
+    files.
+
+    :param str root: the directory holding the trash tree
+    :param float started: the time of the run, now by default
     '''
+    BATCH_FORMAT = '%Y%m%dT%H%M%S'
 
-    def __init__(self, *args, **kwargs):
-        super(InteractivePicker, self).__init__(*args, **kwargs)
+    def __init__(self, root, started=None):
+        self.root = root
+        self.batch = os.path.join(root, time.strftime(
+            self.BATCH_FORMAT, time.localtime(started)))
 
-    def sift(self, clump):
+    @classmethod
+    def is_batch(cls, name):
         '''
-        Asks user for best after giving recommendation
+        return whether the name is the one of a directory holding a run
         '''
-        default, rest = super(InteractivePicker, self).sift(clump)
-        files = [default] + list(rest)
-        for num, file in enumerate(files):
-            if file == default:
-                print("{0}. {1} (default)".format(num, file.name))
-            else:
-                print("{0}. {1}".format(num, file.name))
+        try:
+            time.strptime(name, cls.BATCH_FORMAT)
+        except ValueError:
+            return False
+        return True
+
+    def target(self, path):
+        '''
+        return the path of the file within the trash tree
+        '''
+        return os.path.join(self.batch, os.path.abspath(path).lstrip(os.sep))
+
+    def move(self, path, directories=None):
+        '''
+        rename the file into the trash tree, adding a suffix to the name when
+        a file was already moved to the same place
 
+        :param str path: the file to move
+        :param DirectoryHandles directories: the open directories of the files
+        :returns: the path the file was moved to
+        :raises OSError: when the file can not be renamed into the tree
+        '''
+        files = os if directories is None else directories
+        target = self.target(path)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if os.path.lexists(target):
+            target += '.{0}'.format(uuid.uuid4().hex[:8])
         try:
-            while True:
-                result = input('Pick which file to keep (^C to skip): ')
-                if result == '':
-                    best = default
-                    break
-                elif result.isdigit() and int(result) in range(len(files)):
-                    best = files[int(result)]
-                    break
-                elif result in [file.name for file in files]:
-                    best = [file for file in files if file.name == result][0]
-                    break
-            rest = set(files) - {best}
-            LOGGER.warning('User picked %s over %s', best, default)
+            files.replace(path, target)
+        except OSError as err:
+            if err.errno != errno.EXDEV:
+                raise
+            raise OSError(errno.EXDEV, 'Quarantine is on another filesystem',
+                          path)
+        return target
 
-        except KeyboardInterrupt:
-            print('\nSkipped')
-            LOGGER.warning('User skipped in interactive mode')
-            best = default
-            rest = {}
 
-        return best, rest
+def make_quarantine(**options):
+    '''
+    Return the trash tree for the quarantine option, which is either its
+    directory or a trash tree made earlier in the run
+
+    :rtype: Quarantine or None
+    '''
+    quarantine = options.get('quarantine')
+    if quarantine and not isinstance(quarantine, Quarantine):
+        quarantine = Quarantine(quarantine)
+    return quarantine or None
+
+
+def replace_with_link(bad, best, directories=None):
+    '''
+    Replace the file bad with a hard link to the file best
+
+    The link is made under a temporary name in the directory of bad and then
+    renamed over it, so bad is never missing for readers and is left as it
+    was if the link can not be made. Nothing is done when bad already is a
+    hard link of best, renaming a link over its own inode does nothing and
+    would leave the temporary name behind.
+
+    :param Filename bad: the duplicate to replace
+    :param Filename best: the file that was kept
+    :param DirectoryHandles directories: the open directories of the files
+    :raises OSError: when the link can not be made or renamed
+    '''
+    files = os if directories is None else directories
+    samefile = os.path.samefile if directories is None else \
+        directories.samefile
+    if samefile(best.path, bad.path):
+        return
+    directory, name = os.path.split(bad.path)
+    temp_path = os.path.join(directory, '.{0}.{1}.twintrim'.format(
+        name, uuid.uuid4().hex[:8]))
+    files.link(best.path, temp_path)
+    try:
+        files.replace(temp_path, bad.path)
+    except OSError:
+        files.remove(temp_path)
+        raise
 
 
-def remove_file(bad, best, **options):
+def remove_file(bad, best, directories=None, **options):
     '''
     Preform the deletion of file that has been identified as a duplicate
 
     :param Filename bad: the file to be deleted
     :param Filename best: the file that was kept instead of 'bad'
+    :param DirectoryHandles directories: the open directories of the files,
+                                         full paths are used without them
     :param bool remove_links: causes function to check if best and bad
                              are hardlinks before deletion
     :param bool no_action: show what files would have been deleted.
-    :param bool make_links: create a hard link to best from path bad,
-                           after bad is deleted
+    :param bool make_links: atomically replace bad with a hard link to best
+    :param bool reflink: share the data extents of best with bad rather
+                         than deleting bad
+    :param quarantine: rename bad into the trash tree rather than deleting it
+    :type quarantine: str or Quarantine
     :raises OSError: when error occurs modifing the file
     '''
-    if not options['remove_links'] and os.path.samefile(best.path, bad.path):
+    files = os if directories is None else directories
+    samefile = os.path.samefile if directories is None else \
+        directories.samefile
+    if not options.get('remove_links', False) and samefile(
+            best.path, bad.path):
         LOGGER.info('hard link skipped %s', bad.path)
-    elif options['no_action']:
+    elif options.get('no_action', False):
         print('{0} would have been deleted'.format(bad.path))
         LOGGER.info('%s would have been deleted', bad.path)
+    elif options.get('reflink', False):
+        try:
+            reflink_file(bad, best)
+        except OSError as err:
+            if err.errno not in REFLINK_UNSUPPORTED:
+                raise
+            LOGGER.warning('reflink not supported, %s was kept: %s',
+                           bad.path, err)
+        else:
+            LOGGER.info('reflink created: %s', bad.path)
+    elif options.get('make_links', False):
+        replace_with_link(bad, best, directories)
+        LOGGER.info('hard link created: %s', bad.path)
+    elif options.get('quarantine'):
+        target = make_quarantine(**options).move(bad.path, directories)
+        LOGGER.info('%s was quarantined to %s', bad.path, target)
     else:
-        os.remove(bad.path)
+        files.remove(bad.path)
         LOGGER.info('%s was deleted', bad.path)
-        if options.get('make_links', False):
-            LOGGER.info('hard link created: %s', bad.path)
-            os.link(best.path, bad.path)
 
 
 def remove_by_clump(dict_of_names, picker, **options):
@@ -342,71 +2279,814 @@ def remove_by_clump(dict_of_names, picker, **options):
     This function first groups the files by checksum, and then removes all
     but one copy of the file.
 
+    The copies of each clump are removed directory by directory, through
+    directories that are opened once for the whole run.
+
     :param list_of_names: list of objects to remove
     :type list_of_names:  iterable[Filename]
     :param bool interactive: allow the user to pick which file to keep
     :param str hash_name: the name of the hash function used to compute the
                          checksum
+    :param bool fsync_dirs: fsync each changed directory once at the end
+    :param str quarantine: rename the copies into a trash tree in this
+                           directory, shared by the whole run
+    :returns: the file kept for each key
+    :rtype: dict
+    '''
+    kept = {}
+    directories = DirectoryHandles(options.get('fsync_dirs', False))
+    options['quarantine'] = make_quarantine(**options)
+    try:
+        for file in dict_of_names:
+            if len(dict_of_names[file]) > 1:
+                LOGGER.info("Investigating duplicate key %s", file)
+                LOGGER.debug(
+                    "Values for key %s are %s", file,
+                    ', '.join([item.name for item in dict_of_names[file]]))
+                best, rest = picker.sift(dict_of_names[file])
+
+                for bad in sorted(rest, key=lambda item: (
+                        os.path.dirname(item.path), item.path)):
+                    try:
+                        remove_file(bad, best, directories, **options)
+                    except OSError as err:
+                        LOGGER.error('File deletion error: %s', err)
+                LOGGER.info('%s was kept as only copy', best.path)
+                kept[file] = best
+
+            else:
+                LOGGER.debug(
+                    'Skipping non duplicate checksum %s for key %s', file,
+                    ', '.join([item.name for item in dict_of_names[file]]))
+                kept.update((file, item) for item in dict_of_names[file])
+    finally:
+        directories.close()
+    return kept
 
+
+def remove_by_reference(dict_of_names, index, **options):
     '''
-    for file in dict_of_names:
-        if len(dict_of_names[file]) > 1:
-            LOGGER.info("Investigating duplicate key %s", file)
-            LOGGER.debug(
-                "Values for key %s are %s", file,
-                ', '.join([item.name for item in dict_of_names[file]]))
-            best, rest = picker.sift(dict_of_names[file])
+    Remove every file whose checksum is found in the reference index
 
-            for bad in rest:
-                try:
-                    remove_file(bad, best, **options)
-                except OSError as err:
-                    LOGGER.error('File deletion error: %s', err)
-            LOGGER.info('%s was kept as only copy', best.path)
+    :param dict dict_of_names: clumps whose keys end with the checksums
+    :param ReferenceIndex index: checksums of the reference library
+    :param bool no_action: show what files would have been deleted.
+    :param quarantine: rename the files into the trash tree instead
+    :type quarantine: str or Quarantine
+    :returns: the clumps whose checksum is not in the index
+    :rtype: dict
+    '''
+    remaining = {}
+    quarantine = make_quarantine(**options)
+    for key, clump in dict_of_names.items():
+        digest = key_digest(key, options['hash_function'])
+        if bytes.fromhex(digest) not in index:
+            remaining[key] = clump
+            continue
+
+        LOGGER.info('Checksum %s found in reference index', digest)
+        for bad in clump:
+            if options.get('no_action', False):
+                print('{0} would have been deleted'.format(bad.path))
+                LOGGER.info('%s would have been deleted', bad.path)
+                continue
+            try:
+                if quarantine is not None:
+                    LOGGER.info('%s was quarantined to %s', bad.path,
+                                quarantine.move(bad.path))
+                else:
+                    os.remove(bad.path)
+                    LOGGER.info('%s was deleted', bad.path)
+            except OSError as err:
+                LOGGER.error('File deletion error: %s', err)
+    return remaining
+
+
+def purge_quarantine(path, **options):
+    '''
+    Delete the files of the trash trees, the oldest run first, and the
+    directories left empty
 
-        else:
-            LOGGER.debug(
-                'Skipping non duplicate checksum %s for key %s', file,
-                ', '.join([item.name for item in dict_of_names[file]]))
+    Only directories named for the time of a run are purged, anything else
+    is logged and left alone, so a mistyped path loses no data.
+
+    :param path: the quarantine directory or directories
+    :type path: str or list[str]
+    :param int purge_rate: the bytes to delete each second at most
+    :param bool no_action: show what files would have been deleted.
+    :returns: the number of bytes deleted
+    :rtype: int
+    '''
+    rate = options.get('purge_rate')
+    started = time.monotonic()
+    purged = 0
+    for root in list_root_paths(path):
+        try:
+            entries = list(os.scandir(root))
+        except OSError as err:
+            LOGGER.error('Directory listing error: %s', err)
+            continue
+        batches = []
+        for entry in entries:
+            if (entry.is_dir(follow_symlinks=False) and
+                    Quarantine.is_batch(entry.name)):
+                batches.append(entry.path)
+            else:
+                LOGGER.warning('%s is not a quarantine run, skipped',
+                               entry.path)
+        for batch in sorted(batches):
+            LOGGER.info('Purging quarantine %s', batch)
+            for dirpath, _, filenames in os.walk(batch, topdown=False):
+                for name in sorted(filenames):
+                    file_path = os.path.join(dirpath, name)
+                    if options.get('no_action', False):
+                        print('{0} would have been deleted'.format(file_path))
+                        continue
+                    try:
+                        size = os.lstat(file_path).st_size
+                        os.remove(file_path)
+                    except OSError as err:
+                        LOGGER.error('File deletion error: %s', err)
+                        continue
+                    LOGGER.info('%s was deleted', file_path)
+                    purged += size
+                    if rate:
+                        delay = purged / rate - (time.monotonic() - started)
+                        if delay > 0:
+                            time.sleep(delay)
+                if not options.get('no_action', False):
+                    try:
+                        os.rmdir(dirpath)
+                    except OSError as err:
+                        LOGGER.debug('Directory kept: %s', err)
+    return purged
+
+
+def hash_trees(root_path, file_digests, hash_name):
+    '''
+    Compute a merkle checksum for every directory under the paths from the
+    names and checksums of its files and child directories
+
+    Only directories are listed again, no file is read. A directory holding
+    a file without a checksum, a symbolic link, or anything that was not
+    walked, gets no checksum and neither do the directories above it.
+
+    :param root_path: the path or paths that were walked
+    :type root_path: str or list[str]
+    :param dict file_digests: binary checksum of each file path
+    :param str hash_name: the hash function to combine the checksums with
+    :returns: checksum and number of files of each directory
+    :rtype: dict
+    '''
+    listings = []
+    listed = set()
+    for path in list_root_paths(root_path):
+        pending = [path]
+        while pending:
+            path = pending.pop()
+            if path in listed:
+                continue
+            listed.add(path)
+            entries = []
+            try:
+                entries = [(entry.name, entry.path,
+                            entry.is_dir() and not entry.is_symlink(),
+                            entry.is_file() and not entry.is_symlink())
+                           for entry in list(os.scandir(path))]
+            except OSError as err:
+                LOGGER.error('Directory listing error: %s', err)
+                entries = None
+            listings.append((path, entries))
+            pending.extend(entry[1] for entry in entries or []
+                           if entry[2])
+
+    trees = {}
+    for path, entries in reversed(listings):
+        if entries is None:
+            trees[path] = (None, 0)
+            continue
+        checksum = hashlib.new(hash_name)
+        count = 0
+        for name, child, walked, is_file in sorted(entries):
+            if walked:
+                digest, child_count = trees.get(child, (None, 0))
+                kind = b'd'
+            elif is_file:
+                digest, child_count = file_digests.get(child), 1
+                kind = b'f'
+            else:
+                digest = None
+            if digest is None:
+                checksum = None
+                break
+            checksum.update(kind + os.fsencode(name) + b'\0' + digest)
+            count += child_count
+        trees[path] = (checksum.digest() if checksum else None, count)
+    return trees
 
 
-def walk_path(path, **options):
+def remove_by_tree(root_path, dict_of_names, picker, **options):
     '''
-    This function steps through the directory structure and identifies
-    groups for more in depth investigation.
+    Remove every directory tree that is a copy of another one as a whole,
+    shallowest trees first
+
+    The checksums of the trees are computed before anything is removed, so
+    a tree holding a tree that was removed is no longer compared.
+
+    :param root_path: the path or paths that were walked
+    :type root_path: str or list[str]
+    :param dict dict_of_names: clumps whose keys end with the checksums
+    :param Picker picker: picks the tree to keep
+    :param bool no_action: show what trees would have been deleted.
+    :param quarantine: rename the trees into the trash tree instead
+    :type quarantine: str or Quarantine
+    :returns: the clumps without the files of the removed trees
+    :rtype: dict
+    '''
+    file_digests = {}
+    for key, clump in dict_of_names.items():
+        for filename in clump:
+            file_digests[filename.path] = bytes.fromhex(
+                key_digest(key, options['hash_function']))
+    trees = hash_trees(root_path, file_digests,
+                       list_hash_names(options['hash_function'])[0])
+
+    groups = defaultdict(list)
+    for path, (digest, count) in trees.items():
+        if digest is not None and count:
+            groups[digest].append(path)
+
+    removed = set()
+    changed = set()
+    quarantine = make_quarantine(**options)
+
+    def is_removed(path):
+        while path not in removed:
+            parent = os.path.dirname(path)
+            if parent == path:
+                return False
+            path = parent
+        return True
+
+    def mark_removed(path):
+        removed.add(path)
+        parent = os.path.dirname(path)
+        while parent != path:
+            changed.add(parent)
+            path, parent = parent, os.path.dirname(parent)
+
+    def depth(paths):
+        return (min(path.count(os.sep) for path in paths), sorted(paths))
+
+    for paths in sorted(groups.values(), key=depth):
+        paths = [path for path in paths
+                 if not is_removed(path) and path not in changed]
+        if len(paths) < 2:
+            continue
+        clump = {PathClumper.create_filename_from_string(
+            os.path.basename(path), os.path.dirname(path)) for path in paths}
+        best, rest = picker.sift(clump)
+        for bad in rest:
+            if options.get('no_action', False):
+                print('{0} would have been deleted'.format(bad.path))
+                LOGGER.info('%s would have been deleted', bad.path)
+                mark_removed(bad.path)
+                continue
+            try:
+                if quarantine is not None:
+                    LOGGER.info('%s was quarantined to %s', bad.path,
+                                quarantine.move(bad.path))
+                else:
+                    shutil.rmtree(bad.path)
+                    LOGGER.info('%s was deleted', bad.path)
+                mark_removed(bad.path)
+            except OSError as err:
+                LOGGER.error('Directory deletion error: %s', err)
+        LOGGER.info('%s was kept as only copy', best.path)
+
+    remaining = {}
+    for key, clump in dict_of_names.items():
+        clump = {filename for filename in clump
+                 if not is_removed(filename.path)}
+        if clump:
+            remaining[key] = clump
+    return remaining
+
+
+def prescreen_by_bloom(dict_of_names, bloom_filter):
+    '''
+    Drop every file that is alone in its clump and whose key is missing from
+    the bloom filter: it can not be a duplicate of another file or of the
+    library, so it does not need to be hashed
+
+    :param dict dict_of_names: clumps of files to be hashed
+    :param BloomFilter bloom_filter: keys of the files in the library
+    :returns: the clumps that still need to be hashed
+    :rtype: dict
+    '''
+    screened = {}
+    skipped = 0
+    for key, clump in dict_of_names.items():
+        clump = list(clump)
+        if len(clump) == 1:
+            try:
+                bloom_key = BloomFilter.make_key(clump[0].path,
+                                                 bloom_filter.partial_size)
+            except OSError as err:
+                LOGGER.error('Bloom filter key error: %s', err)
+                continue
+            if bloom_key not in bloom_filter:
+                LOGGER.debug('%s is not in bloom filter', clump[0].path)
+                skipped += 1
+                continue
+        screened[key] = clump
+    LOGGER.info('Bloom filter skipped hashing %d files', skipped)
+    return screened
 
-    :param str path: the path to search for files and begin processing
+
+def make_picker(**options):
+    '''
+    Select the picker used to decide which file of a clump is kept
     '''
     if options.get('interactive', False):
         LOGGER.info('Interactive mode')
-        picker = InteractivePicker()
+        return InteractivePicker()
     elif options.get('keep_oldest', False):
         LOGGER.info('Keep oldest mode')
-        picker = ModificationPicker()
+        return ModificationPicker()
     else:
         LOGGER.info('Default to shortest filename mode')
-        picker = ShortestPicker()
+        return ShortestPicker()
+
+
+def make_walk_filter(**options):
+    '''
+    Make the walk filter for the exclude globs and size limits
+
+    :param list[str] exclude: globs of names to skip
+    :param int min_size: skip files smaller than this
+    :param int max_size: skip files larger than this
+    :param str quarantine: directory of quarantined files, never walked
+    :rtype: WalkFilter
+    '''
+    skip_dirs = [options['quarantine']] if options.get('quarantine') else []
+    return WalkFilter(options.get('exclude'), options.get('min_size'),
+                      options.get('max_size'), skip_dirs)
+
+
+def keeps_singletons(**options):
+    '''
+    Return whether files without a duplicate are still needed once clumped:
+    reference indexes, tree mode, scan indexes and watch mode look at every
+    file, otherwise such files are dropped before they are hashed
+    '''
+    return any(options.get(name) for name in ('reference', 'build_reference',
+                                              'trees', 'save_index', 'watch'))
+
+
+PIPELINE_STAGES = ('regex', 'size', 'partial', 'hash')
+
+GROUP_BACKENDS = ('python', 'numpy')
+
+
+def group_with_numpy(entries):
+    '''
+    Return the items of each group number and clump by sorting arrays
+    instead of hashing every clump
+
+    Each column of the clumps is coded to integers with numpy.unique, then
+    the rows of group numbers and codes are sorted and counted by
+    numpy.unique so the items of a run of equal rows form one group.
+
+    :param entries: the group number, clump and item of every file
+    :type entries: list[tuple]
+    :rtype: dict
+    '''
+    groups, clumps, items = zip(*entries)
+    columns = [numpy.asarray(groups, dtype=numpy.int64)]
+    for column in zip(*clumps):
+        columns.append(numpy.unique(numpy.asarray(column),
+                                    return_inverse=True)[1])
+    rows = numpy.stack(columns, axis=1)
+    _, first, inverse, counts = numpy.unique(rows, axis=0,
+                                             return_index=True,
+                                             return_inverse=True,
+                                             return_counts=True)
+    order = numpy.argsort(inverse.ravel(), kind='stable')
+    runs = numpy.split(order, numpy.cumsum(counts)[:-1])
+    labelled = {}
+    for start, run in zip(first, runs):
+        labelled[groups[start], clumps[start]] = [items[num] for num in run]
+    return labelled
+
+StageStats = namedtuple('StageStats',
+                        ['name', 'files_in', 'files_out', 'seconds'])
+
+
+def check_pipeline(text):
+    '''
+    Check a comma separated list of pipeline stages, the checksum stage can
+    only come last
+
+    :returns: the stages to run before the checksum stage
+    :rtype: list[str]
+    :raises argparse.ArgumentTypeError: when a stage is not understood
+    '''
+    names = text.split(',')
+    for name in names:
+        if name not in PIPELINE_STAGES:
+            raise argparse.ArgumentTypeError(
+                'invalid stage: {0}'.format(name))
+    if 'hash' in names[:-1]:
+        raise argparse.ArgumentTypeError('hash stage must come last')
+    return [name for name in names if name != 'hash']
+
+
+def make_stage(name, **options):
+    '''
+    Make the clumper of a stage that runs before the checksum stage
+    '''
+    if name == 'regex':
+        return RegexClumper(options['regex_pattern'])
+    elif name == 'size':
+        return SizeClumper()
+    return PartialClumper()
+
+
+def pipeline_stages(**options):
+    '''
+    Return the stages to run before the checksum stage, either as set by
+    the pipeline option or ordered by rank
 
-    checksum_clumper = HashClumper(options['hash_function'])
-    filepath_clumper = PathClumper(path, options['recursive'])
+    :rtype: list[Clumper]
+    '''
+    if options.get('pipeline') is not None:
+        return [(name, make_stage(name, **options))
+                for name in options['pipeline']]
+    names = ['size'] if options['skip_regex'] else ['regex', 'size']
+    stages = [(name, make_stage(name, **options)) for name in names]
+    return sorted(stages, key=lambda stage: stage[1].rank())
+
+
+def run_stage(name, clumper, partition, stats):
+    '''
+    Refine the partition with the clumper, counting the files it keeps
+    '''
+    files_in = partition.count()
+    started = time.monotonic()
+    clumper.refine(partition)
+    stats.append(StageStats(name, files_in, partition.count(),
+                            time.monotonic() - started))
+
+
+def print_stats(stats):
+    '''
+    Print the number of files each stage was given and kept
+    '''
+    print('{0:<10}{1:>10}{2:>11}{3:>8}{4:>10}'.format(
+        'stage', 'files in', 'files out', 'kept', 'seconds'))
+    for stage in stats:
+        kept = stage.files_out / stage.files_in if stage.files_in else 1
+        print('{0:<10}{1:>10}{2:>11}{3:>8.1%}{4:>10.2f}'.format(
+            stage.name, stage.files_in, stage.files_out, kept,
+            stage.seconds))
+
+
+def clump_by_content(clumps, progress=None, bloom_filter=None, **options):
+    '''
+    Refine clumps grouped by path using the stages of the pipeline and then
+    the checksum stage
+
+    :param dict clumps: files grouped by path
+    :param Checkpoint progress: where to save and reuse checksums
+    :param BloomFilter bloom_filter: skip hashing files missing from it
+    :param bool stats: print how many files each stage kept
+    :returns: files grouped by path, regex groups and checksum
+    :rtype: dict
+    '''
+    partition = Partition(clumps, keeps_singletons(**options))
+    stats = []
+    backend = options.get('group_backend', 'python')
+    for name, clumper in pipeline_stages(**options):
+        clumper.backend = backend
+        run_stage(name, clumper, partition, stats)
+
+    if bloom_filter is not None:
+        partition.groups = prescreen_by_bloom(partition.groups, bloom_filter)
+
+    chunk_cache = None
+    if options.get('chunk_cache'):
+        chunk_cache = ChunkCache(options['chunk_cache'],
+                                 options['hash_function'],
+                                 options['tree_hash'])
+        chunk_cache.load()
+
+    if options.get('async_io', False):
+        checksum_clumper = AsyncHashClumper(options['hash_function'],
+                                            options.get('concurrency', 8),
+                                            progress,
+                                            options.get('read_empty', False),
+                                            options.get('tree_hash'),
+                                            chunk_cache)
+    else:
+        checksum_clumper = HashClumper(options['hash_function'], progress,
+                                       options.get('read_empty', False),
+                                       options.get('tree_hash'), chunk_cache)
+    checksum_clumper.backend = backend
+    try:
+        run_stage('hash', checksum_clumper, partition, stats)
+    finally:
+        if chunk_cache is not None:
+            chunk_cache.save()
+
+    if options.get('stats', False):
+        print_stats(stats)
+    return partition.dump()
+
+
+def walk_path(path, **options):
+    '''
+    This function steps through the directory structure and identifies
+    groups for more in depth investigation.
+
+    All the paths share one walk, one set of clumpers and one removal pass.
+
+    :param path: the path or paths to search for files and begin processing
+    :type path: str or list[str]
+    :param str checkpoint: file to save progress to at regular intervals
+    :param bool resume: reuse the progress saved in the checkpoint file
+    :param str quarantine: directory of the trash tree the removed files of
+                           the run are renamed into
+    :returns: the file kept for each key
+    :rtype: dict
+    '''
+    picker = make_picker(**options)
+
+    checkpoint = None
+    if options.get('checkpoint'):
+        hash_name = options['hash_function']
+        if options.get('tree_hash'):
+            hash_name += ':tree={0}'.format(options['tree_hash'])
+        checkpoint = Checkpoint(options['checkpoint'], hash_name)
+        if options.get('resume', False):
+            checkpoint.load()
+
+    walk_filter = make_walk_filter(**options)
+    if options.get('async_io', False):
+        LOGGER.info('Asynchronous io mode')
+        filepath_clumper = AsyncPathClumper(path, options['recursive'],
+                                            options.get('concurrency', 8),
+                                            checkpoint, walk_filter)
+    else:
+        filepath_clumper = PathClumper(path, options['recursive'],
+                                       checkpoint, walk_filter)
+
+    bloom_filter = None
+    if options.get('bloom'):
+        bloom_filter = BloomFilter(options['bloom'])
+
+    try:
+        clumps = clump_by_content(filepath_clumper.dump_clumps(),
+                                  checkpoint, bloom_filter, **options)
+    except KeyboardInterrupt:
+        if checkpoint is not None:
+            checkpoint.save()
+            LOGGER.warning('Progress saved to %s', checkpoint.path)
+        raise
+    finally:
+        if bloom_filter is not None:
+            bloom_filter.close()
+
+    if options.get('save_index'):
+        save_index(clumps, options['save_index'], options['hash_function'])
+
+    options['quarantine'] = make_quarantine(**options)
+    if options.get('trees'):
+        clumps = remove_by_tree(path, clumps, picker, **options)
+
+    if options.get('reference'):
+        index = open_index(options['reference'])
+        try:
+            clumps = remove_by_reference(clumps, index, **options)
+        finally:
+            index.close()
+
+    kept = remove_by_clump(clumps, picker, **options)
+    if checkpoint is not None:
+        checkpoint.remove()
+    return kept
+
+
+def save_index(dict_of_names, path, hash_name):
+    '''
+    Write every hashed file to a scan index
+
+    :param dict dict_of_names: clumps whose keys end with the checksums
+    :param str path: the file to write the index to
+    :param str hash_name: the hash functions that made the checksums, the
+                          index keeps the checksum of the first
+    '''
+    entries = []
+    for key, clump in dict_of_names.items():
+        digest = bytes.fromhex(key_digest(key, hash_name))
+        for filename in clump:
+            try:
+                entries.append((filename.path, os.stat(filename.path),
+                                digest))
+            except OSError as err:
+                LOGGER.error('Scan index stat error: %s', err)
+    count = ScanIndex.write(path, list_hash_names(hash_name)[0], entries)
+    LOGGER.info('Wrote %d files to scan index %s', count, path)
+
+
+def build_reference(path, **options):
+    '''
+    Hash every file under the path and write the checksums to a reference
+    index, without removing any files
+
+    :param path: the path or paths of the reference library
+    :type path: str or list[str]
+    :param str build_reference: the file to write the index to
+    '''
+    walk_filter = make_walk_filter(**options)
+    if options.get('async_io', False):
+        filepath_clumper = AsyncPathClumper(path, options['recursive'],
+                                            options.get('concurrency', 8),
+                                            walk_filter=walk_filter)
+    else:
+        filepath_clumper = PathClumper(path, options['recursive'],
+                                       walk_filter=walk_filter)
+
+    clumps = clump_by_content(filepath_clumper.dump_clumps(),
+                              **dict(options, skip_regex=True))
+    count = ReferenceIndex.write(
+        options['build_reference'],
+        list_hash_names(options['hash_function'])[0],
+        (bytes.fromhex(key_digest(key, options['hash_function']))
+         for key, clump in clumps.items() if clump))
+    LOGGER.info('Wrote %d checksums to %s', count, options['build_reference'])
+
+
+def build_bloom(path, **options):
+    '''
+    Write a bloom filter of the size and first bytes of every file under the
+    path, without removing any files
+
+    :param path: the path or paths of the library
+    :type path: str or list[str]
+    :param str build_bloom: the file to write the filter to
+    '''
+    keys = []
+    clumps = PathClumper(path, options['recursive'],
+                         walk_filter=make_walk_filter(**options)).dump_clumps()
+    for clump in clumps.values():
+        for filename in clump:
+            try:
+                keys.append(BloomFilter.make_key(filename.path))
+            except OSError as err:
+                LOGGER.error('Bloom filter key error: %s', err)
+    num_bits = BloomFilter.write(options['build_bloom'], keys)
+    LOGGER.info('Wrote %d keys in %d bits to %s', len(keys), num_bits,
+                options['build_bloom'])
+
+
+def watch_path(path, watcher=None, **options):
+    '''
+    Trim the path once and then keep trimming files as they are written.
+
+    An index of the files kept by the first pass is held in memory, so each
+    new or modified file only has to be hashed itself before it is compared
+    against the file already kept under the same key. The watcher reports
+    None when events were lost, and the whole path is trimmed again.
+
+    :param path: the path or paths to watch for new files
+    :type path: str or list[str]
+    :param watcher: source of changed paths, defaults to an InotifyWatcher
+    :type watcher: InotifyWatcher
+    '''
+    options['watch'] = True
+    root_paths = list_root_paths(path)
+    walk_filter = make_walk_filter(**options)
+    if watcher is None:
+        watcher = InotifyWatcher(root_paths, options['recursive'],
+                                 walk_filter)
+    picker = make_picker(**options)
+
+    index = walk_path(path, **options)
+    keys = {best.path: key for key, best in index.items()}
+    LOGGER.info('Watching %s for new files', ', '.join(root_paths))
+
+    try:
+        for filepath in watcher.events():
+            if filepath is None:
+                LOGGER.info('Scanning %s again', ', '.join(root_paths))
+                index = walk_path(path, **options)
+                keys = {best.path: key for key, best in index.items()}
+                continue
+            if not walk_filter.allows(filepath, root_paths):
+                LOGGER.debug('Skipping excluded file %s', filepath)
+                continue
+            root, name = os.path.split(filepath)
+            filename = PathClumper.create_filename_from_string(name, root)
+
+            stale_key = keys.pop(filepath, None)
+            if stale_key is not None:
+                index.pop(stale_key, None)
+
+            clumps = clump_by_content(
+                {PathClumper.make_clump(root): [filename]}, **options)
+            for key, clump in clumps.items():
+                if key in index and os.path.exists(index[key].path):
+                    clump.add(index[key])
+                kept = remove_by_clump({key: clump}, picker, **options)
+                for kept_key, best in kept.items():
+                    if kept_key in index:
+                        keys.pop(index[kept_key].path, None)
+                    index[kept_key] = best
+                    keys[best.path] = kept_key
+    except KeyboardInterrupt:
+        LOGGER.warning('Stopped watching %s', ', '.join(root_paths))
+    finally:
+        watcher.close()
+
+
+class BatchStreamHandler(logging.StreamHandler):
+    '''
+    StreamHandler keeping formatted records until it is flushed, so a burst
+    of records is written to the stream at once
+
+    :param stream: the stream to write to, stderr by default
+    :param int capacity: the number of records to keep before writing
+    '''
+
+    def __init__(self, stream=None, capacity=1024):
+        super(BatchStreamHandler, self).__init__(stream)
+        self.capacity = capacity
+        self.buffer = []
+
+    def emit(self, record):
+        '''
+        Keep the formatted record, writing the batch once it is full
+        '''
+        try:
+            self.buffer.append(self.format(record) + self.terminator)
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+        if len(self.buffer) >= self.capacity:
+            self.flush()
+
+    def flush(self):
+        '''
+        Write the records kept so far in a single write
+        '''
+        self.acquire()
+        try:
+            if self.buffer and self.stream:
+                self.stream.write(''.join(self.buffer))
+            self.buffer = []
+            super(BatchStreamHandler, self).flush()
+        finally:
+            self.release()
+
+
+class BatchQueueListener(logging.handlers.QueueListener):
+    '''
+    QueueListener flushing its handlers whenever the queue runs empty
 
-    clumps = filepath_clumper.dump_clumps()
+    Records logged while files are removed are only put on a queue, the
+    listener thread hands them to batching handlers and writes the batch
+    once it has caught up.
+    '''
 
-    if not options['skip_regex']:
-        regex_clumper = RegexClumper(options['regex_pattern'])
-        clumps = regex_clumper.dump_clumps(clumps)
+    def dequeue(self, block):
+        '''
+        Return the next record, flushing the handlers before waiting
+        '''
+        try:
+            return self.queue.get_nowait()
+        except queue.Empty:
+            for handler in self.handlers:
+                handler.flush()
+            return self.queue.get(block)
 
-    clumps = checksum_clumper.dump_clumps(clumps)
-    remove_by_clump(clumps, picker, **options)
+    def stop(self):
+        '''
+        Handle the records left on the queue and write them out
+        '''
+        super(BatchQueueListener, self).stop()
+        for handler in self.handlers:
+            handler.flush()
 
 
 def main(args_param=None):
     '''
     The main function handles the parsing of arguments as well as the
-    initiation of the logging handlers.
+    initiation of the logging handlers. Records are put on a queue and
+    written in batches from a background thread, so logging does not hold
+    up removing files.
 
     positional arguments:
-      path                  path to check
+      path                  paths to check
 
     optional arguments:
       -h, --help            show this help message and exit
@@ -421,11 +3101,58 @@ def main(args_param=None):
                             set filename matching regex
       -c, --only-checksum   toggle searching by checksum rather than name first
       -i, --interactive     ask for file deletion interactively
-      --hash-function
-                            {'sha224', 'sha384', 'sha1', 'md5', 'sha512', 'sha256'}
-                            set hash function to use for checksums
+      --pipeline STAGE[,STAGE...]
+                            set order of stages before hashing, from regex,
+                            size and partial, regex is needed without -c
+      --stats               print how many files each stage kept
+      --group-backend {python,numpy}
+                            set how files are grouped by size and checksum,
+                            numpy sorts arrays for large scans
+      --hash-function NAME[,NAME...]
+                            set hash functions to use for checksums, files are
+                            grouped on the first
+      --tree-hash SIZE      hash files larger than size in ranges of size on
+                            every core, such as 1G
+      --chunk-cache CACHE   keep range checksums of tree hashed files in
+                            cache, so files that grew only have their new data
+                            read
       --make-link           create hard link rather than remove file
+      --quarantine DIR      move duplicates into a trash tree in dir, on the
+                            same filesystem, rather than remove them
+      --purge-quarantine    delete the quarantined files of the paths, oldest
+                            run first
+      --purge-rate SIZE     delete at most size each second when purging, such
+                            as 100M
+      --reflink             share data with kept file rather than remove
+                            file (btrfs and xfs only)
+      --fsync-dirs          sync each changed directory to disk once at the
+                            end
       --remove-links        remove hardlinks rather than skipping
+      --async-io            overlap directory listings and file reads, for
+                            high latency filesystems
+      --concurrency CONCURRENCY
+                            set number of files read at once with --async-io
+      --exclude GLOB        skip files and directories whose name matches the
+                            glob
+      --min-size SIZE       skip files smaller than size, such as 4K
+      --max-size SIZE       skip files larger than size, such as 2G
+      --read-empty          read empty files rather than trusting their size
+      --trees               remove duplicate directory trees as a whole
+      --reference INDEX     remove files whose content is in the reference
+                            index
+      --build-reference INDEX
+                            write reference index of files rather than remove
+                            files
+      --save-index INDEX    write scan results of hashed files to index
+      --bloom FILTER        skip hashing files missing from the bloom filter
+                            of the reference
+      --build-bloom FILTER  write bloom filter of files rather than remove
+                            files
+      --checkpoint CHECKPOINT
+                            save progress to file at regular intervals
+      --resume              skip work saved in the checkpoint file
+      --watch               keep running and trim new files as they are
+                            written (linux only)
     '''
     epilog = r'''
     examples:
@@ -449,14 +3176,14 @@ def main(args_param=None):
             examples/underscore/file__1.txt to be deleted
     '''
 
-    if sys.version_info < (3, 4):
-        sys.exit('This script currently only works with python 3.4 or greater')
+    if sys.version_info < (3, 5):
+        sys.exit('This script currently only works with python 3.5 or greater')
 
     parser = argparse.ArgumentParser(
         description='tool for removing duplicate files',
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog=textwrap.dedent(epilog))
-    parser.add_argument('path', help='path to check')
+    parser.add_argument('path', nargs='+', help='paths to check')
     parser.add_argument('-n',
                         '--no-action',
                         default=False,
@@ -501,28 +3228,236 @@ def main(args_param=None):
                         action='store_true',
                         help='keep file with oldest modification date')
 
+    parser.add_argument('--pipeline',
+                        metavar='STAGE[,STAGE...]',
+                        type=check_pipeline,
+                        help='set order of stages before hashing, from regex, '
+                        'size and partial, regex is needed without -c')
+    parser.add_argument('--stats',
+                        default=False,
+                        action='store_true',
+                        help='print how many files each stage kept')
+    parser.add_argument('--group-backend',
+                        choices=GROUP_BACKENDS,
+                        default='python',
+                        help='set how files are grouped by size and '
+                        'checksum, numpy sorts arrays for large scans')
     parser.add_argument('--hash-function',
-                        type=str,
+                        type=check_hash_names,
                         default='md5',
-                        choices=hashlib.algorithms_available,
-                        help='set hash function to use for checksums')
+                        metavar='NAME[,NAME...]',
+                        help='set hash functions to use for checksums, files '
+                        'are grouped on the first')
+    parser.add_argument('--tree-hash',
+                        metavar='SIZE',
+                        type=parse_size,
+                        help='hash files larger than size in ranges of size '
+                        'on every core, such as 1G')
+    parser.add_argument('--chunk-cache',
+                        metavar='CACHE',
+                        help='keep range checksums of tree hashed files in '
+                        'cache, so files that grew only have their new data '
+                        'read')
     parser.add_argument('--make-links',
                         default=False,
                         action='store_true',
                         help='create hard link rather than remove file')
+    parser.add_argument('--quarantine',
+                        metavar='DIR',
+                        help='move duplicates into a trash tree in dir, on '
+                        'the same filesystem, rather than remove them')
+    parser.add_argument('--purge-quarantine',
+                        default=False,
+                        action='store_true',
+                        help='delete the quarantined files of the paths, '
+                        'oldest run first')
+    parser.add_argument('--purge-rate',
+                        metavar='SIZE',
+                        type=parse_size,
+                        help='delete at most size each second when purging, '
+                        'such as 100M')
+    parser.add_argument('--reflink',
+                        default=False,
+                        action='store_true',
+                        help='share data with kept file rather than remove '
+                        'file (btrfs and xfs only)')
+    parser.add_argument('--fsync-dirs',
+                        default=False,
+                        action='store_true',
+                        help='sync each changed directory to disk once at '
+                        'the end')
     parser.add_argument('--remove-links',
                         default=False,
                         action='store_true',
                         help='remove hardlinks rather than skipping')
+    parser.add_argument('--async-io',
+                        default=False,
+                        action='store_true',
+                        help='overlap directory listings and file reads, '
+                        'for high latency filesystems')
+    parser.add_argument('--concurrency',
+                        type=int,
+                        default=8,
+                        help='set number of files read at once with '
+                        '--async-io')
+    parser.add_argument('--exclude',
+                        metavar='GLOB',
+                        action='append',
+                        help='skip files and directories whose name matches '
+                        'the glob')
+    parser.add_argument('--min-size',
+                        metavar='SIZE',
+                        type=parse_size,
+                        help='skip files smaller than size, such as 4K')
+    parser.add_argument('--max-size',
+                        metavar='SIZE',
+                        type=parse_size,
+                        help='skip files larger than size, such as 2G')
+    parser.add_argument('--read-empty',
+                        default=False,
+                        action='store_true',
+                        help='read empty files rather than trusting their '
+                        'size')
+    parser.add_argument('--trees',
+                        default=False,
+                        action='store_true',
+                        help='remove duplicate directory trees as a whole')
+    parser.add_argument('--reference',
+                        metavar='INDEX',
+                        help='remove files whose content is in the reference '
+                        'index')
+    parser.add_argument('--build-reference',
+                        metavar='INDEX',
+                        help='write reference index of files rather than '
+                        'remove files')
+    parser.add_argument('--save-index',
+                        metavar='INDEX',
+                        help='write scan results of hashed files to index')
+    parser.add_argument('--bloom',
+                        metavar='FILTER',
+                        help='skip hashing files missing from the bloom '
+                        'filter of the reference')
+    parser.add_argument('--build-bloom',
+                        metavar='FILTER',
+                        help='write bloom filter of files rather than remove '
+                        'files')
+    parser.add_argument('--checkpoint',
+                        help='save progress to file at regular intervals')
+    parser.add_argument('--resume',
+                        default=False,
+                        action='store_true',
+                        help='skip work saved in the checkpoint file')
+    parser.add_argument('--watch',
+                        default=False,
+                        action='store_true',
+                        help='keep running and trim new files as they are '
+                        'written (linux only)')
     parser.add_argument('--version',
                         action='version',
                         version='%(prog)s ' + __version__)
 
     args = parser.parse_args(args_param)
 
-    if not os.path.isdir(args.path):
-        print(args.path)
-        parser.error('path was not a directory: "{0}"'.format(args.path))
+    for path in args.path:
+        if not os.path.isdir(path):
+            print(path)
+            parser.error('path was not a directory: "{0}"'.format(path))
+
+    if args.fsync_dirs and args.no_action:
+        parser.error('Fsync dirs set while taking no action')
+
+    if args.reflink and args.make_links:
+        parser.error('Reflink set while making links')
+
+    if args.quarantine and (args.make_links or args.reflink):
+        parser.error('Quarantine set while making links')
+
+    if args.quarantine and args.watch:
+        parser.error('Quarantine set while watching')
+
+    if args.quarantine and args.purge_quarantine:
+        parser.error('Quarantine set while purging quarantine')
+
+    if args.purge_rate is not None and not args.purge_quarantine:
+        parser.error('Purge rate set without purging quarantine')
+
+    if args.purge_rate is not None and args.purge_rate < 1:
+        parser.error('Purge rate must be positive')
+
+    if args.concurrency != 8 and not args.async_io:
+        parser.error('Concurrency set without async io')
+
+    if args.concurrency < 1:
+        parser.error('Concurrency must be at least 1')
+
+    if args.reference and (args.make_links or args.reflink):
+        parser.error('Reference set while making links')
+
+    if (args.min_size is not None and args.max_size is not None and
+            args.min_size > args.max_size):
+        parser.error('Minimum size larger than maximum size')
+
+    if args.tree_hash is not None and args.tree_hash < 1:
+        parser.error('Tree hash size must be positive')
+
+    if args.chunk_cache and not args.tree_hash:
+        parser.error('Chunk cache set without tree hash')
+
+    if args.tree_hash and (args.reference or args.build_reference):
+        parser.error('Tree hash set while using reference index')
+
+    if args.group_backend == 'numpy' and numpy is None:
+        parser.error('Numpy backend set without numpy installed')
+
+    if args.pipeline and 'regex' in args.pipeline and args.skip_regex:
+        parser.error('Regex stage set while skipping regex')
+
+    if args.pipeline and 'regex' not in args.pipeline and not args.skip_regex:
+        parser.error('Regex stage left out without only checksum')
+
+    if args.trees and not args.recursive:
+        parser.error('Trees set without recursive')
+
+    if args.trees and (args.make_links or args.reflink or args.watch):
+        parser.error('Trees set while making links, reflinking or watching')
+
+    if args.reference and args.build_reference:
+        parser.error('Reference set while building reference')
+
+    if args.build_reference and args.watch:
+        parser.error('Building reference while watching')
+
+    if args.reference:
+        try:
+            index = open_index(args.reference)
+        except (OSError, ValueError) as err:
+            parser.error('Invalid reference index: {0}'.format(err))
+        index.close()
+        if index.hash_name != list_hash_names(args.hash_function)[0]:
+            parser.error('Reference index uses hash function "{0}"'.format(
+                index.hash_name))
+
+    if args.bloom and not args.reference:
+        parser.error('Bloom filter set without reference')
+
+    if args.build_bloom and (args.build_reference or args.watch):
+        parser.error('Building bloom filter while building reference or '
+                     'watching')
+
+    if args.bloom:
+        try:
+            BloomFilter(args.bloom).close()
+        except (OSError, ValueError) as err:
+            parser.error('Invalid bloom filter: {0}'.format(err))
+
+    if args.resume and not args.checkpoint:
+        parser.error('Resume set without checkpoint file')
+
+    if args.checkpoint and args.watch:
+        parser.error('Checkpoint set while watching')
+
+    if args.watch and not sys.platform.startswith('linux'):
+        parser.error('Watching for new files requires linux')
 
     if args.log_level != 3 and not args.log_file:
         parser.error('Log level set without log file')
@@ -536,27 +3471,50 @@ def main(args_param=None):
         parser.error('Invalid regular expression: "{0}"'.format(
             args.regex_pattern))
 
-    stream = logging.StreamHandler()
+    stream = BatchStreamHandler()
     stream.setLevel((5 - args.verbosity) * 10)
     formatter_simple = logging.Formatter(
         '%(asctime)s - %(levelname)s - %(message)s')
     stream.setFormatter(formatter_simple)
-    root_logger = logging.getLogger('')
-    root_logger.addHandler(stream)
-    root_logger.setLevel(logging.DEBUG)
+    handlers = [stream]
 
     if args.log_file:
         try:
-            log_file = logging.FileHandler(args.log_file)
+            log_stream = open(args.log_file, 'a')
         except OSError as err:
             sys.exit("Couldn't open log file: {0}".format(err))
+        log_file = BatchStreamHandler(log_stream)
         log_file.setFormatter(formatter_simple)
         log_file.setLevel((5 - args.log_level) * 10)
-        root_logger.addHandler(log_file)
+        handlers.append(log_file)
 
-    root_logger.debug("Args: %s", args)
+    queue_handler = logging.handlers.QueueHandler(queue.Queue())
+    queue_handler.setLevel(min(handler.level for handler in handlers))
+    listener = BatchQueueListener(queue_handler.queue, *handlers,
+                                  respect_handler_level=True)
+    root_logger = logging.getLogger('')
+    root_logger.addHandler(queue_handler)
+    root_logger.setLevel(logging.DEBUG)
+    listener.start()
 
-    walk_path(**vars(args))
+    try:
+        root_logger.debug("Args: %s", args)
+
+        if args.purge_quarantine:
+            purge_quarantine(**vars(args))
+        elif args.build_bloom:
+            build_bloom(**vars(args))
+        elif args.build_reference:
+            build_reference(**vars(args))
+        elif args.watch:
+            watch_path(**vars(args))
+        else:
+            walk_path(**vars(args))
+    finally:
+        root_logger.removeHandler(queue_handler)
+        listener.stop()
+        if args.log_file:
+            log_stream.close()
 
 
 if __name__ == '__main__':